@@ -3,12 +3,18 @@
 This is my first attempt to make a GUI for my Keithley application.
 """
 
+import os
 import sys
 from PyQt4.QtCore import *
 from PyQt4.QtGui import *
 import visa
 from keithley import SMUExperiments
 import filemanipulation as fm
+from catalog import RunCatalog
+from estimator import RunEstimate, estimate_run, describe_estimate
+from journal import read_journal
+import sweeps
+import reduction
 import ui_MainWindow
 import ui_RunConfiguration
 
@@ -146,6 +152,182 @@ class RunConfigurationDlg(QDialog,
 
 
 
+class SweepConfigurationDlg(QDialog):
+
+    """Dialog to build, save and load sweeps.
+
+    A sweep is built by adding segments from the sweep generators. The
+    table lists every setpoint; a Dwell or PointDelay typed into it
+    overrides the run default for that setpoint, an empty cell uses
+    the default.
+    """
+
+    def __init__(self, Sweep, Library, parent=None):
+        """Initialize dialog."""
+        super(SweepConfigurationDlg, self).__init__(parent)
+        self.setWindowTitle('Sweep Configuration')
+        self.Sweep = sweeps.Sweep.from_dict(Sweep.to_dict())
+        self.Library = Library
+        self._updating = False
+
+        self.SweepName = QComboBox()
+        self.SweepName.setEditable(True)
+        self.btnLoad = QPushButton('Load')
+        self.btnSave = QPushButton('Save')
+        self.btnDelete = QPushButton('Delete')
+        nameLayout = QHBoxLayout()
+        nameLayout.addWidget(QLabel('Name'))
+        nameLayout.addWidget(self.SweepName, 1)
+        nameLayout.addWidget(self.btnLoad)
+        nameLayout.addWidget(self.btnSave)
+        nameLayout.addWidget(self.btnDelete)
+
+        self.Generator = QComboBox()
+        self.Generator.addItems(sorted(sweeps.GENERATORS))
+        self.ParameterLabels = []
+        self.Parameters = []
+        segmentLayout = QHBoxLayout()
+        segmentLayout.addWidget(self.Generator)
+        for _ in range(max(len(names) for names in
+                           sweeps.PARAMETERS.values())):
+            label = QLabel()
+            edit = QLineEdit()
+            segmentLayout.addWidget(label)
+            segmentLayout.addWidget(edit)
+            self.ParameterLabels.append(label)
+            self.Parameters.append(edit)
+        self.btnAdd = QPushButton('Add Segment')
+        self.btnClear = QPushButton('Clear')
+        segmentLayout.addWidget(self.btnAdd)
+        segmentLayout.addWidget(self.btnClear)
+
+        self.Table = QTableWidget(0, 3)
+        self.Table.setHorizontalHeaderLabels(['SetPoint', 'Dwell (s)',
+                                              'PointDelay (s)'])
+        buttons = QDialogButtonBox(QDialogButtonBox.Ok |
+                                   QDialogButtonBox.Cancel)
+        layout = QVBoxLayout()
+        layout.addLayout(nameLayout)
+        layout.addLayout(segmentLayout)
+        layout.addWidget(self.Table)
+        layout.addWidget(buttons)
+        self.setLayout(layout)
+
+        self.connect(self.Generator, SIGNAL('currentIndexChanged(int)'),
+                     self.updateParameters)
+        self.connect(self.btnAdd, SIGNAL('clicked()'), self.addSegment)
+        self.connect(self.btnClear, SIGNAL('clicked()'), self.clearSweep)
+        self.connect(self.btnLoad, SIGNAL('clicked()'), self.loadSweep)
+        self.connect(self.btnSave, SIGNAL('clicked()'), self.saveSweep)
+        self.connect(self.btnDelete, SIGNAL('clicked()'), self.deleteSweep)
+        self.connect(self.Table, SIGNAL('cellChanged(int, int)'),
+                     self.updateOverride)
+        self.connect(buttons, SIGNAL('accepted()'), self.accept)
+        self.connect(buttons, SIGNAL('rejected()'), self.reject)
+
+        self.updateNames()
+        self.updateParameters()
+        self.updateUI()
+
+    def updateNames(self):
+        """Fill the name box with the sweeps in the library."""
+        self.SweepName.clear()
+        self.SweepName.addItems(sorted(sweeps.read_library(self.Library)))
+        self.SweepName.setEditText(self.Sweep.Name)
+
+    def updateParameters(self):
+        """Show the parameters of the selected generator."""
+        names = sweeps.PARAMETERS[str(self.Generator.currentText())]
+        for key, (label, edit) in enumerate(zip(self.ParameterLabels,
+                                                self.Parameters)):
+            visible = key < len(names)
+            label.setVisible(visible)
+            edit.setVisible(visible)
+            if visible:
+                label.setText(names[key])
+
+    def updateUI(self):
+        """Fill the table with the setpoints of the sweep."""
+        self._updating = True
+        setpoints = self.Sweep.setpoints()
+        self.Table.setRowCount(len(setpoints))
+        for row, value in enumerate(setpoints):
+            item = QTableWidgetItem(str(value))
+            item.setFlags(item.flags() & ~Qt.ItemIsEditable)
+            self.Table.setItem(row, 0, item)
+            overrides = self.Sweep.Overrides.get(row, {})
+            for column, key in ((1, 'Dwell'), (2, 'PointDelay')):
+                text = str(overrides[key]) if key in overrides else ''
+                self.Table.setItem(row, column, QTableWidgetItem(text))
+        self._updating = False
+
+    def addSegment(self):
+        """Add a segment made by the selected generator."""
+        generator = str(self.Generator.currentText())
+        kwargs = {}
+        try:
+            for name, edit in zip(sweeps.PARAMETERS[generator],
+                                  self.Parameters):
+                text = str(edit.text()).strip()
+                if not text:
+                    continue
+                if name == 'Values':
+                    kwargs[name] = [float(value) for value in
+                                    text.replace(',', ' ').split()]
+                else:
+                    kwargs[name] = float(text)
+            self.Sweep.add(generator, **kwargs)
+        except (TypeError, ValueError) as e:
+            QMessageBox.warning(self, 'Sweep Configuration',
+                                'Could not add the segment: %s' % e)
+            return
+        self.updateUI()
+
+    def clearSweep(self):
+        """Remove all of the segments and overrides."""
+        self.Sweep = sweeps.Sweep(str(self.SweepName.currentText()))
+        self.updateUI()
+
+    def updateOverride(self, row, column):
+        """Store a Dwell or PointDelay typed into the table."""
+        if self._updating or column == 0:
+            return
+        values = []
+        for key in (1, 2):
+            text = str(self.Table.item(row, key).text()).strip()
+            try:
+                values.append(float(text) if text else None)
+            except ValueError:
+                values.append(None)
+        self.Sweep.override(row, *values)
+
+    def loadSweep(self):
+        """Load the named sweep from the library."""
+        name = str(self.SweepName.currentText())
+        try:
+            self.Sweep = sweeps.load_sweep(name, self.Library)
+        except KeyError:
+            QMessageBox.warning(self, 'Sweep Configuration',
+                                'There is no sweep named %s.' % name)
+            return
+        self.updateUI()
+
+    def saveSweep(self):
+        """Save the sweep to the library under the name in the box."""
+        self.Sweep.Name = str(self.SweepName.currentText())
+        sweeps.save_sweep(self.Sweep, self.Library)
+        self.updateNames()
+
+    def deleteSweep(self):
+        """Delete the named sweep from the library."""
+        sweeps.delete_sweep(str(self.SweepName.currentText()), self.Library)
+        self.updateNames()
+
+    def accept(self):
+        self.Sweep.Name = str(self.SweepName.currentText())
+        super(SweepConfigurationDlg, self).accept()
+
+
 class MainWindow(QMainWindow,
                  ui_MainWindow.Ui_MainWindow):
 
@@ -166,20 +348,38 @@ class MainWindow(QMainWindow,
         if settings.value('ComplianceLevel'):
             self._KWARGS['ComplianceLevel'] = \
                 settings.value('ComplianceLevel').toDouble()
-        self.__Sweep = [-0.005, -0.004, -0.003, -0.002,
-                        -0.001, 0.0, 0.001, 0.002,
-                        0.003,0.004, 0.005, 0.006, 0.007, 0.008
-                        ]
+        # Sweep library and the sweep that was used last.
+        self.SweepLibrary = str(settings.value(
+            'SweepLibrary', DEFAULT_SWEEP_LIBRARY).toString())
+        SweepName = str(settings.value('SweepName', '').toString())
+        try:
+            self.Sweep = sweeps.load_sweep(SweepName, self.SweepLibrary)
+        except (KeyError, ValueError):
+            self.Sweep = sweeps.DEFAULT_SWEEP
         self.ConfigDlg = RunConfigurationDlg(self._KWARGS, self._RunArgs, self)
         self.setupUi(self)
-        self.btnSweepConfig.setDisabled(True)
         self.btnSave.setDisabled(True)
         self.btnRun.setDisabled(True)
         # Connect Buttons
         self.connect(self.btnConfigure, SIGNAL('clicked()'),
                      self._openConfigDlg)
+        self.connect(self.btnSweepConfig, SIGNAL('clicked()'),
+                     self._openSweepDlg)
         self.connect(self.btnRun, SIGNAL('clicked()'), self._RunExperiment)
         self.connect(self.btnSave, SIGNAL('clicked()'), self._SaveData)
+        # Catalog of recorded runs.
+        CatalogPath = settings.value('CatalogPath', DEFAULT_CATALOG)
+        self.Catalog = RunCatalog(str(CatalogPath.toString()))
+        # Compression of recorded files ('gzip', 'xz', 'quantized' or ''
+        # for none).
+        self.Compression = str(settings.value('Compression', '').toString())
+        # Reduction of the chrono data ('deadband', 'swinging door' or
+        # '' for none) and its voltage and current bands (a band of 0
+        # leaves that column out, at least one has to be set).
+        self.Reduction = str(settings.value('Reduction', '').toString())
+        self.VoltageBand, _ = settings.value('VoltageBand', 0.).toDouble()
+        self.CurrentBand, _ = settings.value('CurrentBand', 0.).toDouble()
+        self._updateEstimate()
 
     def _openConfigDlg(self):
         """Open configuration dialog.
@@ -196,6 +396,15 @@ class MainWindow(QMainWindow,
         self.ConfigDlg.exec_()
         self.btnRun.setEnabled(True)
         self.updateArguments()
+        self._updateEstimate()
+
+    def _openSweepDlg(self):
+        """Open the sweep configuration dialog."""
+        dialog = SweepConfigurationDlg(self.Sweep, self.SweepLibrary, self)
+        if dialog.exec_():
+            self.Sweep = dialog.Sweep
+            QSettings().setValue('SweepName', self.Sweep.Name)
+            self._updateEstimate()
 
     def _RunExperiment(self):
         """Run experiment.
@@ -206,15 +415,85 @@ class MainWindow(QMainWindow,
         process so the UI doesn't hang while running.
         """
         self.updateArguments()
+        try:
+            reducer = reduction.make_filter(
+                self.Reduction, self.VoltageBand, self.CurrentBand)
+        except ValueError as e:
+            QMessageBox.warning(self, 'Data Reduction', str(e))
+            return
         self.SMU = SMUExperiments(self._KWARGS['GPIBAddr'])
         """self._KWARGS = self.ConfigDlg._KWARGS
         self._RunArgs = self.ConfigDlg._RunArgs"""
         self.SMU.KWARGS = self._KWARGS
         self.SMU.RunArgs = self._RunArgs
-        self.Data = self.SMU.slow_chrono(self.__Sweep,
-                                         self._KWARGS['ExperimentLength'],
-                                         self._KWARGS['PointDelay'])
+        self.SMU.Reduction = reducer
+        # Runs are journaled so that a crashed run can be resumed.
+        self.SMU.Journal = self._RunArgs['DataPath'] + 'run.journal'
+        self.btnSave.setDisabled(True)
+        self._setRunning(True)
+        try:
+            if self._resumeRun():
+                return
+            plan = self.Sweep.plan(self._KWARGS)
+            self.SweepPath = plan['SetPoint'].tolist()
+            estimate = RunEstimate(
+                self._KWARGS, plan, self.SMU, self.Compression or None,
+                Callback=self._showEstimate)
+            self.SMU.Listeners.append(estimate)
+            try:
+                self.Data = self.SMU.slow_chrono(plan)
+            finally:
+                self.SMU.Listeners.remove(estimate)
+            self.btnSave.setEnabled(True)
+        finally:
+            self._setRunning(False)
+
+    def _setRunning(self, Running):
+        """Disable the controls that start or change a run during one.
+
+        _showEstimate processes events while the run goes, so a click
+        on them would otherwise start a second run on the same SMU.
+        """
+        for button in (self.btnRun, self.btnConfigure, self.btnSweepConfig):
+            button.setDisabled(Running)
+
+    def _resumeRun(self):
+        """Offer to resume a run that was interrupted.
+
+        Returns True if there was one and it was resumed.
+        """
+        if not os.path.exists(self.SMU.Journal):
+            return False
+        state = read_journal(self.SMU.Journal)
+        if state['Plan'] is None or state['Complete']:
+            return False
+        answer = QMessageBox.question(
+            self, 'Resume Run',
+            'A run in %s was interrupted after %d of %d setpoints. '
+            'Resume it?' % (self._RunArgs['DataPath'], state['Finished'],
+                            len(state['Plan'])),
+            QMessageBox.Yes | QMessageBox.No)
+        if answer != QMessageBox.Yes:
+            return False
+        self.SweepPath = state['Plan']['SetPoint'].tolist()
+        self.Data = self.SMU.resume_chrono(self.SMU.Journal)
+        self._RunArgs = self.SMU.RunArgs
         self.btnSave.setEnabled(True)
+        return True
+
+    def _updateEstimate(self):
+        """Show the estimated cost of the run in the status bar."""
+        self._showEstimate(estimate_run(self._KWARGS, self.Sweep,
+                                        Compression=self.Compression or None))
+
+    def _showEstimate(self, Estimate):
+        """Show a run estimate in the status bar.
+
+        This is also called while a run is going, so it processes
+        events to get the message on screen.
+        """
+        self.statusBar().showMessage(describe_estimate(Estimate))
+        QApplication.processEvents()
 
     def updateArguments(self):
         """Run to update KWARGS and RunArgs."""
@@ -249,7 +528,10 @@ class MainWindow(QMainWindow,
     def _SaveData(self):
         """Run the save data routiene."""
         self.updateArguments()
-        fm.record_data_files(self.Data, self.__Sweep, self._RunArgs)
+        fm.record_data_files(self.Data, self.SweepPath, self._RunArgs,
+                             Catalog=self.Catalog,
+                             Compression=self.Compression or None,
+                             Ranges=self.SMU.measure_ranges())
         self.btnSave.setDisabled(True)
 
 
@@ -282,6 +564,11 @@ DEFAULT_RunArgs = {'Membrane': '', 'MembraneID': '',
                                 '1.14-0.01\\14-06-19\\'),
                    'User': '', 'CellDesign': '', 'Comments': ''}
 
+DEFAULT_CATALOG = os.path.join(os.path.expanduser('~'), 'SMUExperiments',
+                               'catalog.sqlite')
+DEFAULT_SWEEP_LIBRARY = os.path.join(os.path.expanduser('~'),
+                                     'SMUExperiments', 'sweeps.json')
+
 
 def main():
     app = QApplication(sys.argv)
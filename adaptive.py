@@ -0,0 +1,200 @@
+"""Adaptive sweeps.
+
+A fixed staircase spends as long on the straight ohmic part of an I-V
+curve as on the limiting current plateau and the transition to
+overlimiting current, where the curve bends and the detail is wanted.
+An AdaptiveSweep picks its setpoints as the run goes instead. It
+starts with a few setpoints spread over the range; after that, every
+time a setpoint finishes, the curve through the steady states measured
+so far is refit and the next setpoint is the one that best splits the
+interval where the curve bends the most. Setpoints where the curve is
+straight are skipped:
+
+    sweep = AdaptiveSweep(sweeps.linear(-0.005, 0.008, 53),
+                          MaxSetPoints=20)
+    data = SMU.slow_chrono(sweep)
+
+Setpoints are only picked from the Candidates (a fine grid, so the
+setpoints and filenames line up with those of fixed sweeps over the
+same grid). The sweep ends when no interval bends more than Tolerance,
+or when its budget of setpoints (MaxSetPoints) or run time (MaxTime)
+is spent.
+"""
+
+import numpy as np
+import analysis
+import sweeps
+
+
+class AdaptiveSweep(object):
+
+    """A sweep that picks its setpoints from Candidates as it runs.
+
+    slow_chrono adds the sweep to its Listeners for the run, so the
+    steady state of every setpoint (over the last Window seconds or
+    nPoints rows, see analysis.steady_state) is added to the curve,
+    and takes the setpoints to run from steps. The InitialPoints
+    setpoints spread evenly over the Candidates are run first. Dwell
+    and PointDelay are the same for every setpoint and default to the
+    ExperimentLength and PointDelay in KWARGS. MaxTime is in seconds
+    of run time (the global time of the points).
+    """
+
+    def __init__(self, Candidates, InitialPoints=5, Tolerance=0.02,
+                 MaxSetPoints=None, MaxTime=None, Window=None, nPoints=2,
+                 Dwell=None, PointDelay=None, Name='Adaptive'):
+        if isinstance(Candidates, sweeps.Sweep):
+            Candidates = Candidates.setpoints()
+        self.Candidates = np.unique(sweeps.round_setpoints(Candidates))
+        if len(self.Candidates) < 2:
+            raise ValueError('An adaptive sweep needs at least two '
+                             'candidate setpoints.')
+        self.InitialPoints = int(InitialPoints)
+        self.Tolerance = Tolerance
+        self.MaxSetPoints = MaxSetPoints
+        self.MaxTime = MaxTime
+        self.Window = Window
+        self.nPoints = nPoints
+        self.Dwell = Dwell
+        self.PointDelay = PointDelay
+        self.Name = Name
+        self.reset()
+
+    def reset(self):
+        """Forget the results of a run."""
+        # Setpoints run so far and their steady states.
+        self.SetPoints = []
+        self.Voltage = []
+        self.Current = []
+        # Global time at the end of the last setpoint (s).
+        self.Elapsed = 0.
+        self._setPoint = None
+
+    def initial_setpoints(self):
+        """The setpoints that are run before any refinement."""
+        count = min(max(self.InitialPoints, 2), len(self.Candidates))
+        index = np.round(np.linspace(0, len(self.Candidates) - 1, count))
+        return self.Candidates[np.unique(index.astype(int))].tolist()
+
+    def _timing(self, KWARGS):
+        return (KWARGS['ExperimentLength'] if self.Dwell is None
+                else self.Dwell,
+                KWARGS['PointDelay'] if self.PointDelay is None
+                else self.PointDelay)
+
+    def plan(self, KWARGS):
+        """Plan of the initial setpoints (see sweeps.make_plan).
+
+        The rest of the setpoints are only known as the run goes.
+        """
+        dwell, delay = self._timing(KWARGS)
+        return sweeps.make_plan(self.initial_setpoints(),
+                                {'ExperimentLength': dwell,
+                                 'PointDelay': delay})
+
+    def add_result(self, SetPoint, Table):
+        """Add the points of a finished setpoint to the curve."""
+        ss = analysis.steady_state([np.asarray(Table)], self.Window,
+                                   self.nPoints)
+        self.SetPoints.append(float(SetPoint))
+        self.Voltage.append(float(ss['Voltage'][0]))
+        self.Current.append(float(ss['Current'][0]))
+        if len(Table):
+            self.Elapsed = max(self.Elapsed, float(Table[-1][3]))
+
+    def setpoint_started(self, Index, SetPoint):
+        self._setPoint = SetPoint
+
+    def setpoint_finished(self, Index, Data):
+        self.add_result(self._setPoint, Data)
+
+    def losses(self):
+        """How much the curve bends over each interval.
+
+        The steady states are put in setpoint order and scaled by the
+        range of the voltage and of the current so that both count the
+        same. The loss of the interval between two neighbouring
+        setpoints is its length on that scale times the mean of the
+        angles the curve turns through at its two ends. Returns the
+        lower and upper setpoint and the loss of every interval.
+        """
+        setPoints = np.array(self.SetPoints)
+        curve = np.column_stack((self.Current, self.Voltage))
+        keep = ~np.isnan(curve).any(axis=1)
+        order = np.argsort(setPoints[keep])
+        setPoints = setPoints[keep][order]
+        curve = curve[keep][order]
+        if len(setPoints) < 2:
+            return setPoints[:0], setPoints[:0], np.zeros(0)
+        span = np.ptp(curve, axis=0)
+        curve = curve / np.where(span > 0, span, 1)
+        steps = np.diff(curve, axis=0)
+        lengths = np.hypot(steps[:, 0], steps[:, 1])
+        angles = np.arctan2(steps[:, 1], steps[:, 0])
+        turns = np.zeros(len(setPoints))
+        turns[1:-1] = np.abs((np.diff(angles) + np.pi) % (2 * np.pi) - np.pi)
+        loss = lengths * 0.5 * (turns[:-1] + turns[1:])
+        return setPoints[:-1], setPoints[1:], loss
+
+    def next_setpoint(self):
+        """The setpoint to run next, or None if the curve is done.
+
+        This is the next initial setpoint not yet run or else the
+        candidate closest to the middle of the interval with the
+        largest loss, if that is more than Tolerance. Intervals with
+        no candidate left inside them are done.
+        """
+        for setPoint in self.initial_setpoints():
+            if setPoint not in self.SetPoints:
+                return setPoint
+        lower, upper, loss = self.losses()
+        if not len(loss):
+            return None
+        candidates = self.Candidates
+        middle = 0.5 * (lower + upper)
+        above = np.clip(np.searchsorted(candidates, middle), 1,
+                        len(candidates) - 1)
+        below = above - 1
+        nearest = np.where(middle - candidates[below] <=
+                           candidates[above] - middle, below, above)
+        choice = candidates[nearest]
+        inside = ((choice > lower) & (choice < upper) &
+                  ~np.isin(choice, self.SetPoints))
+        loss = np.where(inside, loss, 0)
+        best = int(np.argmax(loss))
+        if loss[best] <= self.Tolerance:
+            return None
+        return float(choice[best])
+
+    def steps(self, KWARGS):
+        """Yield the (SetPoint, Dwell, PointDelay) of each setpoint to run.
+
+        Each step is only picked once the setpoint before it has been
+        added (through add_result), and the steps end with the curve or
+        the budget.
+        """
+        dwell, delay = self._timing(KWARGS)
+        while True:
+            if (self.MaxSetPoints is not None and
+                    len(self.SetPoints) >= self.MaxSetPoints):
+                return
+            if (self.MaxTime is not None and
+                    self.Elapsed + dwell > self.MaxTime):
+                return
+            setPoint = self.next_setpoint()
+            if setPoint is None:
+                return
+            yield setPoint, dwell, delay
+
+    def to_dict(self):
+        return {'Name': self.Name, 'Candidates': self.Candidates.tolist(),
+                'InitialPoints': self.InitialPoints,
+                'Tolerance': self.Tolerance,
+                'MaxSetPoints': self.MaxSetPoints, 'MaxTime': self.MaxTime,
+                'Window': self.Window, 'nPoints': self.nPoints,
+                'Dwell': self.Dwell, 'PointDelay': self.PointDelay}
+
+    @classmethod
+    def from_dict(cls, definition):
+        return cls(**dict((str(key), value) for key, value in
+                          definition.items()))
@@ -0,0 +1,273 @@
+"""Analysis of chrono sweeps.
+
+The functions in this module take the output of a chrono sweep (a list
+of [voltage, current, local time, global time] arrays, one for each
+setpoint, or a datastore.RunData as returned by
+SMUExperiments.slow_chrono, or loaded with load_sweep) and compute the
+usual quantities for every setpoint at once: steady state statistics
+over a window at the end of each step, the steady state I-V curve,
+differential and ohmic resistance, transition time constants and the
+charge passed.
+
+Rather than looping over setpoints, the sweep is concatenated into one
+array with a setpoint index for every row and each quantity is
+computed with a few vectorized numpy operations. analyze_runs runs
+analyze_run over many runs in a process pool.
+"""
+
+import multiprocessing
+from functools import partial
+import numpy as np
+import filemanipulation as fm
+from datastore import RunData
+
+try:
+    basestring
+except NameError:
+    basestring = str
+
+VOLTAGE = 0
+CURRENT = 1
+LOCAL_TIME = 2
+GLOBAL_TIME = 3
+
+
+def _stack(data):
+    """Concatenate a sweep into one array.
+
+    Returns the concatenated array, the setpoint index of every row,
+    the position of every row within its setpoint and the number of
+    rows of every setpoint. A RunData is already one array, so this
+    costs no copy.
+    """
+    lengths = np.array([len(table) for table in data], dtype=np.intp)
+    if isinstance(data, RunData):
+        table = data.table()
+    elif lengths.sum():
+        table = np.concatenate([np.asarray(t)[:, :4]
+                                for t in data if len(t)])
+    else:
+        table = np.zeros((0, 4))
+    index = np.repeat(np.arange(len(data)), lengths)
+    starts = np.cumsum(lengths) - lengths
+    position = np.arange(len(table)) - starts[index]
+    return table, index, position, lengths
+
+
+def _window_mask(table, index, position, lengths, Window, nPoints):
+    """Select the rows at the end of each setpoint.
+
+    If Window is given, the rows within Window seconds (local time) of
+    the last row of each setpoint are selected, otherwise the last
+    nPoints rows.
+    """
+    if Window is None:
+        return position >= (lengths - nPoints)[index]
+    ends = np.cumsum(lengths) - 1
+    tEnd = np.zeros(len(lengths))
+    has = lengths > 0
+    tEnd[has] = table[ends[has], LOCAL_TIME]
+    return table[:, LOCAL_TIME] >= (tEnd - Window)[index]
+
+
+def _group_mean_std(values, index, mask, nGroups):
+    """Return the per group mean, standard deviation and count."""
+    idx = index[mask]
+    values = values[mask]
+    count = np.bincount(idx, minlength=nGroups).astype(float)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.bincount(idx, weights=values, minlength=nGroups) / count
+        dev = (values - mean[idx]) ** 2
+        std = np.sqrt(np.bincount(idx, weights=dev, minlength=nGroups) /
+                      count)
+    return mean, std, count
+
+
+def steady_state(data, Window=None, nPoints=2):
+    """Compute steady state statistics for each setpoint of a sweep.
+
+    The steady state values are taken over the last Window seconds of
+    each setpoint, or the last nPoints rows if no Window is given (the
+    default of two rows matches generate_ss_array). Returns a dictionary
+    of arrays with one entry per setpoint: Voltage, VoltageStd,
+    Current, CurrentStd, Count, LocalTime (end of the step) and
+    GlobalTime (median global time of the window).
+    """
+    table, index, position, lengths = _stack(data)
+    mask = _window_mask(table, index, position, lengths, Window, nPoints)
+    nGroups = len(lengths)
+    voltage, voltageStd, count = _group_mean_std(table[:, VOLTAGE], index,
+                                                 mask, nGroups)
+    current, currentStd, _ = _group_mean_std(table[:, CURRENT], index,
+                                             mask, nGroups)
+    ends = np.cumsum(lengths) - 1
+    localTime = np.full(nGroups, np.nan)
+    globalTime = np.full(nGroups, np.nan)
+    for key in np.flatnonzero(count):
+        # Medians are not vectorizable, but this only touches the
+        # (small) window of each step.
+        globalTime[key] = np.median(table[mask & (index == key),
+                                          GLOBAL_TIME])
+        localTime[key] = table[ends[key], LOCAL_TIME]
+    return {'Voltage': voltage, 'VoltageStd': voltageStd,
+            'Current': current, 'CurrentStd': currentStd, 'Count': count,
+            'LocalTime': localTime, 'GlobalTime': globalTime}
+
+
+def iv_curve(data, Window=None, nPoints=2):
+    """Return the steady state I-V curve of a sweep.
+
+    The output is an (n, 2) array of [current, voltage] sorted by
+    current.
+    """
+    ss = steady_state(data, Window, nPoints)
+    order = np.argsort(ss['Current'])
+    return np.column_stack((ss['Current'][order], ss['Voltage'][order]))
+
+
+def differential_resistance(IV):
+    """Return dV/dI along an I-V curve from iv_curve.
+
+    Points with the same current are not allowed to give infinite
+    resistance; their derivative is returned as nan.
+    """
+    current = IV[:, 0]
+    voltage = IV[:, 1]
+    if len(current) < 2:
+        return np.full(len(current), np.nan)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        resistance = np.gradient(voltage) / np.gradient(current)
+    resistance[~np.isfinite(resistance)] = np.nan
+    return resistance
+
+
+def ohmic_fit(IV, MaxCurrent=None):
+    """Fit the ohmic region of an I-V curve.
+
+    A line is fit to the points with |current| <= MaxCurrent (all
+    points if MaxCurrent is None). Returns the resistance (slope, in
+    ohms) and the membrane potential (voltage at zero current).
+    """
+    current = IV[:, 0]
+    voltage = IV[:, 1]
+    if MaxCurrent is not None:
+        keep = np.abs(current) <= MaxCurrent
+        current = current[keep]
+        voltage = voltage[keep]
+    if len(current) < 2:
+        return np.nan, np.nan
+    resistance, potential = np.polyfit(current, voltage, 1)
+    return resistance, potential
+
+
+def time_constants(data, Column=VOLTAGE, Fraction=1 - np.exp(-1),
+                   Window=None, nPoints=2):
+    """Return the transition time of each setpoint.
+
+    The transition time is the local time at which the measured
+    quantity (Column, voltage by default for current sourcing) has
+    first covered Fraction of the change from its first value to its
+    steady state value. The default fraction of 1 - 1/e gives the
+    time constant of a first order response. Setpoints with no change
+    return nan.
+    """
+    table, index, position, lengths = _stack(data)
+    mask = _window_mask(table, index, position, lengths, Window, nPoints)
+    nGroups = len(lengths)
+    final, _, _ = _group_mean_std(table[:, Column], index, mask, nGroups)
+    starts = np.cumsum(lengths) - lengths
+    has = lengths > 0
+    first = np.full(nGroups, np.nan)
+    first[has] = table[starts[has], Column]
+    change = (final - first)[index]
+    with np.errstate(invalid='ignore'):
+        reached = ((table[:, Column] - first[index]) * np.sign(change) >=
+                   Fraction * np.abs(change)) & (change != 0)
+    crossing = np.where(reached, table[:, LOCAL_TIME], np.inf)
+    out = np.full(nGroups, np.inf)
+    np.minimum.at(out, index, crossing)
+    out[~np.isfinite(out)] = np.nan
+    return out
+
+
+def integrated_charge(data):
+    """Return the charge passed (in C) during each setpoint.
+
+    The current is integrated over local time with the trapezoid rule.
+    """
+    table, index, _, lengths = _stack(data)
+    current = table[:, CURRENT]
+    dt = np.diff(table[:, LOCAL_TIME])
+    area = 0.5 * (current[1:] + current[:-1]) * dt
+    same = index[1:] == index[:-1]
+    return np.bincount(index[1:][same], weights=area[same],
+                       minlength=len(lengths))
+
+
+def load_sweep(Filenames):
+    """Load a sweep from its files.
+
+    Filenames is either the steady state file of a run or a list of
+    its chrono files. Returns the sweep data (a list of arrays, one
+    per setpoint) and the header of the first chrono file.
+    """
+    if not isinstance(Filenames, (list, tuple)):
+        Filenames = fm.find_chrono_files(Filenames)
+    header = None
+    data = []
+    for filename in Filenames:
+        fileHeader, table = fm.read_data(filename)
+        header = header or fileHeader
+        data.append(table)
+    return data, header
+
+
+def analyze_run(Run, Window=None, nPoints=2, MaxCurrent=None,
+                SourceMode=None):
+    """Compute all of the sweep quantities for one run.
+
+    Run can be the sweep data itself or anything load_sweep accepts.
+    The measured column for the time constants is chosen from
+    SourceMode ('CURR' or 'VOLT'), which is read from the files if
+    not given. Returns a dictionary with the steady_state results plus
+    IV, DifferentialResistance, Resistance, MembranePotential,
+    TimeConstant and Charge.
+    """
+    if (Run and isinstance(Run, (list, tuple)) and
+            isinstance(Run[0], basestring)):
+        Run, header = load_sweep(Run)
+    elif isinstance(Run, basestring):
+        Run, header = load_sweep(Run)
+    else:
+        header = None
+    if SourceMode is None:
+        SourceMode = header['SourceMode'] if header else 'CURR'
+    column = VOLTAGE if SourceMode == 'CURR' else CURRENT
+    results = steady_state(Run, Window, nPoints)
+    order = np.argsort(results['Current'])
+    iv = np.column_stack((results['Current'][order],
+                          results['Voltage'][order]))
+    results['IV'] = iv
+    results['DifferentialResistance'] = differential_resistance(iv)
+    results['Resistance'], results['MembranePotential'] = ohmic_fit(
+        iv, MaxCurrent)
+    results['TimeConstant'] = time_constants(Run, column, Window=Window,
+                                             nPoints=nPoints)
+    results['Charge'] = integrated_charge(Run)
+    return results
+
+
+def analyze_runs(Runs, Processes=None, **kwargs):
+    """Run analyze_run over many runs in a process pool.
+
+    Runs is a list of anything analyze_run accepts (steady state
+    filenames are the cheapest to send to the workers) and kwargs are
+    passed on to analyze_run. Processes defaults to the number of
+    CPUs. Returns the results in the same order as Runs.
+    """
+    pool = multiprocessing.Pool(Processes)
+    try:
+        return pool.map(partial(analyze_run, **kwargs), Runs)
+    finally:
+        pool.close()
+        pool.join()
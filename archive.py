@@ -0,0 +1,193 @@
+"""Quantized archive encoding of chrono data.
+
+A 2400 reading only has the resolution of the range it was measured on
+(1 uV on the 200 mV range, 10 pA on the 1 uA range, ...), yet a text
+file spends some twenty characters on it and an array eight bytes. The
+encoding here stores each voltage and current as a whole number of
+those resolution steps, in int16 where the counts fit and int32 where
+they do not, with the range of each reading as a one byte code. The
+local time is stored as the steps between points (TIME_RESOLUTION) and
+the global time as its offset from the local time, which is the same
+for every point of a setpoint. Decoding is a few vectorized passes, so
+a table comes back as fast as it could be read:
+
+    encoded = encode_table(table, VoltageRange=2., CurrentRange=None)
+    table = decode_table(encoded)
+
+A range of None (auto range) gives each reading the lowest range that
+holds it, a fixed range gives the readings that range (or the lowest
+that holds them, for readings beyond it such as the sourced value).
+Decoded values are within half a resolution step of the originals;
+readings no range holds (overflows and nan) are kept exactly.
+
+write_data writes an archive file with Compression='quantized': the
+header in text (so read_header and read_burst work as usual) and the
+encoded table in a zipped numpy archive. read_data decodes it.
+"""
+
+import numpy as np
+
+# Measure ranges of the 2400 and the resolution of each (5 1/2 digits).
+VOLTAGE_RANGES = np.array([0.2, 2., 20., 200.])
+VOLTAGE_RESOLUTION = np.array([1e-6, 1e-5, 1e-4, 1e-3])
+CURRENT_RANGES = np.array([1e-6, 1e-5, 1e-4, 1e-3, 1e-2, 1e-1, 1.])
+CURRENT_RESOLUTION = np.array([1e-11, 1e-10, 1e-9, 1e-8, 1e-7, 1e-6, 1e-5])
+# Readings go up to 5% over the range.
+OVER_RANGE = 1.05
+# Resolution the times are kept to (s).
+TIME_RESOLUTION = 1e-6
+COLUMNS = (('Voltage', VOLTAGE_RANGES, VOLTAGE_RESOLUTION),
+           ('Current', CURRENT_RANGES, CURRENT_RESOLUTION))
+ARCHIVE_VERSION = 1
+ZIP_MAGIC = b'PK\x03\x04'
+
+
+def _smallest_int(values, Types=(np.int16, np.int32, np.int64)):
+    """Return values as the smallest integer type that holds them."""
+    if not len(values):
+        return values.astype(Types[0])
+    low, high = values.min(), values.max()
+    for dtype in Types:
+        info = np.iinfo(dtype)
+        if info.min <= low and high <= info.max:
+            return values.astype(dtype)
+    raise ValueError('Values too large to encode.')
+
+
+def range_codes(values, Ranges, Range=None):
+    """Index into Ranges of the range of each reading.
+
+    This is the lowest range that holds the reading, but not lower than
+    Range (the fixed range, None for auto range). Readings no range
+    holds get len(Ranges).
+    """
+    with np.errstate(invalid='ignore'):
+        codes = np.searchsorted(Ranges * OVER_RANGE, np.abs(values))
+    codes[~np.isfinite(values)] = len(Ranges)
+    if Range:
+        lowest = min(np.searchsorted(Ranges, Range * (1 - 1e-9)),
+                     len(Ranges) - 1)
+        codes = np.where(codes < lowest, lowest, codes)
+    return codes
+
+
+def _encode_column(encoded, name, values, Ranges, Resolution, Range):
+    codes = range_codes(values, Ranges, Range)
+    outside = codes == len(Ranges)
+    inside = ~outside
+    # Exceptions take the code of another reading, so that they do not
+    # stop a single code standing for every reading.
+    codes[outside] = codes[inside][0] if inside.any() else 0
+    counts = np.zeros(len(values))
+    counts[inside] = np.round(values[inside] / Resolution[codes[inside]])
+    encoded[name] = _smallest_int(counts)
+    # A single code stands for every reading.
+    if len(codes) and (codes == codes[0]).all():
+        codes = codes[:1]
+    encoded[name + 'Range'] = codes.astype(np.uint8)
+    index = np.flatnonzero(outside)
+    encoded[name + 'Exceptions'] = np.column_stack((index,
+                                                    values[index]))
+
+
+def encode_table(Table, VoltageRange=None, CurrentRange=None):
+    """Encode a table of [voltage, current, local, global time] rows.
+
+    VoltageRange and CurrentRange are the fixed measure ranges (the
+    VoltageMeasureRange and CurrentMeasureRange of the KWARGS), None
+    for auto range. Any columns after the four are kept as they are.
+    Returns a dictionary of arrays (see decode_table).
+    """
+    Table = np.asarray(Table, dtype=float)
+    if Table.ndim != 2 or Table.shape[1] < 4:
+        raise ValueError('A table needs voltage, current and time columns.')
+    encoded = {'Version': np.array([ARCHIVE_VERSION]),
+               'Rows': np.array([len(Table)])}
+    for (name, ranges, resolution), Range, values in zip(
+            COLUMNS, (VoltageRange, CurrentRange), Table.T):
+        _encode_column(encoded, name, values, ranges, resolution, Range)
+    local, globalTime = Table[:, 2], Table[:, 3]
+    start = local[0] if len(local) else 0.
+    steps = np.round((local - start) / TIME_RESOLUTION)
+    # Steps from the (rounded) previous time, so errors do not add up.
+    encoded['TimeStart'] = np.array([start])
+    encoded['TimeSteps'] = _smallest_int(np.concatenate((steps[:1],
+                                                         np.diff(steps))))
+    offset = globalTime - local
+    first = offset[0] if len(offset) else 0.
+    residual = np.round((offset - first) / TIME_RESOLUTION)
+    encoded['GlobalOffset'] = np.array([first])
+    # Usually the offset is the same throughout and nothing is kept.
+    encoded['GlobalResidual'] = _smallest_int(
+        residual if residual.any() else residual[:0])
+    encoded['Extra'] = Table[:, 4:]
+    return encoded
+
+
+def _decode_column(encoded, name, Resolution):
+    counts = encoded[name]
+    values = counts * Resolution[encoded[name + 'Range']]
+    exceptions = encoded[name + 'Exceptions']
+    if len(exceptions):
+        values[exceptions[:, 0].astype(int)] = exceptions[:, 1]
+    return values
+
+
+def decode_table(encoded):
+    """Decode a table made by encode_table back into a float array."""
+    rows = int(encoded['Rows'][0])
+    table = np.empty((rows, 4 + encoded['Extra'].shape[1]))
+    for column, (name, _, resolution) in enumerate(COLUMNS):
+        table[:, column] = _decode_column(encoded, name, resolution)
+    local = (encoded['TimeStart'][0] +
+             np.cumsum(encoded['TimeSteps'], dtype=np.int64) *
+             TIME_RESOLUTION)
+    table[:, 2] = local
+    table[:, 3] = local + encoded['GlobalOffset'][0]
+    residual = encoded['GlobalResidual']
+    if len(residual):
+        table[:, 3] += residual * TIME_RESOLUTION
+    table[:, 4:] = encoded['Extra']
+    return table
+
+
+def encoded_size(encoded):
+    """Bytes taken by the arrays of an encoded table."""
+    return sum(value.nbytes for value in encoded.values())
+
+
+def is_archive(filename):
+    """True if filename is an archive file (see write_archive)."""
+    with open(filename, 'rb') as f:
+        return f.read(4) == ZIP_MAGIC
+
+
+def write_archive(filename, Text, Table, VoltageRange=None,
+                  CurrentRange=None):
+    """Write the header Text and the encoded Table to filename.
+
+    Text is the header of the file (with any sections after the data)
+    as write_data writes it. The arrays are zipped with deflate.
+    """
+    encoded = encode_table(Table, VoltageRange, CurrentRange)
+    encoded['Header'] = np.frombuffer(Text.encode('latin-1'), np.uint8)
+    with open(filename, 'wb') as f:
+        np.savez_compressed(f, **encoded)
+    return filename
+
+
+def read_archive_text(filename):
+    """Return the header text of an archive file."""
+    with np.load(filename) as archive:
+        return archive['Header'].tobytes().decode('latin-1')
+
+
+def read_archive(filename):
+    """Return the header text and the decoded table of an archive."""
+    with np.load(filename) as archive:
+        encoded = dict((key, archive[key]) for key in archive.files)
+    if int(encoded['Version'][0]) > ARCHIVE_VERSION:
+        raise ValueError('%s is a newer archive than this version reads.'
+                         % filename)
+    return (encoded.pop('Header').tobytes().decode('latin-1'),
+            decode_table(encoded))
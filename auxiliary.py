@@ -0,0 +1,315 @@
+"""Auxiliary sensors polled during runs.
+
+The conductivity and temperature of the solutions drift during a sweep,
+so rather than typing one value of each into the run arguments, the
+meters can be polled while the run goes. Each sensor is read on its own
+thread by a SensorPoller, so a slow meter never holds up the SMU, and
+the readings are stamped with the host clock the SMU times are on.
+
+    recorder = AuxiliaryRecorder([
+        SCPISensor(rm.get_instrument('GPIB0::5'), 'HighTempIn', 'C'),
+        SerialSensor('COM3', 'HighConductivityIn', 'mS/cm')])
+    SMU.Auxiliary = recorder
+    SMU.slow_chrono(SweepPath, RecordData='Yes')
+
+slow_chrono then polls the sensors for the length of the run and the
+files it writes get a column for each sensor (its readings interpolated
+to the time of every point), the steady state file the mean and
+standard deviation of each sensor over every setpoint, and the solution
+info in the headers the mean of the sensors named after its RunArgs
+keys (HighConductivityIn, LowTempOut, ...). SimulatedSensor stands in
+for a meter when there is none.
+"""
+
+import logging
+import re
+import threading
+import time
+import numpy as np
+from clocksync import host_clock
+
+try:
+    import serial
+except ImportError:
+    serial = None
+
+log = logging.getLogger(__name__)
+
+# Run arguments written in the solution info of the file headers.
+SOLUTION_RUNARGS = ('HighConductivityIn', 'HighConductivityOut',
+                    'HighTempIn', 'HighTempOut', 'LowConductivityIn',
+                    'LowConductivityOut', 'LowTempIn', 'LowTempOut')
+NUMBER_PATTERN = re.compile(r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?')
+
+
+class SCPISensor(object):
+
+    """A meter read with a SCPI query.
+
+    instrument is its VISA instrument, Name the name of the sensor
+    (used for its column) and Unit the unit of its readings. Each
+    reading is the answer to Query times Scale.
+    """
+
+    def __init__(self, instrument, Name, Unit='', Query=':READ?',
+                 Scale=1.):
+        self.instrument = instrument
+        self.Name = Name
+        self.Unit = Unit
+        self.Query = Query
+        self.Scale = Scale
+
+    def read(self):
+        return float(self.instrument.ask(self.Query)) * self.Scale
+
+    def close(self):
+        pass
+
+
+class SerialSensor(object):
+
+    """A meter on a serial port.
+
+    Port is a port name or an open serial.Serial (which needs
+    pyserial). Each reading writes Command and reads a line back, of
+    which the first number (or the first group of Pattern) times Scale
+    is the reading.
+    """
+
+    def __init__(self, Port, Name, Unit='', Command=b'\r', Pattern=None,
+                 Scale=1., BaudRate=9600, Timeout=1.):
+        if isinstance(Port, str):
+            if serial is None:
+                raise ImportError('Serial sensors need pyserial.')
+            Port = serial.Serial(Port, BaudRate, timeout=Timeout)
+        self.port = Port
+        self.Name = Name
+        self.Unit = Unit
+        self.Command = Command
+        self.Pattern = re.compile(Pattern) if Pattern else NUMBER_PATTERN
+        self.Scale = Scale
+
+    def read(self):
+        self.port.write(self.Command)
+        line = self.port.readline().decode('latin-1')
+        match = self.Pattern.search(line)
+        if match is None:
+            raise ValueError('No reading in %r from %s.' % (line, self.Name))
+        return float(match.group(match.lastindex or 0)) * self.Scale
+
+    def close(self):
+        self.port.close()
+
+
+class SimulatedSensor(object):
+
+    """Stand-in for a meter.
+
+    Readings start at Value and drift by Drift per second with noise
+    of standard deviation Noise; each takes ReadTime seconds. Time is
+    kept with clock and waited with sleep; give those of the SMU
+    (SimulatedK2400.clock and sleep) to run with a simulated one.
+    """
+
+    def __init__(self, Name, Unit='', Value=0., Drift=0., Noise=0.,
+                 ReadTime=0.01, Seed=None, clock=host_clock,
+                 sleep=time.sleep):
+        self.Name = Name
+        self.Unit = Unit
+        self.Value = Value
+        self.Drift = Drift
+        self.Noise = Noise
+        self.ReadTime = ReadTime
+        self.random = np.random.RandomState(Seed)
+        self.clock = clock
+        self.sleep = sleep
+        self._start = clock()
+
+    def read(self):
+        self.sleep(self.ReadTime)
+        return (self.Value + self.Drift * (self.clock() - self._start) +
+                self.random.normal(0, self.Noise))
+
+    def close(self):
+        pass
+
+
+class SensorPoller(object):
+
+    """Read a sensor every Interval seconds on a thread of its own.
+
+    The readings are kept with the host time (from clock) halfway
+    through each (see readings). A failed reading is logged and
+    counted in Errors and polling goes on.
+    """
+
+    def __init__(self, Sensor, Interval=1., clock=host_clock):
+        self.Sensor = Sensor
+        self.Interval = Interval
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.clear()
+
+    def clear(self):
+        """Forget the readings."""
+        with self._lock:
+            self._times = []
+            self._values = []
+        self.Errors = 0
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._poll,
+                                        name='Poll ' + self.Sensor.Name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def _poll(self):
+        nextTime = self.clock()
+        while not self._stop.is_set():
+            before = self.clock()
+            try:
+                value = self.Sensor.read()
+            except Exception as e:
+                self.Errors += 1
+                log.warning('Reading %s failed: %s', self.Sensor.Name, e)
+            else:
+                stamp = 0.5 * (before + self.clock())
+                with self._lock:
+                    self._times.append(stamp)
+                    self._values.append(value)
+            nextTime += self.Interval
+            self._stop.wait(max(nextTime - self.clock(), 0))
+
+    def readings(self):
+        """Return arrays of the times and values read so far."""
+        with self._lock:
+            return np.array(self._times), np.array(self._values)
+
+
+class AuxiliaryRecorder(object):
+
+    """Poll a set of sensors during slow_chrono runs.
+
+    Set as SMUExperiments.Auxiliary, the recorder is told about the run
+    like a listener: it starts polling every sensor (each every
+    Interval seconds, on the clock of the SMU) when the run starts and
+    stops when it finishes. The host time the global times of the run
+    count from is taken from the points as they arrive.
+    """
+
+    def __init__(self, Sensors, Interval=1.):
+        self.Sensors = list(Sensors)
+        self.Interval = Interval
+        self.Pollers = []
+        # Host time of global time zero of the run.
+        self.Offset = None
+
+    def attach(self, clock):
+        """Make the pollers of the sensors on clock (the SMU's)."""
+        if (self.Pollers and
+                all(poller.clock is clock for poller in self.Pollers)):
+            return
+        self.stop()
+        self.Pollers = [SensorPoller(sensor, self.Interval, clock)
+                        for sensor in self.Sensors]
+
+    def start(self):
+        for poller in self.Pollers:
+            poller.start()
+
+    def stop(self):
+        for poller in self.Pollers:
+            poller.stop()
+
+    def run_started(self, SweepPath, KWARGS):
+        self.Offset = None
+        for poller in self.Pollers:
+            poller.clear()
+        self.start()
+
+    def points_taken(self, Index, Rows):
+        # Points are told about just after they are taken, so the
+        # smallest difference between the clock and their global time
+        # is the closest to the offset.
+        if self.Pollers and len(Rows):
+            offset = self.Pollers[0].clock() - Rows[-1][3]
+            if self.Offset is None or offset < self.Offset:
+                self.Offset = offset
+
+    def run_finished(self, Data):
+        self.stop()
+
+    def labels(self):
+        return ['%s (%s)' % (sensor.Name, sensor.Unit) if sensor.Unit
+                else sensor.Name for sensor in self.Sensors]
+
+    def extra_columns(self, Data):
+        """Columns of sensor readings for the data of a run.
+
+        Returns a dictionary with the Labels of a column for every
+        sensor and Columns, an array of those columns for each
+        setpoint of Data (a datastore.RunData) with each sensor
+        interpolated to the global time of every point, plus
+        SummaryLabels and Summary, the mean and standard deviation of
+        the readings of each sensor over each setpoint. Values are nan
+        where a sensor has no readings.
+        """
+        readings = []
+        for poller in self.Pollers:
+            times, values = poller.readings()
+            readings.append((times - (self.Offset or 0.), values))
+        columns = []
+        summary = np.full((len(Data), 2 * len(readings)), np.nan)
+        for key, table in enumerate(Data):
+            globalTime = np.asarray(table)[:, 3]
+            column = np.full((len(globalTime), len(readings)), np.nan)
+            for number, (times, values) in enumerate(readings):
+                if not len(times) or not len(globalTime):
+                    continue
+                column[:, number] = np.interp(globalTime, times, values)
+                inside = ((times >= globalTime[0]) &
+                          (times <= globalTime[-1]))
+                if not inside.any():
+                    # A setpoint shorter than the polling interval gets
+                    # the readings at its points.
+                    summary[key, 2 * number] = column[:, number].mean()
+                    summary[key, 2 * number + 1] = 0.
+                else:
+                    summary[key, 2 * number] = values[inside].mean()
+                    summary[key, 2 * number + 1] = values[inside].std()
+            columns.append(column)
+        summaryLabels = []
+        for label in self.labels():
+            summaryLabels.extend([label + ' Mean', label + ' Std'])
+        return {'Labels': self.labels(), 'Columns': columns,
+                'SummaryLabels': summaryLabels, 'Summary': summary}
+
+    def solution_info(self):
+        """Mean over the run of the sensors named after RunArgs keys.
+
+        Returns a dictionary that updates the RunArgs written in the
+        solution info of the file headers.
+        """
+        info = {}
+        for sensor, poller in zip(self.Sensors, self.Pollers):
+            _, values = poller.readings()
+            if sensor.Name in SOLUTION_RUNARGS and len(values):
+                info[sensor.Name] = float('%.4g' % values.mean())
+        return info
+
+    def close(self):
+        self.stop()
+        for sensor in self.Sensors:
+            sensor.close()
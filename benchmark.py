@@ -0,0 +1,275 @@
+"""Benchmarks of the acquisition, storage and analysis hot paths.
+
+This runs the acquisition functions of SMUExperiments against the
+simulated instrument in simulator.py (so no hardware is needed) over
+a grid of NPLC, PointDelay, BufferSize and TriggerCount settings, and
+times the file writing and steady state functions in
+filemanipulation and analysis on generated data. For every case the
+points (or rows) per second and the latency percentiles are written
+to a JSON file so that runs can be compared between versions:
+
+    python benchmark.py -o before.json
+    ... change the code ...
+    python benchmark.py -o after.json --compare before.json
+
+--time-scale sets how fast the simulated instrument runs compared to
+the real one (1 is real time, 0 does not wait at all). The acquisition
+rates are timed on the clock of the simulator, so they are the rates
+the instrument would reach whatever the time scale; the WallTime of
+each case is the real time it took (at a time scale of 0, the
+overhead of the code itself). --quick runs a smaller grid.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import filemanipulation as fm
+import analysis
+from keithley import SMUExperiments
+from simulator import SimulatedK2400
+
+FULL_GRID = {'NPLC': [0.01, 0.1, 1], 'PointDelay': [0, 0.01, 0.1],
+             'BufferSize': [1, 100, 2500], 'TriggerCount': [1, 10, 100],
+             'Rows': [10000, 100000, 1000000], 'Setpoints': [14, 100],
+             'Compression': [None, 'gzip', 'xz', 'quantized']}
+QUICK_GRID = {'NPLC': [0.01, 1], 'PointDelay': [0, 0.1],
+              'BufferSize': [1, 2500], 'TriggerCount': [1, 100],
+              'Rows': [10000, 100000], 'Setpoints': [14],
+              'Compression': [None, 'gzip']}
+
+RUN_ARGS = {'Membrane': 'Benchmark', 'MembraneID': 'B0', 'Salt': 'NaCl',
+            'HighConcentration': 0.5, 'LowConcentration': 0.1,
+            'HighConductivityIn': 0, 'HighTempIn': 25,
+            'HighConductivityOut': 0, 'HighTempOut': 25,
+            'LowConductivityIn': 0, 'LowTempIn': 25,
+            'LowConductivityOut': 0, 'LowTempOut': 25, 'RunNumber': 1,
+            'SourceMode': 'CURR', 'User': 'benchmark', 'CellDesign': '',
+            'Comments': ''}
+
+
+def latency(samples):
+    """Return latency statistics (in ms) of a list of durations (s)."""
+    samples = np.asarray(samples, dtype=float) * 1000
+    if not len(samples):
+        return {}
+    p50, p90, p99 = np.percentile(samples, [50, 90, 99])
+    return {'p50': p50, 'p90': p90, 'p99': p99, 'Mean': samples.mean(),
+            'Max': samples.max(), 'Samples': len(samples)}
+
+
+def make_smu(TimeScale, **kwargs):
+    """Make an SMUExperiments object connected to a simulated 2400."""
+    smu = SMUExperiments(Transport=SimulatedK2400(TimeScale=TimeScale))
+    smu.KWARGS.update(kwargs)
+    return smu
+
+
+def bench_take_points(grid, TimeScale, Repeat):
+    """Time take_points for each NPLC, BufferSize and TriggerCount."""
+    results = []
+    for nplc in grid['NPLC']:
+        for bufferSize in grid['BufferSize']:
+            for count in grid['TriggerCount']:
+                if count > bufferSize:
+                    continue
+                smu = make_smu(TimeScale, NPLC=nplc, BufferSize=bufferSize,
+                               TriggerCount=count)
+                smu.setup_simple_experiment(0.001)
+                durations = []
+                wall = time.time()
+                for _ in range(Repeat):
+                    start = smu.clock()
+                    smu.take_points()
+                    durations.append(smu.clock() - start)
+                results.append({
+                    'Benchmark': 'take_points',
+                    'Parameters': {'NPLC': nplc, 'BufferSize': bufferSize,
+                                   'TriggerCount': count},
+                    'PointsPerSecond': count * Repeat / sum(durations),
+                    'Latency': latency(durations),
+                    'WallTime': time.time() - wall})
+    return results
+
+
+def bench_slow_chrono(grid, TimeScale, ExperimentLength):
+    """Time slow_chrono for each NPLC and PointDelay."""
+    results = []
+    sweep = [0.001, 0.002]
+    for nplc in grid['NPLC']:
+        for delay in grid['PointDelay']:
+            smu = make_smu(TimeScale, NPLC=nplc)
+            wall = time.time()
+            start = smu.clock()
+            data = smu.slow_chrono(sweep, ExperimentLength, delay or 1e-9)
+            elapsed = smu.clock() - start
+            points = sum(len(table) for table in data)
+            # Time between points as seen by the program.
+            spacing = np.concatenate([np.diff(table[:, 3])
+                                      for table in data])
+            results.append({
+                'Benchmark': 'slow_chrono',
+                'Parameters': {'NPLC': nplc, 'PointDelay': delay},
+                'PointsPerSecond': points / elapsed,
+                'Latency': latency(spacing),
+                'WallTime': time.time() - wall})
+    return results
+
+
+def bench_simple_sweep(grid, TimeScale):
+    """Time simple_sweep for each NPLC and TriggerCount."""
+    results = []
+    sweep = list(np.linspace(-0.005, 0.008, 14))
+    for nplc in grid['NPLC']:
+        for count in grid['TriggerCount']:
+            smu = make_smu(TimeScale, NPLC=nplc, TriggerCount=count)
+            wall = time.time()
+            start = smu.clock()
+            smu.simple_sweep(sweep)
+            elapsed = smu.clock() - start
+            results.append({
+                'Benchmark': 'simple_sweep',
+                'Parameters': {'NPLC': nplc, 'TriggerCount': count},
+                'PointsPerSecond': count * len(sweep) / elapsed,
+                'Latency': latency([elapsed / len(sweep)]),
+                'WallTime': time.time() - wall})
+    return results
+
+
+def make_sweep_data(Setpoints, Rows):
+    """Make chrono sweep data with Rows points in total."""
+    perSetpoint = max(Rows // Setpoints, 1)
+    t = np.arange(perSetpoint) * 0.1
+    data = []
+    for key in range(Setpoints):
+        current = 0.001 * (key - Setpoints // 2)
+        voltage = 0.01 + current * 100 * (1.2 - 0.2 * np.exp(-t))
+        data.append(np.column_stack((voltage, np.full_like(t, current), t,
+                                     t + key * t[-1])))
+    return data
+
+
+def bench_record_data_files(grid, Directory):
+    """Time record_data_files for each size and compression."""
+    results = []
+    for rows in grid['Rows']:
+        data = make_sweep_data(14, rows)
+        sweep = [table[0, 1] for table in data]
+        for compression in grid['Compression']:
+            runArgs = dict(RUN_ARGS, DataPath=Directory + os.sep)
+            start = time.time()
+            fm.record_data_files(data, sweep, runArgs,
+                                 Compression=compression)
+            elapsed = time.time() - start
+            size = sum(os.path.getsize(os.path.join(path, name))
+                       for path, _, names in os.walk(Directory)
+                       for name in names)
+            shutil.rmtree(Directory)
+            results.append({
+                'Benchmark': 'record_data_files',
+                'Parameters': {'Rows': rows, 'Compression': compression},
+                'PointsPerSecond': rows / elapsed,
+                'MegabytesPerSecond': size / elapsed / 1e6,
+                'Bytes': size,
+                'Latency': latency([elapsed])})
+    return results
+
+
+def bench_steady_state(grid, Repeat):
+    """Time generate_ss_array and analysis.steady_state at scale."""
+    results = []
+    for setpoints in grid['Setpoints']:
+        for rows in grid['Rows']:
+            data = make_sweep_data(setpoints, rows)
+            for name, function in (
+                    ('generate_ss_array', fm.generate_ss_array),
+                    ('analysis.steady_state', analysis.steady_state)):
+                durations = []
+                for _ in range(Repeat):
+                    start = time.time()
+                    function(data)
+                    durations.append(time.time() - start)
+                results.append({
+                    'Benchmark': name,
+                    'Parameters': {'Setpoints': setpoints, 'Rows': rows},
+                    'PointsPerSecond': rows * Repeat / sum(durations),
+                    'Latency': latency(durations)})
+    return results
+
+
+def run_info(TimeScale):
+    """Describe the code and machine the benchmarks ran on."""
+    try:
+        version = subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+        version = version.decode('ascii')
+    except (OSError, subprocess.CalledProcessError):
+        version = 'unknown'
+    return {'Version': version, 'Date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'Python': platform.python_version(), 'Numpy': np.__version__,
+            'Machine': platform.platform(), 'TimeScale': TimeScale}
+
+
+def compare(results, baseline):
+    """Print the speed of results relative to a baseline run."""
+    def key(result):
+        return (result['Benchmark'],
+                json.dumps(result['Parameters'], sort_keys=True))
+    base = dict((key(result), result) for result in baseline['Results'])
+    print('%-24s %-60s %10s' % ('Benchmark', 'Parameters', 'Speedup'))
+    for result in results['Results']:
+        old = base.get(key(result))
+        if old and old['PointsPerSecond']:
+            print('%-24s %-60s %9.2fx' % (
+                result['Benchmark'], key(result)[1],
+                result['PointsPerSecond'] / old['PointsPerSecond']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-o', '--output', default='benchmark.json',
+                        help='JSON file to write the results to.')
+    parser.add_argument('--compare', help='Results to compare against.')
+    parser.add_argument('--time-scale', type=float, default=1.,
+                        help='Speed of the simulated instrument '
+                        '(1 = real time, 0 = no waiting).')
+    parser.add_argument('--quick', action='store_true',
+                        help='Run a smaller grid.')
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='Repeats of the short benchmarks.')
+    args = parser.parse_args()
+    grid = QUICK_GRID if args.quick else FULL_GRID
+    directory = tempfile.mkdtemp()
+    try:
+        results = {'Info': run_info(args.time_scale), 'Results': []}
+        for name, bench in (
+                ('take_points', lambda: bench_take_points(
+                    grid, args.time_scale, args.repeat)),
+                ('slow_chrono', lambda: bench_slow_chrono(
+                    grid, args.time_scale, 0.5 if args.quick else 2)),
+                ('simple_sweep', lambda: bench_simple_sweep(
+                    grid, args.time_scale)),
+                ('record_data_files', lambda: bench_record_data_files(
+                    grid, os.path.join(directory, 'data'))),
+                ('steady_state', lambda: bench_steady_state(
+                    grid, args.repeat))):
+            sys.stdout.write('Running %s...\n' % name)
+            results['Results'].extend(bench())
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=1, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,294 @@
+"""Catalog of recorded runs.
+
+This module keeps an SQLite index of the steady state and chrono files
+written by record_data_files. Each run is stored once with the
+information from its filename and header (membrane, salt,
+concentrations, user, date, sweep path...) and each of its setpoints is
+stored with the path to its chrono file. The columns used for lookups
+are indexed so that finding, say, every AmB run at 0.5/0.1 M is a
+single indexed query no matter how many years of data are in the
+catalog.
+
+Existing data trees can be added with ingest_tree, which parses the
+file headers in a pool of worker processes.
+"""
+
+import os
+import sqlite3
+import multiprocessing
+import filemanipulation as fm
+import sweeps
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    ss_path TEXT UNIQUE NOT NULL,
+    mtime REAL,
+    stamp TEXT,
+    date TEXT,
+    source_mode TEXT,
+    membrane TEXT,
+    membrane_id TEXT,
+    salt TEXT,
+    high_concentration REAL,
+    low_concentration REAL,
+    run_number TEXT,
+    user TEXT,
+    cell_design TEXT,
+    comments TEXT,
+    sweep_path TEXT,
+    data_path TEXT
+);
+CREATE TABLE IF NOT EXISTS setpoints (
+    run_id INTEGER NOT NULL REFERENCES runs(id) ON DELETE CASCADE,
+    idx INTEGER NOT NULL,
+    setpoint REAL,
+    chrono_path TEXT,
+    PRIMARY KEY (run_id, idx)
+);
+CREATE INDEX IF NOT EXISTS runs_condition ON runs
+    (membrane_id, salt, high_concentration, low_concentration);
+CREATE INDEX IF NOT EXISTS runs_membrane ON runs (membrane);
+CREATE INDEX IF NOT EXISTS runs_user ON runs (user);
+CREATE INDEX IF NOT EXISTS runs_date ON runs (date);
+CREATE INDEX IF NOT EXISTS setpoints_setpoint ON setpoints (setpoint);
+CREATE INDEX IF NOT EXISTS setpoints_chrono ON setpoints (chrono_path);
+"""
+
+# Keyword arguments accepted by find_runs (RunArgs names) and the
+# column of the runs table they are matched against.
+QUERY_COLUMNS = {'SourceMode': 'source_mode', 'Membrane': 'membrane',
+                 'MembraneID': 'membrane_id', 'Salt': 'salt',
+                 'HighConcentration': 'high_concentration',
+                 'LowConcentration': 'low_concentration',
+                 'RunNumber': 'run_number', 'User': 'user',
+                 'CellDesign': 'cell_design', 'Date': 'date'}
+
+RUN_FIELDS = ('ss_path', 'mtime', 'stamp', 'date', 'source_mode',
+              'membrane', 'membrane_id', 'salt', 'high_concentration',
+              'low_concentration', 'run_number', 'user', 'cell_design',
+              'comments', 'sweep_path', 'data_path')
+
+
+def _stamp_to_date(stamp):
+    """Convert a yymmddHHMM filename stamp to an ISO date string."""
+    return '20%s-%s-%s' % (stamp[0:2], stamp[2:4], stamp[4:6])
+
+
+def _run_number(value):
+    """Format a run number the same way make_filenames does."""
+    try:
+        return '%02d' % int(value)
+    except (TypeError, ValueError):
+        return str(value)
+
+
+def _concentration(value):
+    """Store concentrations as numbers where possible."""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return value
+
+
+def _run_record(SSFilename, RunArgs, SweepPath):
+    """Build a runs table record from RunArgs and the SS filename."""
+    info = fm.parse_filename(SSFilename) or {}
+    stamp = info.get('Timestamp', '')
+    try:
+        mtime = os.path.getmtime(SSFilename)
+    except OSError:
+        mtime = None
+    return {'ss_path': SSFilename, 'mtime': mtime, 'stamp': stamp,
+            'date': _stamp_to_date(stamp) if stamp else None,
+            'source_mode': RunArgs.get('SourceMode'),
+            'membrane': RunArgs.get('Membrane'),
+            'membrane_id': str(RunArgs.get('MembraneID')),
+            'salt': RunArgs.get('Salt'),
+            'high_concentration':
+                _concentration(RunArgs.get('HighConcentration')),
+            'low_concentration':
+                _concentration(RunArgs.get('LowConcentration')),
+            'run_number': _run_number(RunArgs.get('RunNumber')),
+            'user': RunArgs.get('User'),
+            'cell_design': RunArgs.get('CellDesign'),
+            'comments': RunArgs.get('Comments'),
+            'sweep_path': ','.join(repr(x) for x in
+                                   sweeps.round_setpoints(SweepPath)),
+            'data_path': (RunArgs.get('DataPath') or
+                          os.path.dirname(SSFilename) + os.sep)}
+
+
+def _scan_ss_file(SSFilename):
+    """Read the header of a steady state file for ingest_tree.
+
+    This runs in the worker processes. Files that can not be read are
+    returned with a None record so a single bad file does not stop
+    the ingest.
+    """
+    try:
+        header = fm.read_header(SSFilename)
+    except (IOError, OSError, ValueError):
+        return SSFilename, None
+    return SSFilename, _run_record(SSFilename, header, header['SweepPath'])
+
+
+class RunCatalog(object):
+
+    """SQLite catalog of recorded runs.
+
+    Open the catalog with the path to the database file (it is created
+    if it does not exist). Runs are added as they are recorded with
+    add_run (record_data_files does this when passed the catalog) or
+    in bulk from existing data with ingest_tree. Use find_runs to
+    query them.
+    """
+
+    def __init__(self, DatabasePath):
+        """Open (and if needed create) the catalog database."""
+        self.DatabasePath = DatabasePath
+        if DatabasePath != ':memory:':
+            fm.ensure_dir(os.path.abspath(DatabasePath))
+        self.db = sqlite3.connect(DatabasePath)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('PRAGMA foreign_keys = ON')
+        self.db.execute('PRAGMA journal_mode = WAL')
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        """Close the database connection."""
+        self.db.close()
+
+    def _insert(self, record, Setpoints):
+        """Insert or replace a run and its setpoints (no commit).
+
+        Setpoints are rounded as sweeps rounds them, so that a setpoint
+        read back from a filename (in mA) matches the one that was run.
+        """
+        self.db.execute('DELETE FROM runs WHERE ss_path = ?',
+                        (record['ss_path'],))
+        cursor = self.db.execute(
+            'INSERT INTO runs (%s) VALUES (%s)' %
+            (','.join(RUN_FIELDS), ','.join('?' * len(RUN_FIELDS))),
+            [record[key] for key in RUN_FIELDS])
+        runID = cursor.lastrowid
+        Setpoints = list(Setpoints)
+        rounded = sweeps.round_setpoints([sp for sp, _ in Setpoints])
+        self.db.executemany(
+            'INSERT INTO setpoints (run_id, idx, setpoint, chrono_path) '
+            'VALUES (?, ?, ?, ?)',
+            [(runID, idx, setPoint, path) for idx, (setPoint, (_, path))
+             in enumerate(zip(rounded, Setpoints))])
+        return runID
+
+    def add_run(self, SSFilename, ChronoFilenames, RunArgs, SweepPath):
+        """Add a recorded run to the catalog.
+
+        The inputs are the same as what record_data_files writes: the
+        steady state filename, the list of chrono filenames (one per
+        setpoint in SweepPath) and the RunArgs of the run. Adding a
+        run that is already in the catalog replaces it.
+        """
+        record = _run_record(SSFilename, RunArgs, SweepPath)
+        with self.db:
+            return self._insert(record, zip(SweepPath, ChronoFilenames))
+
+    def ingest_tree(self, Root, Processes=None):
+        """Add every run found below the directory Root.
+
+        Steady state files are found by their names, their headers
+        are parsed in a pool of Processes worker processes (defaults
+        to the number of CPUs) and the chrono files from the same run
+        are matched to them by name. Runs already in the catalog whose
+        SS file has not been modified are skipped. Returns the number
+        of runs added.
+        """
+        ssFiles = []
+        chronoFiles = {}
+        known = dict(self.db.execute('SELECT ss_path, mtime FROM runs'))
+        for dirPath, _, files in os.walk(Root):
+            for name in files:
+                info = fm.parse_filename(name)
+                if info is None:
+                    continue
+                path = os.path.join(dirPath, name)
+                if info['FileType'] == 'SS':
+                    if known.get(path) != os.path.getmtime(path):
+                        ssFiles.append(path)
+                else:
+                    chronoFiles.setdefault(self._run_key(info), []).append(
+                        (info['ChronoNumber'], info['SetPoint'], path))
+        if not ssFiles:
+            return 0
+        pool = multiprocessing.Pool(Processes)
+        try:
+            results = pool.map(_scan_ss_file, ssFiles,
+                               chunksize=max(1, len(ssFiles) // 64))
+        finally:
+            pool.close()
+            pool.join()
+        added = 0
+        with self.db:
+            for path, record in results:
+                if record is None:
+                    continue
+                info = fm.parse_filename(path)
+                chrono = sorted(chronoFiles.get(self._run_key(info), []))
+                self._insert(record, [(sp, p) for _, sp, p in chrono])
+                added += 1
+        return added
+
+    @staticmethod
+    def _run_key(info):
+        """Key shared by the SS file and chrono files of one run."""
+        return (info['Timestamp'], info['SourceMode'], info['MembraneID'],
+                info['Salt'], info['HighConcentration'],
+                info['LowConcentration'], info['RunNumber'])
+
+    def find_runs(self, After=None, Before=None, SetPoint=None, **kwargs):
+        """Find runs matching the given conditions.
+
+        Conditions are given with the RunArgs names, for example
+        find_runs(MembraneID='AmB', HighConcentration=0.5,
+        LowConcentration=0.1). After and Before limit the run date
+        (inclusive, as 'YYYY-MM-DD') and SetPoint only returns runs
+        that include that setpoint. Returns a list of dictionaries
+        with the run information and a 'Setpoints' list of
+        (setpoint, chrono_path) tuples.
+        """
+        where = []
+        values = []
+        for key, value in kwargs.items():
+            if key not in QUERY_COLUMNS:
+                raise KeyError('Can not search the catalog by %s.' % key)
+            if key in ('HighConcentration', 'LowConcentration'):
+                value = _concentration(value)
+            elif key == 'RunNumber':
+                value = _run_number(value)
+            elif key == 'MembraneID':
+                value = str(value)
+            where.append('%s = ?' % QUERY_COLUMNS[key])
+            values.append(value)
+        if After:
+            where.append('date >= ?')
+            values.append(After)
+        if Before:
+            where.append('date <= ?')
+            values.append(Before)
+        if SetPoint is not None:
+            where.append('id IN (SELECT run_id FROM setpoints '
+                         'WHERE setpoint = ?)')
+            values.append(sweeps.round_setpoints([SetPoint])[0])
+        condition = ' WHERE ' + ' AND '.join(where) if where else ''
+        runs = [dict(row) for row in self.db.execute(
+            'SELECT * FROM runs' + condition + ' ORDER BY stamp', values)]
+        byID = dict((run['id'], run) for run in runs)
+        for run in runs:
+            run['Setpoints'] = []
+        for row in self.db.execute(
+                'SELECT run_id, setpoint, chrono_path FROM setpoints '
+                'WHERE run_id IN (SELECT id FROM runs' + condition + ') '
+                'ORDER BY run_id, idx', values):
+            byID[row['run_id']]['Setpoints'].append(
+                (row['setpoint'], row['chrono_path']))
+        return runs
@@ -0,0 +1,124 @@
+"""Alignment of the SMU timer with the host clock.
+
+The 2400 has a timer of its own (reset at connect by setup_connection,
+and rolling over every TIMER_WRAP seconds) that stamps the readings
+returned by :READ?. Those timestamps are far more precise than reading
+the host clock when the data arrives, but they are on a different
+clock: the timer starts at an unknown host time (offset) and runs
+slightly fast or slow (drift). The timestamps of the trace buffer are
+not on the timer: they count from the first reading in the buffer, so
+they only give the spacing of the readings of a trigger (see
+SourceMeter.trigger_times).
+
+ClockAligner estimates both from sync samples: the SMU timer is
+queried (:SYST:TIME?) between two readings of the host clock, and the
+sample with the shortest round trip of a burst is kept. A straight
+line fit through the kept samples, weighted by how tight they are,
+gives the offset and drift, and to_host maps any SMU timestamp to host
+time. Syncing again now and then (slow_chrono does at every setpoint)
+tracks the drift over long runs.
+"""
+
+from collections import deque
+import logging
+import time
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+# Host clock that timing is done on: monotonic, so that it never steps
+# (time.time where there is no time.monotonic, as on Python 2).
+host_clock = getattr(time, 'monotonic', time.time)
+
+# The 2400 timer rolls over to zero after this many seconds.
+TIMER_WRAP = 100000.
+# Drifts larger than this are not believed (a quartz timer is good to
+# about 1e-4); the fit falls back to the offset only.
+MAX_DRIFT = 1e-3
+# The drift is only fit once the samples span this long (s); over
+# shorter times the round trip jitter swamps it.
+MIN_DRIFT_SPAN = 60.
+
+
+class ClockAligner(object):
+
+    """Map SMU timestamps to host clock times.
+
+    clock is the host clock function (SourceMeter.clock). Window is the
+    number of sync samples the fit is made over. Only the Read strategy
+    of slow_chrono takes its times from the SMU timer (and the block
+    strategies the drift); Trace points and multiplexed_chrono stay
+    timed by the host clock and do not sync.
+    """
+
+    def __init__(self, clock, Window=50, Wrap=TIMER_WRAP):
+        self.clock = clock
+        self.Wrap = Wrap
+        # Kept samples of (unwrapped SMU time, host time, half round
+        # trip).
+        self.samples = deque(maxlen=Window)
+        self.Offset = None  # Host time at SMU time zero
+        self.Drift = 0.     # SMU seconds per host second - 1
+        self.Uncertainty = None
+
+    def _unwrap(self, smuTimes, hostTimes):
+        """Add the rollovers of the timer to smuTimes.
+
+        The number of rollovers is the one that puts each timestamp
+        closest to the SMU time predicted for hostTimes.
+        """
+        smuTimes = np.asarray(smuTimes, dtype=float)
+        if self.Offset is None:
+            return smuTimes
+        predicted = (np.asarray(hostTimes) - self.Offset) * (1 + self.Drift)
+        return smuTimes + self.Wrap * np.round((predicted - smuTimes) /
+                                               self.Wrap)
+
+    def add_sample(self, SMUTime, HostBefore, HostAfter):
+        """Add a sync sample and refit."""
+        host = 0.5 * (HostBefore + HostAfter)
+        smu = float(self._unwrap(SMUTime, host))
+        self.samples.append((smu, host, 0.5 * (HostAfter - HostBefore)))
+        self.fit()
+
+    def synchronize(self, instrument, Samples=5):
+        """Take a burst of sync samples and keep the tightest."""
+        best = None
+        for _ in range(Samples):
+            before = self.clock()
+            smu = float(instrument.ask(':SYST:TIME?'))
+            after = self.clock()
+            if best is None or after - before < best[2] - best[1]:
+                best = (smu, before, after)
+        self.add_sample(*best)
+        return self.Offset, self.Drift
+
+    def fit(self):
+        """Fit the offset and drift to the samples."""
+        smu, host, halfTrip = [np.array(values) for values in
+                               zip(*self.samples)]
+        weights = 1. / np.maximum(halfTrip, 1e-6)
+        drift = 0.
+        if np.ptp(host) >= MIN_DRIFT_SPAN:
+            # host = Offset + smu / (1 + Drift)
+            slope, _ = np.polyfit(smu, host, 1, w=weights)
+            drift = 1. / slope - 1
+            if abs(drift) > MAX_DRIFT:
+                log.warning('Ignoring SMU clock drift of %g.', drift)
+                drift = 0.
+        self.Drift = drift
+        self.Offset = np.average(host - smu / (1 + drift), weights=weights)
+        self.Uncertainty = halfTrip.min()
+
+    def to_host(self, SMUTimes, HostTime=None):
+        """Convert SMU timestamps to host clock times.
+
+        HostTime is a host time close to when the readings were taken
+        (the current time by default), used to undo timer rollovers.
+        """
+        if self.Offset is None:
+            raise ValueError('The clock has not been synchronized.')
+        if HostTime is None:
+            HostTime = self.clock()
+        smu = self._unwrap(SMUTimes, HostTime)
+        return self.Offset + smu / (1 + self.Drift)
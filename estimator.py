@@ -0,0 +1,238 @@
+"""Cost estimates for planned runs.
+
+estimate_run predicts how long a slow_chrono sweep will take, how many
+points it will give and how much memory and disk it will need from
+the KWARGS, sweep path and acquisition strategy of the run. If the
+SourceMeter the run will use is given and its timing has been measured
+(see SourceMeter.calibrate_timing), the time per point comes from that,
+otherwise from default overheads.
+
+RunEstimate refines the estimate while the run goes. Add it to the
+Listeners of an SMUExperiments object and it updates the estimate with
+the measured points and time of each setpoint as setpoints finish.
+Without a timing calibration, the period achieved by the setpoints
+done (from the AcquisitionReport of the SMU) takes the place of the
+default overheads for the setpoints to come.
+"""
+
+import time
+import numpy as np
+import sweeps
+
+# Bytes per row of the data store (float64, see datastore.RunData).
+BYTES_PER_ROW = 4 * 8
+# Bytes per row and header written by write_data ('%.18e' values).
+TEXT_BYTES_PER_ROW = 4 * 24.5 + 4
+HEADER_BYTES = 1000
+# Typical compressed size of the data files relative to plain text.
+COMPRESSION_RATIOS = {None: 1., 'gzip': 0.45, 'xz': 0.4, 'quantized': 0.05}
+# Overheads used when there is no SMU timing (s).
+DEFAULT_POINT_OVERHEAD = 0.01
+SETPOINT_OVERHEAD = 0.01
+# Rows per second written by write_data.
+WRITE_RATE = 2e5
+# Seconds between estimate updates during a setpoint.
+UPDATE_INTERVAL = 1.
+
+
+def point_period(KWARGS, SMU=None, PointDelay=None, Strategy='Trace'):
+    """Return the predicted time between points and the strategy used.
+
+    PointDelay defaults to the one in KWARGS and Strategy is the one
+    given to slow_chrono. The prediction uses the timing of SMU if it
+    has been calibrated (and 'Auto' is taken to be Trace if not).
+    """
+    if PointDelay is None:
+        PointDelay = KWARGS['PointDelay']
+    if SMU is not None and SMU.Timing is not None:
+        if Strategy == 'Auto':
+            Strategy, _ = SMU.choose_strategy(PointDelay, KWARGS['NPLC'])
+        period, _ = SMU.predict_period(Strategy, PointDelay, KWARGS['NPLC'])
+        return period, Strategy
+    if Strategy == 'Auto':
+        Strategy = 'Trace'
+    reading = KWARGS['NPLC'] / 60. + DEFAULT_POINT_OVERHEAD
+    if Strategy == 'Trace':
+        # PointDelay is waited after each point.
+        return PointDelay + reading, Strategy
+    return max(PointDelay, reading), Strategy
+
+
+def _costs(StepPoints, Compression):
+    """Return the points, memory and disk use of a run.
+
+    StepPoints is the number of points of every setpoint.
+    """
+    nSetpoints = len(StepPoints)
+    points = int(np.sum(StepPoints))
+    ratio = COMPRESSION_RATIOS[Compression]
+    chronoSizes = ((HEADER_BYTES + np.asarray(StepPoints) *
+                    TEXT_BYTES_PER_ROW) * ratio).astype(int).tolist()
+    ssSize = int((HEADER_BYTES + nSetpoints * TEXT_BYTES_PER_ROW) * ratio)
+    fileSizes = [ssSize] + chronoSizes
+    return {'PointsPerSetpoint': StepPoints, 'Points': points,
+            'WriteTime': (points + nSetpoints) / WRITE_RATE,
+            'Memory': points * BYTES_PER_ROW,
+            'FileSizes': fileSizes, 'DiskSpace': sum(fileSizes)}
+
+
+def estimate_run(KWARGS, SweepPath, SMU=None, Compression=None,
+                 Strategy='Trace'):
+    """Estimate the cost of a slow_chrono sweep.
+
+    SweepPath and Strategy are anything slow_chrono accepts (a list of
+    setpoints, a sweeps.Sweep or a plan). Returns a dictionary with:
+        WallTime: total time of the run including writing files (s).
+        AcquisitionTime, WriteTime: the parts of the above (s).
+        Period: time between points of every setpoint (s) and the
+            Strategy used.
+        PointsPerSetpoint, Points: number of points.
+        Memory: memory taken by the data while running (bytes).
+        FileSizes: size of the SS file followed by each chrono file.
+        DiskSpace: total size of the files (bytes).
+    """
+    plan = sweeps.make_plan(SweepPath, KWARGS)
+    delays = plan['PointDelay'].tolist()
+    # slow_chrono picks one strategy for the shortest delay.
+    _, strategy = point_period(KWARGS, SMU, min(delays) if delays else None,
+                               Strategy)
+    period = np.array([point_period(KWARGS, SMU, delay, strategy)[0]
+                       for delay in delays])
+    stepPoints = np.maximum(np.ceil(plan['Dwell'] / period),
+                            1).astype(int).tolist()
+    estimate = _costs(stepPoints, Compression)
+    acquisitionTime = float(np.sum(plan['Dwell'] + period +
+                                   SETPOINT_OVERHEAD))
+    estimate.update({'WallTime': acquisitionTime + estimate['WriteTime'],
+                     'AcquisitionTime': acquisitionTime,
+                     'Period': period.tolist(), 'Strategy': strategy})
+    return estimate
+
+
+def _format_time(seconds):
+    """Format a time in seconds as h/min/s."""
+    seconds = int(round(seconds))
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    if hours:
+        return '%d h %02d min' % (hours, minutes)
+    if minutes:
+        return '%d min %02d s' % (minutes, seconds)
+    return '%d s' % seconds
+
+
+def _format_bytes(size):
+    """Format a size in bytes."""
+    for unit in ('B', 'kB', 'MB', 'GB'):
+        if size < 1000:
+            return '%.3g %s' % (size, unit)
+        size /= 1000.
+    return '%.3g TB' % size
+
+
+def describe_estimate(Estimate):
+    """Return a one line description of an estimate."""
+    text = 'Estimated %s, %d points, %s memory, %s on disk' % (
+        _format_time(Estimate['WallTime']), Estimate['Points'],
+        _format_bytes(Estimate['Memory']),
+        _format_bytes(Estimate['DiskSpace']))
+    if 'Remaining' in Estimate:
+        text += ' (%s remaining)' % _format_time(Estimate['Remaining'])
+    return text
+
+
+class RunEstimate(object):
+
+    """Estimate of a run that is refined as the run progresses.
+
+    Add the object to SMUExperiments.Listeners before starting
+    slow_chrono. self.Estimate holds the latest estimate (see
+    estimate_run) with the Remaining time of the run added once it
+    has started. If Callback is given it is called with the estimate
+    every time it is updated. Strategy is the one the run is started
+    with. SMU is the SMUExperiments object that runs it.
+    """
+
+    def __init__(self, KWARGS, SweepPath, SMU=None, Compression=None,
+                 Callback=None, Strategy='Trace'):
+        self.Plan = sweeps.make_plan(SweepPath, KWARGS)
+        self.Compression = Compression
+        self.Callback = Callback
+        self.Estimate = estimate_run(KWARGS, self.Plan, SMU, Compression,
+                                     Strategy)
+        self.Predicted = self.Estimate['PointsPerSetpoint']
+        self.Period = np.array(self.Estimate['Period'])
+        self.SMU = SMU
+        self.StartTime = None
+        # Points kept and taken by each setpoint done (they differ when
+        # the SMU reduces the data) and, without a timing calibration,
+        # how much longer the achieved periods were than predicted.
+        self.StepPoints = []
+        self.Taken = []
+        self.Offsets = []
+        self._lastUpdate = 0
+
+    def _update(self):
+        """Send the estimate to the callback."""
+        self._lastUpdate = time.time()
+        if self.Callback is not None:
+            self.Callback(self.Estimate)
+
+    def run_started(self, SweepPath, KWARGS):
+        self.StartTime = time.time()
+        self.Estimate['Remaining'] = self.Estimate['WallTime']
+        self._update()
+
+    def points_taken(self, Index, Rows):
+        if time.time() - self._lastUpdate > UPDATE_INTERVAL:
+            elapsed = time.time() - self.StartTime
+            self.Estimate['Remaining'] = max(
+                self.Estimate['WallTime'] - elapsed, 0)
+            self._update()
+
+    def setpoint_finished(self, Index, Data):
+        """Re-estimate the run from the setpoints done so far.
+
+        The points taken by the remaining setpoints come from the period
+        achieved so far if the SMU timing was not calibrated, otherwise
+        they are scaled by how the points taken so far compare to their
+        prediction. The points kept are the points taken times the
+        fraction kept so far, and the time of the remaining setpoints
+        is scaled like that of the ones done.
+        """
+        taken = len(Data)
+        reducer = getattr(self.SMU, 'Reduction', None)
+        if reducer is not None:
+            taken = reducer.PointsTaken
+        self.StepPoints.append(len(Data))
+        self.Taken.append(taken)
+        done = len(self.StepPoints)
+        period = self.Period
+        if (self.SMU is not None and self.SMU.Timing is None and
+                done <= len(self.Period)):
+            achieved = self.SMU.AcquisitionReport[-1]['Achieved']
+            if achieved is not None:
+                self.Offsets.append(achieved - self.Period[done - 1])
+        dwell = self.Plan['Dwell']
+        if self.Offsets:
+            period = np.maximum(self.Period + np.mean(self.Offsets), 1e-6)
+            predicted = np.maximum(np.ceil(dwell[done:] / period[done:]), 1)
+        else:
+            pointScale = sum(self.Taken) / float(
+                max(sum(self.Predicted[:done]), 1))
+            predicted = np.array(self.Predicted[done:]) * pointScale
+        kept = sum(self.StepPoints) / float(max(sum(self.Taken), 1))
+        stepPoints = self.StepPoints + [int(np.ceil(points * kept))
+                                        for points in predicted]
+        estimate = _costs(stepPoints, self.Compression)
+        elapsed = time.time() - self.StartTime
+        timeScale = elapsed / max(float(np.sum(dwell[:done])), 1e-9)
+        estimate['AcquisitionTime'] = elapsed + timeScale * float(
+            np.sum(dwell[done:]))
+        estimate['WallTime'] = (estimate['AcquisitionTime'] +
+                                estimate['WriteTime'])
+        estimate['Remaining'] = max(estimate['WallTime'] - elapsed, 0)
+        estimate['Period'] = period.tolist()
+        estimate['Strategy'] = self.Estimate['Strategy']
+        self.Estimate = estimate
+        self._update()
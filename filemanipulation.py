@@ -7,6 +7,60 @@ Created on Tue Jun 17 20:49:57 2014
 import numpy as np
 import time
 import os
+import re
+import json
+import glob
+import io
+import gzip
+import zlib
+try:
+    import lzma
+except ImportError:
+    lzma = None
+import reduction
+import overview
+import archive
+
+# Pattern for the names generated by make_filenames. Groups are the
+# timestamp, source mode, SS or CR block, the setpoint block of a chrono
+# file and the membrane/salt/concentration/run number back end.
+FILENAME_PATTERN = re.compile(
+    r'^(?P<Timestamp>\d{10})(?P<Mode>[iv])_'
+    r'(?:(?P<SS>SS)|CR(?P<ChronoNumber>\d+)_(?P<SetPoint>[^_]+?)(?:mA|V))_'
+    r'(?P<MembraneID>.*)_(?P<Salt>[^_]*)_'
+    r'(?P<HighConcentration>[^_]*?)p(?P<LowConcentration>[^_p]*)_'
+    r'(?P<RunNumber>[^_]*)\.csv(?:\.gz|\.xz|\.qz)?$')
+
+# Header labels written by write_data and the RunArgs keys they hold.
+HEADER_KEYS = {'Date': 'Date', 'Time': 'Time', 'Data Type': 'DataType',
+               'Source Mode': 'SourceMode', 'Sweep Path': 'SweepPath',
+               'User': 'User', 'Membrane Name': 'Membrane',
+               'Membrane ID': 'MembraneID', 'Salt': 'Salt',
+               'Run Number': 'RunNumber', 'Cell Design': 'CellDesign',
+               'Comments': 'Comments'}
+SOLUTION_KEYS = {'Inlet High': ('HighConcentration', 'HighConductivityIn',
+                                'HighTempIn'),
+                 'Outlet High': ('HighConcentration', 'HighConductivityOut',
+                                 'HighTempOut'),
+                 'Inlet Low': ('LowConcentration', 'LowConductivityIn',
+                               'LowTempIn'),
+                 'Outlet Low': ('LowConcentration', 'LowConductivityOut',
+                                'LowTempOut')}
+# Labels of the Reduction header line and the keys they hold.
+REDUCTION_KEYS = {'Voltage Band (V)': 'VoltageBand',
+                  'Current Band (A)': 'CurrentBand',
+                  'Max Gap (s)': 'MaxGap', 'Points Taken': 'PointsTaken',
+                  'Points Kept': 'PointsKept',
+                  'Compression Ratio': 'CompressionRatio'}
+COLUMN_LINE = 'SMU Voltage (V)'
+# Line that starts a section after the data (an interruption burst).
+SECTION_LINE = '~,~,~,~'
+DATA_COLUMNS = ('SMU Voltage (V),SMU Current(A),Local Time (s),'
+                'Global Time (s)')
+# Suffixes added to data files written with compression.
+COMPRESSION_SUFFIXES = {'gzip': '.gz', 'xz': '.xz', 'quantized': '.qz'}
+# Suffix of the binary sidecar that read_data caches parsed files in.
+CACHE_SUFFIX = '.cache.npz'
 
 
 def make_filenames(SweepList, RunArgs):
@@ -59,6 +113,251 @@ def make_filenames(SweepList, RunArgs):
     return ListOut
 
 
+def parse_filename(filename):
+    """Parse a filename made by make_filenames.
+
+    This is the inverse of make_filenames. It returns a dictionary with
+    the Timestamp (yymmddHHMM string), SourceMode, FileType ('SS' or
+    'CR'), MembraneID, Salt, HighConcentration, LowConcentration and
+    RunNumber. Chrono files also get their ChronoNumber and SetPoint
+    (converted back to A or V). Returns None if the name does not
+    follow the naming scheme.
+    """
+    # Directories may have been written with Windows separators.
+    baseFilename = re.split(r'[\\/]', filename)[-1]
+    match = FILENAME_PATTERN.match(baseFilename)
+    if not match:
+        return None
+    info = match.groupdict()
+    if info.pop('Mode') == 'i':
+        info['SourceMode'] = 'CURR'
+        unitX = 1000.
+    else:
+        info['SourceMode'] = 'VOLT'
+        unitX = 1.
+    if info.pop('SS'):
+        info['FileType'] = 'SS'
+        del info['ChronoNumber'], info['SetPoint']
+    else:
+        info['FileType'] = 'CR'
+        info['ChronoNumber'] = int(info['ChronoNumber'])
+        info['SetPoint'] = float(info['SetPoint']) / unitX
+    for key in ('HighConcentration', 'LowConcentration'):
+        info[key] = to_number(info[key])
+    return info
+
+
+def find_chrono_files(SSFilename):
+    """Return the chrono files of the run of a steady state file.
+
+    The files are found with the naming from make_filenames and are
+    returned in sweep order.
+    """
+    info = parse_filename(SSFilename)
+    if info is None or info['FileType'] != 'SS':
+        raise ValueError('%s is not a steady state file.' % SSFilename)
+    base = SSFilename[:SSFilename.rindex('.csv')]
+    split = len(base) - len(re.split(r'[\\/]', base)[-1]) + 12
+    crDir = base[:split] + 'CR' + base[split + 2:] + '\\'
+    # The chrono "directory" uses Windows separators; on other systems
+    # it may have been written as a plain directory or a name prefix.
+    files = glob.glob(crDir + '*.csv*') + glob.glob(
+        crDir[:-1] + '/*.csv*')
+    files = [f for f in files if (parse_filename(f) or {}).get(
+        'FileType') == 'CR']
+    return sorted(set(files),
+                  key=lambda f: parse_filename(f)['ChronoNumber'])
+
+
+def to_number(string):
+    """Return string as a float if possible, otherwise unchanged."""
+    try:
+        return float(string)
+    except ValueError:
+        return string
+
+
+def _parse_header_lines(lines):
+    """Parse the header lines written by write_data.
+
+    Returns a dictionary keyed like RunArgs along with the number of
+    lines the header (including the column name line) takes up.
+    """
+    header = {'Filename': lines[0].strip()}
+    for lineNo, line in enumerate(lines[1:], 1):
+        line = line.rstrip('\r\n')
+        if line.startswith(COLUMN_LINE):
+            header['Columns'] = line.split(',')
+            return header, lineNo + 1
+        key, _, value = line.partition(',')
+        if key in HEADER_KEYS:
+            header[HEADER_KEYS[key]] = value
+        elif key.startswith('Setpoint'):
+            header['SetPoint'] = to_number(value)
+        elif key in SOLUTION_KEYS:
+            for name, item in zip(SOLUTION_KEYS[key], value.split(',')):
+                header[name] = to_number(item)
+        elif key == 'Reduction':
+            items = value.split(',')
+            described = {'Method': items[0]}
+            for label, item in zip(items[1::2], items[2::2]):
+                described[REDUCTION_KEYS.get(label, label)] = \
+                    to_number(item)
+            header['Reduction'] = described
+    raise ValueError('No column header found in %s.' % header['Filename'])
+
+
+def _clean_header(header):
+    """Convert header strings into the values used in RunArgs."""
+    if header.get('SourceMode') == 'Current':
+        header['SourceMode'] = 'CURR'
+    elif header.get('SourceMode') == 'Voltage':
+        header['SourceMode'] = 'VOLT'
+    sweep = header.get('SweepPath', '').strip()
+    header['SweepPath'] = ([float(x) for x in sweep.split(',')]
+                           if sweep else [])
+    return header
+
+
+def open_data_file(filename):
+    """Open a data file for reading as text.
+
+    Files written with gzip or xz compression (see BlockWriter) are
+    recognized by their contents and decompressed as they are read,
+    so compressed and plain files can be read the same way. Of a
+    quantized archive (see archive.py) only the header is text.
+    """
+    with open(filename, 'rb') as f:
+        magic = f.read(6)
+    if magic.startswith(archive.ZIP_MAGIC):
+        return io.StringIO(archive.read_archive_text(filename))
+    if magic.startswith(b'\x1f\x8b'):
+        raw = gzip.open(filename, 'rb')
+    elif magic == b'\xfd7zXZ\x00':
+        if lzma is None:
+            raise IOError('Reading %s needs the lzma module.' % filename)
+        raw = lzma.open(filename, 'rb')
+    else:
+        return io.open(filename, 'r', encoding='latin-1')
+    return io.TextIOWrapper(raw, encoding='latin-1')
+
+
+def read_header(filename):
+    """Read the header of a file written by write_data.
+
+    The header is returned as a dictionary using the same keys as
+    RunArgs (Membrane, MembraneID, Salt, HighConcentration,
+    HighConductivityIn, ...) plus the Date, Time, DataType, SetPoint,
+    SweepPath and Columns found in the file.
+    """
+    lines = []
+    with open_data_file(filename) as f:
+        for line in f:
+            lines.append(line)
+            if line.startswith(COLUMN_LINE):
+                break
+    header, _ = _parse_header_lines(lines)
+    return _clean_header(header)
+
+
+def cache_key(filename):
+    """Return the (size, mtime) key a sidecar cache is valid for."""
+    stat = os.stat(filename)
+    return np.array([stat.st_size, stat.st_mtime], dtype=np.float64)
+
+
+def _read_cache(filename, key):
+    """Return (header, data) from the sidecar of filename if valid."""
+    try:
+        with np.load(filename + CACHE_SUFFIX) as cached:
+            if np.array_equal(cached['key'], key):
+                return json.loads(str(cached['header'])), cached['data']
+    except Exception:
+        # A missing, stale or half written cache just means re-parsing.
+        pass
+    return None
+
+
+def _write_cache(filename, key, header, data):
+    """Write the sidecar cache of a parsed file (if possible)."""
+    try:
+        with open(filename + CACHE_SUFFIX, 'wb') as f:
+            np.savez(f, key=key, header=np.array(json.dumps(header)),
+                     data=data)
+    except (IOError, OSError):
+        pass
+
+
+def parse_rows(body, nColumns):
+    """Parse the comma separated rows of body into an array.
+
+    Raises ValueError unless every row has nColumns numbers.
+    """
+    if not body:
+        return np.zeros((0, nColumns))
+    # Parsing the body as one flat list of numbers is far faster than
+    # going line by line, but stops quietly at anything that is not a
+    # number, so the count is checked.
+    rows = body.count('\n') + 1
+    data = np.fromstring(body.replace('\n', ','), sep=',')
+    if data.size != rows * nColumns:
+        raise ValueError('Read %d values from %d rows of %d columns; the '
+                         'data is damaged.' % (data.size, rows, nColumns))
+    return data.reshape(rows, nColumns)
+
+
+def _parse_text(text):
+    """Parse the full text of a file written by write_data."""
+    start = text.find('\n' + COLUMN_LINE)
+    if start < 0:
+        raise ValueError('No column header found in %s.' %
+                         text[:text.find('\n')])
+    end = text.find('\n', start + 1)
+    if end < 0:
+        end = len(text)
+    header, _ = _parse_header_lines(text[:end].split('\n'))
+    header = _clean_header(header)
+    nColumns = len(header['Columns'])
+    section = text.find('\n' + SECTION_LINE, end)
+    body = text[end + 1:section if section >= 0 else len(text)].strip()
+    return header, parse_rows(body, nColumns)
+
+
+def read_data(filename, Cache=True):
+    """Read a steady state or chrono file written by write_data.
+
+    Returns a tuple of the header (a dictionary in the format returned
+    by read_header) and the data as a 2D numpy array with the columns
+    given in header['Columns'].
+
+    The parsed result is cached in a binary sidecar file next to the
+    data file (filename + CACHE_SUFFIX) that is only used while the
+    size and modification time of the data file are unchanged, so
+    reading a file a second time does not need to parse any text.
+    Pass Cache=False to always parse the text file. Quantized archives
+    (see archive.py) are decoded and never cached. A file whose rows do
+    not all parse raises ValueError (and is not cached).
+    """
+    if archive.is_archive(filename):
+        text, data = archive.read_archive(filename)
+        header, _ = _parse_text(text)
+        return header, data
+    key = cache_key(filename)
+    if Cache:
+        cached = _read_cache(filename, key)
+        if cached is not None:
+            return cached
+    with open_data_file(filename) as f:
+        text = f.read()
+    try:
+        header, data = _parse_text(text)
+    except ValueError as e:
+        raise ValueError('%s: %s' % (filename, e))
+    if Cache:
+        _write_cache(filename, key, header, data)
+    return header, data
+
+
 def ensure_dir(Input, isfile='Yes'):
     """Check if file directory exists. If not, create directory.
 
@@ -75,7 +374,154 @@ def ensure_dir(Input, isfile='Yes'):
         os.makedirs(d)
 
 
-def write_data(filename, data, RunArgs, SetPoint='NA', SweepPath=[]):
+def _gzip_block(block, level):
+    """Compress a block into a complete gzip member."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush()
+
+
+def _xz_block(block, level):
+    """Compress a block into a complete xz stream."""
+    return lzma.compress(block, preset=level)
+
+
+COMPRESSORS = {'gzip': (_gzip_block, 6), 'xz': (_xz_block, 3)}
+
+
+class BlockWriter(object):
+
+    """Write a data file in blocks, optionally compressed.
+
+    Text written to the object is collected into blocks of BlockSize
+    bytes. With Compression set to 'gzip' or 'xz' each block is
+    compressed on its own as it is written, so only one block of text
+    is held in memory whatever the size of the file.
+
+    Every block is a complete gzip member or xz stream and the file is
+    a concatenation of them, which the standard gzip and lzma readers
+    (and open_data_file) read as one file. The compression suffix is
+    added to filename; the name of the file written is in
+    self.filename.
+    """
+
+    def __init__(self, filename, Compression=None, BlockSize=1 << 20,
+                 Level=None):
+        """Open the file."""
+        if Compression is not None and Compression not in COMPRESSORS:
+            raise ValueError("Compression must be None, 'gzip' or 'xz'.")
+        if Compression == 'xz' and lzma is None:
+            raise ValueError('xz compression needs the lzma module.')
+        self.Compression = Compression
+        self.BlockSize = BlockSize
+        if Compression:
+            self._compress, defaultLevel = COMPRESSORS[Compression]
+            self.Level = defaultLevel if Level is None else Level
+            filename += COMPRESSION_SUFFIXES[Compression]
+        self.filename = filename
+        ensure_dir(filename)
+        self._file = open(filename, 'wb')
+        self._buffer = []
+        self._buffered = 0
+
+    def write(self, text):
+        """Add text (or bytes) to the file."""
+        if not isinstance(text, bytes):
+            text = text.encode('latin-1')
+        self._buffer.append(text)
+        self._buffered += len(text)
+        if self._buffered >= self.BlockSize:
+            self.flush()
+
+    def flush(self):
+        """Write the text collected so far as a block."""
+        if not self._buffered:
+            return
+        block = b''.join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+        if self.Compression:
+            block = self._compress(block, self.Level)
+        self._file.write(block)
+
+    def close(self):
+        """Write everything that is left and close the file."""
+        try:
+            self.flush()
+        finally:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _reduction_line(Reduction):
+    """Header line describing the reduction of the data (if any)."""
+    if not Reduction:
+        return ''
+    ratio = Reduction['PointsTaken'] / float(max(Reduction['PointsKept'], 1))
+    return ('Reduction,%s,Voltage Band (V),%s,Current Band (A),%s,'
+            'Max Gap (s),%s,Points Taken,%d,Points Kept,%d,'
+            'Compression Ratio,%.4g\n' % (
+                Reduction['Method'], Reduction['VoltageBand'],
+                Reduction['CurrentBand'],
+                'NA' if Reduction['MaxGap'] is None else Reduction['MaxGap'],
+                Reduction['PointsTaken'], Reduction['PointsKept'], ratio))
+
+
+def _burst_section(Burst):
+    """Section of a chrono file holding an interruption burst."""
+    if not Burst:
+        return ''
+    out = io.BytesIO()
+    np.savetxt(out, Burst['Data'], delimiter=',')
+    return ('%s\nBurst,Level,%s,Readings Before,%d,Readings After,%d\n%s\n'
+            % (SECTION_LINE, Burst['Level'], Burst['Before'],
+               Burst['After'], DATA_COLUMNS) +
+            out.getvalue().decode('latin-1'))
+
+
+def read_burst(filename):
+    """Read the interruption burst section of a chrono file.
+
+    Returns a dictionary of the Level, the readings Before and After the
+    step and the Data of the burst, or None if the file has none.
+    """
+    with open_data_file(filename) as f:
+        text = f.read()
+    start = text.find('\n' + SECTION_LINE + '\nBurst,')
+    if start < 0:
+        return None
+    lines = text[start + 1:].split('\n', 3)
+    values = lines[1].split(',')
+    body = lines[3].strip() if len(lines) > 3 else ''
+    try:
+        data = parse_rows(body, 4)
+    except ValueError as e:
+        raise ValueError('%s: burst: %s' % (filename, e))
+    return {'Level': float(values[2]), 'Before': int(values[4]),
+            'After': int(values[6]), 'Data': data}
+
+
+def write_data(filename, data, RunArgs, SetPoint='NA', SweepPath=[],
+               Compression=None, Reduction=None, Columns=(), Burst=None,
+               Ranges=(None, None)):
+    """Write a steady state or chrono file.
+
+    The data is written with a header made from RunArgs. Compression
+    can be 'gzip' or 'xz' to write a compressed file (see BlockWriter)
+    or 'quantized' to write a quantized archive (see archive.py) with
+    the voltage and current measure Ranges (None for auto range), in
+    which case the suffix is added to filename. Reduction is the
+    describe() of the reduction filter the data went through (see
+    reduction.py), which is written to the header along with the
+    compression ratio. Columns are the labels of any columns of data
+    after the usual four. Burst is an interruption burst (see
+    SMUExperiments.slow_chrono), written in a section after the data
+    (see read_burst). Returns the name of the file written.
+    """
     # Generate file header.
     if RunArgs['SourceMode'] == 'CURR':
         SourceMode = 'Current'
@@ -105,6 +551,7 @@ def write_data(filename, data, RunArgs, SetPoint='NA', SweepPath=[]):
         'Source Mode,%s\n' % (SourceMode) +
         'Setpoint (%s),%s\n' % (SourceUnit, str(SetPoint)) +
         'Sweep Path,%s\n' % (str(SweepPath)[1:-1]) +
+        _reduction_line(Reduction) +
         '~,~,\nGeneral Info\n' +
         'User,%s\n' % (RunArgs['User']) +
         'Membrane Name,%s\n' % str(RunArgs['Membrane']) +
@@ -127,17 +574,25 @@ def write_data(filename, data, RunArgs, SetPoint='NA', SweepPath=[]):
                                       str(RunArgs['LowConductivityOut']),
                                       str(RunArgs['LowTempOut'])) +
         '~,~,~,~\nComments,%s\n~,~,~,~\n' % str(RunArgs['Comments']) +
-        'SMU Voltage (V),SMU Current(A),Local Time (s),Global Time (s)')
+        DATA_COLUMNS + ''.join(',' + label for label in Columns))
     # Write file
-    ensure_dir(filename)
-    np.savetxt(filename, data, delimiter=',', header=header, comments='')
+    if Compression == 'quantized':
+        filename += COMPRESSION_SUFFIXES[Compression]
+        ensure_dir(filename)
+        return archive.write_archive(filename, header + '\n' +
+                                     _burst_section(Burst), data, *Ranges)
+    with BlockWriter(filename, Compression) as f:
+        np.savetxt(f, data, delimiter=',', header=header, comments='')
+        f.write(_burst_section(Burst))
+    return f.filename
 
 
 def generate_ss_array(data, nPoints=1):
     """Generate SS array from output of the chrono sweep.
 
-    Inputs the list of numpy arrays from the chrono sweep and extracts
-    the final values to generate the steady state chart.
+    Inputs the output of the chrono sweep (a datastore.RunData or a
+    list of numpy arrays) and extracts the final values to generate
+    the steady state chart.
     """
     nPoints = nPoints * -1
     nPoints = len(data)
@@ -150,13 +605,54 @@ def generate_ss_array(data, nPoints=1):
     return ssArray
 
 
-def record_data_files(Data, SweepPath, RunArgs):
-    """Record data."""
+def record_data_files(Data, SweepPath, RunArgs, Catalog=None,
+                      Compression=None, Overview=True, Extra=None,
+                      Ranges=(None, None)):
+    """Record data.
+
+    Data is the output of the chrono sweep, a datastore.RunData or a
+    list of numpy arrays, one for each setpoint. If the data was
+    reduced (see reduction.py) the reduction of each setpoint is
+    recorded in the headers. If a Catalog (see catalog.RunCatalog) is
+    given, the files that were written are added to it once they are
+    on disk. Compression ('gzip', 'xz' or 'quantized', with the
+    voltage and current measure Ranges) writes all of the files
+    compressed. With Overview, the overviews of long chrono files (see
+    overview.py) are written next to them. Extra holds columns to add
+    to the files (see auxiliary.AuxiliaryRecorder.extra_columns): the
+    Labels and Columns for each chrono file and the SummaryLabels and
+    Summary rows for the steady state file. The interruption bursts of
+    the setpoints (the Bursts of a RunData) are written in the chrono
+    files.
+    """
     filenames = make_filenames(SweepPath, RunArgs)
+    reductions = getattr(Data, 'Reduction', None) or [None] * len(Data)
+    bursts = getattr(Data, 'Bursts', None) or []
     # Write SS File.
     SSArray = generate_ss_array(Data)
-    write_data(filenames[0], SSArray, RunArgs, SweepPath=SweepPath)
+    labels = []
+    if Extra is not None:
+        SSArray = np.column_stack((SSArray, Extra['Summary']))
+        labels = Extra['SummaryLabels']
+    SSFilename = write_data(filenames[0], SSArray, RunArgs,
+                            SweepPath=SweepPath, Compression=Compression,
+                            Reduction=reduction.combine(reductions),
+                            Columns=labels, Ranges=Ranges)
     # Write Chrono Files
+    chronoFilenames = []
     for key, fn in enumerate(filenames[1]):
-        write_data(fn, Data[key], RunArgs, SetPoint=SweepPath[key],
-                   SweepPath=SweepPath)
+        table = Data[key]
+        labels = []
+        if Extra is not None:
+            table = np.column_stack((table, Extra['Columns'][key]))
+            labels = Extra['Labels']
+        chronoFilenames.append(write_data(
+            fn, table, RunArgs, SetPoint=SweepPath[key],
+            SweepPath=SweepPath, Compression=Compression,
+            Reduction=reductions[key], Columns=labels,
+            Burst=bursts[key] if key < len(bursts) else None,
+            Ranges=Ranges))
+        if Overview and len(Data[key]) >= overview.MIN_ROWS:
+            overview.write_overview(chronoFilenames[-1], Data[key])
+    if Catalog is not None:
+        Catalog.add_run(SSFilename, chronoFilenames, RunArgs, SweepPath)
@@ -0,0 +1,258 @@
+"""Crash-safe journal of slow_chrono runs.
+
+Nothing of a run reaches the data files until record_data_files at the
+end, so a crash of Python, the PC or the VISA driver used to lose the
+whole run. With SMUExperiments.Journal set to a filename, slow_chrono
+keeps an append-only journal of the run as it goes: the plan and
+arguments of the run, the start and end of every setpoint and the
+points themselves.
+
+The journal is a sequence of records, each a header (kind, length and
+CRC32 of the payload) followed by the payload. Points are kept in
+memory and written as one binary record per batch, when FlushPoints
+points are waiting or FlushInterval seconds have gone by, and at the
+end of every setpoint, so the cost of the journal per point is bounded
+by one fsync per batch. A crash loses at most the last batch; a torn
+record at the end of the file is detected by its length or CRC and
+ignored.
+
+After a crash,
+
+    SMU.resume_chrono(filename)
+
+runs the rest of the sweep from the setpoint that was interrupted (the
+points it had taken are dropped, the setpoint is run again from its
+start), and
+
+    finalize_journal(filename)
+
+writes the data files from whatever the journal holds, including the
+points of the interrupted setpoint.
+"""
+
+import json
+import os
+import struct
+import time
+import zlib
+import numpy as np
+import filemanipulation as fm
+import sweeps
+from datastore import RunData
+
+# Record header: kind, payload length, CRC32 of the payload.
+RECORD_HEADER = struct.Struct('<cII')
+POINTS_INDEX = struct.Struct('<I')
+RUN = b'R'         # Plan, KWARGS, RunArgs and strategy of the run
+RESUME = b'U'      # The run was resumed at a setpoint
+SETPOINT = b'S'    # A setpoint was started
+POINTS = b'P'      # Points of a setpoint
+FINISHED = b'F'    # A setpoint was finished
+END = b'E'         # The run was finished
+FLUSH_POINTS = 1024
+FLUSH_INTERVAL = 1.
+
+
+class RunJournal(object):
+
+    """Append-only journal of a slow_chrono run.
+
+    slow_chrono adds the journal to its Listeners for the
+    setpoint_started, points_taken and run_finished events and calls
+    start_run and finish_setpoint itself with what the events do not
+    carry. With Resume, an existing journal is appended to after any
+    torn record at its end is cut off.
+    """
+
+    def __init__(self, Filename, FlushPoints=FLUSH_POINTS,
+                 FlushInterval=FLUSH_INTERVAL, Sync=True, Resume=False):
+        self.Filename = Filename
+        self.FlushPoints = int(FlushPoints)
+        self.FlushInterval = FlushInterval
+        self.Sync = Sync
+        fm.ensure_dir(Filename)
+        if Resume:
+            size = read_journal(Filename)['Size']
+            self._file = open(Filename, 'r+b')
+            self._file.truncate(size)
+            self._file.seek(size)
+        else:
+            self._file = open(Filename, 'wb')
+        self._pending = []   # (index, rows) waiting to be written
+        self._pendingPoints = 0
+        self._lastFlush = time.time()
+
+    def _write(self, kind, payload):
+        self._file.write(RECORD_HEADER.pack(
+            kind, len(payload), zlib.crc32(payload) & 0xffffffff))
+        self._file.write(payload)
+
+    def _write_json(self, kind, values):
+        self._write(kind, json.dumps(values, default=float).encode('utf-8'))
+
+    def flush(self):
+        """Write the waiting points and sync the journal to disk."""
+        # Rows of the same setpoint go out as one record.
+        while self._pending:
+            index = self._pending[0][0]
+            rows = []
+            while self._pending and self._pending[0][0] == index:
+                rows.append(self._pending.pop(0)[1])
+            self._write(POINTS, POINTS_INDEX.pack(index) +
+                        np.concatenate(rows).astype('<f8').tobytes())
+        self._pendingPoints = 0
+        self._file.flush()
+        if self.Sync:
+            os.fsync(self._file.fileno())
+        self._lastFlush = time.time()
+
+    def start_run(self, Plan, KWARGS, RunArgs, Strategy, ResumeIndex=None,
+                  Sweep=None):
+        """Record the start of a run (or its resumption at ResumeIndex).
+
+        Sweep is the to_dict() of an adaptive sweep, whose Plan only
+        holds its initial setpoints.
+        """
+        if ResumeIndex is not None:
+            self._write_json(RESUME, {'Index': ResumeIndex,
+                                      'Wall': time.time()})
+        else:
+            self._write_json(RUN, {
+                'Plan': [list(step) for step in Plan.tolist()],
+                'KWARGS': KWARGS, 'RunArgs': RunArgs,
+                'Strategy': Strategy, 'Sweep': Sweep,
+                'Wall': time.time()})
+        self.flush()
+
+    def setpoint_started(self, Index, SetPoint):
+        self._write_json(SETPOINT, {'Index': Index, 'SetPoint': SetPoint})
+        self.flush()
+
+    def points_taken(self, Index, Rows):
+        self._pending.append((Index, np.array(Rows, dtype=float)))
+        self._pendingPoints += len(Rows)
+        if (self._pendingPoints >= self.FlushPoints or
+                time.time() - self._lastFlush >= self.FlushInterval):
+            self.flush()
+
+    def finish_setpoint(self, Index, Report=None, Reduction=None):
+        """Record the end of a setpoint.
+
+        Report is its entry of the AcquisitionReport and Reduction the
+        describe() of its reduction filter (if any).
+        """
+        self.flush()
+        self._write_json(FINISHED, {'Index': Index, 'Report': Report,
+                                    'Reduction': Reduction})
+        self.flush()
+
+    def run_finished(self, Data):
+        self._write_json(END, {'Wall': time.time()})
+        self.flush()
+
+    def close(self):
+        if not self._file.closed:
+            self.flush()
+            self._file.close()
+
+
+def _records(Filename):
+    """Yield the (kind, payload, end offset) of the valid records."""
+    with open(Filename, 'rb') as f:
+        data = f.read()
+    offset = 0
+    while offset + RECORD_HEADER.size <= len(data):
+        kind, length, crc = RECORD_HEADER.unpack_from(data, offset)
+        start = offset + RECORD_HEADER.size
+        payload = data[start:start + length]
+        if (len(payload) < length or
+                zlib.crc32(payload) & 0xffffffff != crc):
+            break
+        offset = start + length
+        yield kind, payload, offset
+
+
+def read_journal(Filename):
+    """Read a journal back.
+
+    Returns a dictionary with the Plan, KWARGS, RunArgs, Strategy and
+    Sweep (of an adaptive sweep) of the run, Wall (time.time() at its
+    start), Data (a RunData of every setpoint that was started, with
+    the points that reached the journal), Finished (the number of
+    setpoints that were finished), Report (the acquisition report of
+    the finished setpoints), Complete (True if the run finished) and
+    Size (bytes of valid records).
+    """
+    state = {'Plan': None, 'KWARGS': None, 'RunArgs': None,
+             'Strategy': None, 'Sweep': None, 'Wall': None, 'Finished': 0,
+             'Report': [], 'Reduction': [], 'Complete': False, 'Size': 0}
+    setPoints = []
+    tables = []
+    for kind, payload, offset in _records(Filename):
+        state['Size'] = offset
+        if kind == POINTS:
+            index, = POINTS_INDEX.unpack_from(payload)
+            if index < len(tables):
+                tables[index].append(np.frombuffer(
+                    payload[POINTS_INDEX.size:], '<f8').reshape(-1, 4))
+            continue
+        values = json.loads(payload.decode('utf-8'))
+        if kind == RUN:
+            plan = np.zeros(len(values['Plan']), dtype=sweeps.PLAN_DTYPE)
+            plan[:] = [tuple(step) for step in values['Plan']]
+            state.update(Plan=plan, KWARGS=values['KWARGS'],
+                         RunArgs=values['RunArgs'],
+                         Strategy=values['Strategy'],
+                         Sweep=values.get('Sweep'), Wall=values['Wall'])
+        elif kind == SETPOINT:
+            # A setpoint that is started again replaces the points it
+            # had (and any after it).
+            index = values['Index']
+            del setPoints[index:], tables[index:]
+            del state['Report'][index:], state['Reduction'][index:]
+            setPoints.append(values['SetPoint'])
+            tables.append([])
+            state['Finished'] = index
+            state['Complete'] = False
+        elif kind == FINISHED:
+            state['Report'].append(values['Report'])
+            state['Reduction'].append(values['Reduction'])
+            state['Finished'] = values['Index'] + 1
+        elif kind == END:
+            state['Complete'] = True
+    data = RunData()
+    for setPoint, table in zip(setPoints, tables):
+        data.start_setpoint(setPoint)
+        for rows in table:
+            data.append_rows(rows)
+    if any(state['Reduction']):
+        data.Reduction = (state['Reduction'] +
+                          [None] * (len(data) - len(state['Reduction'])))
+    state['Data'] = data
+    return state
+
+
+def finalize_journal(Filename, Partial=True, Catalog=None,
+                     Compression=None):
+    """Write the data files of a (possibly interrupted) run.
+
+    With Partial, the points of an interrupted setpoint are written
+    too; otherwise only the finished setpoints are. Returns the state
+    from read_journal.
+    """
+    state = read_journal(Filename)
+    if state['RunArgs'] is None:
+        raise ValueError('%s does not hold a run.' % Filename)
+    data = state['Data']
+    count = len(data) if Partial else state['Finished']
+    if count < len(data):
+        data = RunData.from_tables(data[:count], data.SetPoints[:count])
+        if any(state['Reduction']):
+            data.Reduction = list(state['Reduction'][:count])
+    if count:
+        KWARGS = state['KWARGS'] or {}
+        fm.record_data_files(data, data.SetPoints[:count], state['RunArgs'],
+                             Catalog=Catalog, Compression=Compression,
+                             Ranges=(KWARGS.get('VoltageMeasureRange'),
+                                     KWARGS.get('CurrentMeasureRange')))
+    return state
@@ -1,10 +1,25 @@
 """ This program will open and run a program on a Keithley2400."""
 
-import visa
+try:
+    import visa
+except ImportError:
+    # Only needed to open an instrument (Transport=None).
+    visa = None
 import numpy as np
 import time
+import logging
+from contextlib import contextmanager
+from functools import partial
 import filemanipulation as fm
+import scpitrace
+import sweeps
+from adaptive import AdaptiveSweep
+from clocksync import ClockAligner, host_clock
+from datastore import RunData
+from journal import RunJournal, read_journal
+from switching import MultiplexScheduler
 
+log = logging.getLogger(__name__)
 class error(Exception):
 
     """ Custom error class for error handling.
@@ -15,7 +30,7 @@ class error(Exception):
 
     def __init__(self, string):
         """Initialize error message."""
-        Exception.__init__()
+        Exception.__init__(self, string)
         self.ErrorMsg = string
 
     def __str__(self):
@@ -23,6 +38,17 @@ class error(Exception):
         return self.ErrorMsg
 
 
+class CompletionTimeout(error):
+
+    """Raised when a measurement does not complete by its deadline."""
+
+
+# Errors of a session that recover_session can get out of: completion
+# timeouts and the I/O errors of the VISA library (if it has them).
+RECOVERABLE_ERRORS = (CompletionTimeout,) + tuple(
+    getattr(visa, name) for name in ('VisaIOError',) if hasattr(visa, name))
+
+
 class SourceMeter(object):
 
     """ This class defines a Keithley SMU experiment object.
@@ -42,21 +68,89 @@ class SourceMeter(object):
                       'TriggerDelay': 0, 'SourceDelay': 0,
                       'ExperimentLength': 2, 'PointDelay': 0.1,
                       'BufferSize': 2500, 'VoltageMeasureRange': None,
-					  'CurrentMeasureRange': None}
+					  'CurrentMeasureRange': None,
+                      'PulseWidth': None}
+
+    # Instrument settings changed by the max throughput profile. They
+    # are queried before the profile is applied and restored after.
+    THROUGHPUT_SETTINGS = (':SYST:AZER:STAT', ':DISP:ENAB',
+                           ':SOUR:DEL:AUTO', ':SOUR:DEL', ':TRIG:DEL')
+    # KWARGS changed by the max throughput profile.
+    THROUGHPUT_KWARGS = ('NPLC', 'SourceDelay', 'TriggerDelay',
+                         'VoltageMeasureRange', 'CurrentMeasureRange')
+    MIN_NPLC = 0.01
+    LineFrequency = 60.
+    # Ways slow_chrono can take points (see choose_strategy).
+    ACQUISITION_STRATEGIES = ('Trace', 'Read', 'Buffered')
+    # slow_chrono can also pulse the source (Strategy='Pulsed', see
+    # configure_pulse), which is never chosen automatically.
+    # Longest time a buffered block of points may take (s).
+    MaxBlockTime = 1.
+    # The deadline of a measurement is CompletionFactor times the time
+    # its readings should take plus CompletionMargin (s).
+    CompletionFactor = 1.5
+    CompletionMargin = 0.5
+    # Bits of the status byte set once the *OPC of a measurement has
+    # gone off (event summary 32 and the request for service 64).
+    STB_COMPLETE = 32 | 64
+    # Session recoveries call_with_recovery tries before giving up.
+    MaxRecoveries = 3
 
-    def __init__(self, smu_address='GPIB0::25'):
+    def __init__(self, smu_address='GPIB0::25', Transport=None,
+                 TraceFile=None, Calibrate=True, CalibrateTiming=False):
         """Initialize the object.
 
         This makes the source meter recource manager for the PyVISA
         protocall. It also makes the local KWARGS dictionary for this
         instance and runs an initilization routiene that does not depend
         on KWARGS (to give a chance for the user to change KWARGS later.
+
+        Transport can be given to talk to something other than a VISA
+        instrument (for example a scpitrace.TraceReplayer), in which
+        case smu_address is not used. If TraceFile is given, all of
+        the I/O with the instrument is recorded to that file (see
+        scpitrace). Call close when done so the trace is complete.
+
+        With Calibrate=True the SMU timer is aligned with the host clock
+        (see align_clock) so that points can carry the SMU timestamps.
+        With CalibrateTiming=True the timing of the connection is
+        measured as well (see calibrate_timing) so that slow_chrono can
+        choose how to take points. That turns the output on, so it is
+        only done when asked for.
         """
-        self.rm = visa.ResourceManager()
         self.KWARGS = dict(self.DEFAULT_KWARGS)
-        self.k2400 = self.rm.get_instrument(smu_address)
+        self.Address = smu_address
+        self.rm = None
+        if Transport is None:
+            if visa is None:
+                raise ImportError('Opening %s needs PyVISA.' % smu_address)
+            self.rm = visa.ResourceManager()
+            self.k2400 = self.rm.get_instrument(smu_address)
+        else:
+            self.k2400 = Transport
+        if TraceFile:
+            self.k2400 = scpitrace.TraceRecorder(self.k2400, TraceFile)
+        # Timing functions. Recording and replaying transports supply
+        # their own so that the timing of a run can be replayed.
+        self.clock = getattr(self.k2400, 'clock', host_clock)
+        self.sleep = getattr(self.k2400, 'sleep', time.sleep)
+        self.Timing = None
+        self.Clock = None
+        # Host time the last trigger was sent (see trigger_times).
+        self.TriggerTime = None
+        # Output as last set (put back by recover_session).
+        self.OutputLevel = 0
+        self.OutputState = 'OFF'
+        # Whether every reading is a pulse (see configure_pulse).
+        self.Pulsing = False
+        # Time, duration and cause of every session recovery.
+        self.Recoveries = []
         self.setup_connection()
         self.initialize_SRQ()
+        if CalibrateTiming:
+            self.calibrate_timing()
+        if Calibrate:
+            self.align_clock()
 
     def setup_connection(self):
         """ Setup the source meter to take measurements.
@@ -186,6 +280,11 @@ class SourceMeter(object):
         # Local or remote sensing (Four temrinal or two terminal)
         self.k2400.write(':SYST:RSEN ' + self.KWARGS['FourTerminal'])
 
+    def measure_ranges(self):
+        """Fixed voltage and current measure ranges (None for auto)."""
+        return (self.KWARGS['VoltageMeasureRange'] or None,
+                self.KWARGS['CurrentMeasureRange'] or None)
+
     def reset_buffer(self):
         """Empty the buffer and set to defined buffer size.
 
@@ -219,9 +318,101 @@ class SourceMeter(object):
         self.k2400.write(':TRIG:DEL ' + str(self.KWARGS['TriggerDelay']))
         self.k2400.write(':SOUR:DEl ' + str(self.KWARGS['SourceDelay']))
 
+    def _pulse_source_delay(self, PulseWidth):
+        """Source delay for pulses of PulseWidth (s) at the NPLC."""
+        overhead = self.Timing['ReadingOverhead'] if self.Timing else 0.
+        measure = self.KWARGS['NPLC'] / self.LineFrequency + overhead
+        if not PulseWidth or PulseWidth < measure:
+            raise error('A pulse of %s s is too short to measure at %g NPLC '
+                        '(%.3g s).' % (PulseWidth, self.KWARGS['NPLC'],
+                                       measure))
+        return PulseWidth - measure
+
+    def configure_pulse(self, PulseWidth=None):
+        """Make every reading a pulse of the source.
+
+        With source auto clear on, the SMU turns the output on at the
+        source level at the start of each reading, waits the source
+        delay, measures and turns the output off again. The pulse width
+        and the time between pulses (the pulse plus the trigger delay)
+        are then timed by the instrument and not by the host. The
+        source delay is set so that a pulse lasts PulseWidth (s,
+        KWARGS['PulseWidth'] by default) with the measurement at its
+        end. Returns the source delay; end_pulse goes back to a steady
+        output.
+        """
+        if PulseWidth is None:
+            PulseWidth = self.KWARGS.get('PulseWidth')
+        self.KWARGS['SourceDelay'] = self._pulse_source_delay(PulseWidth)
+        self.KWARGS['PulseWidth'] = PulseWidth
+        self.configure_chrono_trigger()
+        self.source_on('OFF')
+        self.k2400.write(':SOUR:CLE:AUTO:MODE ALW')
+        self.k2400.write(':SOUR:CLE:AUTO ON')
+        self.Pulsing = True
+        return self.KWARGS['SourceDelay']
+
+    def end_pulse(self):
+        """Stop pulsing the source (see configure_pulse)."""
+        self.k2400.write(':SOUR:CLE:AUTO OFF')
+        self.Pulsing = False
+
+    def capture_interruption(self, SetPoint, Before=10, After=90, Level=0.,
+                             NPLC=None):
+        """Step the output in the middle of a burst of fast readings.
+
+        The source is put in list mode so that, in one trigger of
+        Before + After readings (at most 100, the length of the source
+        list) into the trace buffer, the first Before readings are
+        taken at SetPoint and the rest after the output steps to Level
+        (0 to interrupt the current). The readings are taken as fast as
+        the SMU can: without delays, at NPLC (MIN_NPLC by default) and
+        with the measure range fixed at the range in use. The source,
+        trigger, range and buffer settings are put back afterwards,
+        with the output left at Level. Returns the readings as
+        [voltage, current, time] rows, with the times from the SMU
+        timer.
+        """
+        if self.Pulsing:
+            raise error('An interruption can not be captured while '
+                        'pulsing.')
+        count = int(Before) + int(After)
+        if not 0 < count <= 100:
+            raise error('A burst must have 1 to 100 readings.')
+        mode = self.KWARGS['SourceMode']
+        measure = 'CURR' if mode == 'VOLT' else 'VOLT'
+        state = self.query_state([':TRAC:FEED:CONT',
+                                  ':SENS:%s:RANG:AUTO' % measure])
+        savedKWARGS = dict(self.KWARGS)
+        # Auto range would change range (and stall) at the step.
+        self.k2400.write(':SENS:%s:RANG %s' % (measure, self.k2400.ask(
+            ':SENS:%s:RANG?' % measure).strip()))
+        self.KWARGS.update(NPLC=NPLC or self.MIN_NPLC, TriggerCount=count,
+                           TriggerDelay=0, SourceDelay=0, BufferSize=count)
+        try:
+            self.k2400.write(':SENS:%s:NPLC %s' % (measure,
+                                                   self.KWARGS['NPLC']))
+            self.configure_chrono_trigger()
+            self.k2400.write(':SOUR:%s:MODE LIST' % mode)
+            self.k2400.write(':SOUR:LIST:%s %s' % (mode, ','.join(
+                [repr(float(SetPoint))] * int(Before) +
+                [repr(float(Level))] * int(After))))
+            rows = self.take_points().T
+        finally:
+            self.k2400.write(':SOUR:%s:MODE FIX' % mode)
+            self.set_output(Level)
+            self.KWARGS.update(savedKWARGS)
+            self.k2400.write(':SENS:%s:NPLC %s' % (measure,
+                                                   self.KWARGS['NPLC']))
+            self.configure_chrono_trigger()
+            self.reset_buffer()
+            self.restore_state(state)
+        return rows
+
     def set_output(self, SetPoint=0):
         """Set output level of SMU (in A or V) depending on mode."""
         self.k2400.write(':SOUR:CURR:LEV:TRIG ' + str(SetPoint))
+        self.OutputLevel = SetPoint
 
     def source_on(self, state='OFF'):
         """Turn on or off the SMU.
@@ -230,6 +421,7 @@ class SourceMeter(object):
         to turn off output. Function will default OFF with no parameters.
         """
         self.k2400.write(':OUTP ' + state)
+        self.OutputState = state
 
     def take_points(self):
         """Take points as defined by the Trigger.
@@ -253,14 +445,128 @@ class SourceMeter(object):
         #     newSRQ = self.buffer_bin_to_dec(eventEnable) + 32
         #     self.k2400.write('*SRE ' + str(newSRQ))
         self.k2400.write('*CLS')  # Clear SRQ
+        self.TriggerTime = self.clock()
         self.k2400.write(':INIT')
         self.k2400.write('*OPC')
-        self.k2400.wait_for_srq(None)
+        self.wait_for_completion()
         # Ask for values and format in 2D numpy array.
         Data = np.array(self.k2400.ask_for_values(':TRAC:DATA?'))
         DataOut = np.array((Data[0::3], Data[1::3], Data[2::3]))
         return DataOut
 
+    def completion_timeout(self):
+        """Deadline (s) for the readings of one trigger to complete.
+
+        This is the time TriggerCount readings take (integration time
+        from the NPLC, trigger and source delays and the measured
+        reading overhead, or 10 ms without a calibration) scaled by
+        CompletionFactor plus CompletionMargin.
+        """
+        overhead = (self.Timing['ReadingOverhead'] if self.Timing
+                    else 0.01)
+        reading = (self.KWARGS['NPLC'] / self.LineFrequency +
+                   self.KWARGS['TriggerDelay'] + self.KWARGS['SourceDelay'] +
+                   overhead)
+        return (self.CompletionFactor * reading * self.KWARGS['TriggerCount']
+                + self.CompletionMargin)
+
+    def _status_byte(self):
+        """Read the status byte (by serial poll where possible)."""
+        read_stb = getattr(self.k2400, 'read_stb', None)
+        if read_stb is not None:
+            return int(read_stb())
+        return int(self.k2400.ask('*STB?'))
+
+    def wait_for_completion(self, Timeout=None):
+        """Wait for the SRQ of a pending *OPC with a deadline.
+
+        The SRQ is waited for up to Timeout (s, completion_timeout by
+        default). If it does not come (a missed SRQ or a bus error),
+        the status byte is polled for the completion for as long again
+        before CompletionTimeout is raised.
+        """
+        if Timeout is None:
+            Timeout = self.completion_timeout()
+        try:
+            # VISA timeouts are in milliseconds.
+            self.k2400.wait_for_srq(int(Timeout * 1000))
+            return
+        except Exception as e:
+            log.warning('No SRQ after %.3g s (%s), polling the status '
+                        'byte.', Timeout, e)
+        end = self.clock() + Timeout
+        while True:
+            try:
+                if self._status_byte() & self.STB_COMPLETE:
+                    return
+            except Exception as e:
+                log.warning('Polling the status byte failed: %s', e)
+            if self.clock() >= end:
+                raise CompletionTimeout('The measurement did not complete '
+                                        'within %.3g s.' % (2 * Timeout))
+            self.sleep(min(0.01, Timeout / 10.))
+
+    def recover_session(self, Cause=None):
+        """Get a failed session with the SMU going again.
+
+        The instrument is sent a device clear (or, if that fails, the
+        VISA session is opened again and set up from scratch) and the
+        SRQ, source, trigger, buffer and output are configured again
+        from KWARGS and the last output. The SMU clock is aligned again
+        if it was. The time it took is logged and kept in
+        self.Recoveries with the time and Cause; it is returned.
+        """
+        start = self.clock()
+        aligned = self.Clock is not None
+        log.warning('Recovering the session with the SMU after: %s', Cause)
+        try:
+            self.k2400.clear()
+            self.k2400.write('*CLS')
+        except Exception as e:
+            if self.rm is None:
+                raise error('Can not reopen the session with the SMU: %s'
+                            % e)
+            log.warning('Device clear failed (%s), reopening %s.', e,
+                        self.Address)
+            try:
+                self.k2400.close()
+            except Exception:
+                pass
+            self.k2400 = self.rm.get_instrument(self.Address)
+            self.setup_connection()
+            self.Clock = None
+        self.initialize_SRQ()
+        self.configure_source()
+        self.configure_chrono_trigger()
+        self.reset_buffer()
+        self.set_output(self.OutputLevel)
+        self.source_on(self.OutputState)
+        if self.Pulsing:
+            self.k2400.write(':SOUR:CLE:AUTO ON')
+        if aligned:
+            self.align_clock()
+        duration = self.clock() - start
+        self.Recoveries.append({'Time': start, 'Duration': duration,
+                                'Cause': str(Cause)})
+        log.warning('Session recovered in %.3f s.', duration)
+        return duration
+
+    def call_with_recovery(self, function, *args):
+        """Call function(*args), recovering the session if it fails.
+
+        A function that fails with one of RECOVERABLE_ERRORS is called
+        again after recover_session, up to MaxRecoveries times.
+        """
+        attempt = 0
+        while True:
+            try:
+                return function(*args)
+            except RECOVERABLE_ERRORS as e:
+                if attempt >= self.MaxRecoveries:
+                    raise
+                attempt += 1
+                self.recover_session(e)
+
     def setup_simple_experiment(self, SetPoint=0):
         """Setup simple experiment.
 
@@ -275,12 +581,300 @@ class SourceMeter(object):
         self.set_output(SetPoint)
         self.source_on('ON')
 
+    def query_state(self, Settings):
+        """Return the current values of a list of instrument settings.
+
+        Settings is a list of SCPI command headers (for example
+        ':DISP:ENAB'). The values are returned in a dictionary that
+        can be given to restore_state.
+        """
+        return dict((setting, self.k2400.ask(setting + '?').strip())
+                    for setting in Settings)
+
+    def restore_state(self, State):
+        """Write back settings returned by query_state."""
+        for setting, value in State.items():
+            self.k2400.write(setting + ' ' + value)
+
+    def apply_max_throughput(self, AutoZero='OFF', Points=100):
+        """Configure the SMU for its maximum reading rate.
+
+        This applies the fastest valid combination of settings:
+        autozero off (or 'ONCE' to autozero once now and then leave it
+        off), the front panel display off, the measurement ranges fixed
+        at the range currently in use, no source or trigger delays and
+        the lowest NPLC. The KWARGS are changed to match so that
+        configure_source and configure_chrono_trigger keep the profile.
+
+        The previous instrument settings and KWARGS are saved and put
+        back by restore_throughput. The reading rate achieved with the
+        profile is then measured over Points readings (if Points is
+        not 0) and returned (see measure_reading_rate). Note this is
+        for when speed matters more than noise; readings at the lowest
+        NPLC without autozero are noticeably noisier.
+        """
+        if AutoZero not in ('OFF', 'ONCE'):
+            raise error("AutoZero must be 'OFF' or 'ONCE'.")
+        self._SavedThroughputState = (
+            self.query_state(self.THROUGHPUT_SETTINGS),
+            dict((key, self.KWARGS[key]) for key in self.THROUGHPUT_KWARGS))
+        # Fix the ranges at whatever range is in use now.
+        for mode, key in (('VOLT', 'VoltageMeasureRange'),
+                          ('CURR', 'CurrentMeasureRange')):
+            if not self.KWARGS[key]:
+                self.KWARGS[key] = float(
+                    self.k2400.ask(':SENS:' + mode + ':RANG?'))
+        self.KWARGS['NPLC'] = self.MIN_NPLC
+        self.KWARGS['SourceDelay'] = 0
+        self.KWARGS['TriggerDelay'] = 0
+        self.k2400.write(':SYST:AZER:STAT ' + AutoZero)
+        self.k2400.write(':DISP:ENAB OFF')
+        self.k2400.write(':SOUR:DEL:AUTO OFF')
+        self.configure_source()
+        self.configure_chrono_trigger()
+        if Points:
+            return self.measure_reading_rate(Points)
+
+    def restore_throughput(self):
+        """Undo apply_max_throughput.
+
+        The instrument settings and KWARGS saved by apply_max_throughput
+        are restored and the source and trigger reconfigured with them.
+        """
+        state, kwargs = self._SavedThroughputState
+        self.KWARGS.update(kwargs)
+        self.configure_source()
+        self.configure_chrono_trigger()
+        self.restore_state(state)
+        del self._SavedThroughputState
+
+    @contextmanager
+    def max_throughput(self, AutoZero='OFF', Points=100):
+        """Run a block of code with the max throughput profile.
+
+        Use as:
+            with smu.max_throughput() as rate:
+                data = smu.simple_sweep(SweepPath)
+        where rate is the result of measure_reading_rate. The previous
+        settings are restored when the block exits.
+        """
+        rate = self.apply_max_throughput(AutoZero, Points)
+        try:
+            yield rate
+        finally:
+            self.restore_throughput()
+
+    def measure_reading_rate(self, Points=100):
+        """Measure the reading rate the SMU achieves with its settings.
+
+        A burst of Points readings (at most the 2500 point buffer) is
+        taken with take_points. Returns a dictionary with the
+        InstrumentRate (readings per second from the SMU timestamps)
+        and HostRate (readings per second including the trigger, SRQ
+        and transfer overhead as seen by the program). The result is
+        also kept in self.ReadingRate.
+        """
+        Points = max(2, min(int(Points), 2500))
+        saved = dict((key, self.KWARGS[key])
+                     for key in ('TriggerCount', 'BufferSize'))
+        self.KWARGS['TriggerCount'] = Points
+        self.KWARGS['BufferSize'] = Points
+        try:
+            self.configure_chrono_trigger()
+            start = self.clock()
+            Data = self.take_points()
+            elapsed = self.clock() - start
+        finally:
+            self.KWARGS.update(saved)
+            self.configure_chrono_trigger()
+        times = Data[2]
+        span = times[-1] - times[0]
+        self.ReadingRate = {
+            'InstrumentRate': (len(times) - 1) / span if span > 0 else None,
+            'HostRate': len(times) / elapsed if elapsed > 0 else None,
+            'Points': len(times)}
+        return self.ReadingRate
+
+    def calibrate_timing(self, Points=20, Repeats=3):
+        """Measure the timing costs of the connection to the SMU.
+
+        This turns the output on to take a few short measurements at
+        0 A (and off again afterwards), so only call it with the cell
+        in a state where that is safe. It stores in self.Timing:
+            RoundTrip: time of a query with no measurement.
+            ReadingOverhead: time per reading on top of the NPLC
+                integration time (from the SMU timestamps).
+            TraceOverhead: extra time of a take_points call (trace
+                buffer, SRQ and transfer) over the reading itself.
+            ReadOverhead: extra time of a single shot :READ? query.
+            TransferPerPoint: time to transfer each extra reading
+                from the buffer.
+        These are used by predict_period and choose_strategy. The
+        KWARGS are left unchanged.
+        """
+        saved = dict(self.KWARGS)
+        self.KWARGS.update(SourceMode='CURR', TriggerDelay=0, SourceDelay=0)
+        try:
+            self.configure_source()
+            self.set_output(0)
+            self.source_on('ON')
+            start = self.clock()
+            for _ in range(Repeats):
+                self.k2400.ask('*OPC?')
+            roundTrip = (self.clock() - start) / Repeats
+            # Burst of points to get the reading period of the SMU.
+            self.KWARGS.update(TriggerCount=Points, BufferSize=Points)
+            self.configure_chrono_trigger()
+            start = self.clock()
+            burst = self.take_points()
+            blockTime = self.clock() - start
+            period = (burst[2][-1] - burst[2][0]) / (Points - 1)
+            # Single points through the trace buffer.
+            self.KWARGS.update(TriggerCount=1, BufferSize=1)
+            self.configure_chrono_trigger()
+            start = self.clock()
+            for _ in range(Repeats):
+                self.take_points()
+            traceTime = (self.clock() - start) / Repeats
+            # Single shot readings.
+            self.k2400.write(':TRAC:FEED:CONT NEV')
+            start = self.clock()
+            for _ in range(Repeats):
+                self.k2400.ask_for_values(':READ?')
+            readTime = (self.clock() - start) / Repeats
+        finally:
+            self.source_on('OFF')
+            self.KWARGS.clear()
+            self.KWARGS.update(saved)
+            self.configure_source()
+            self.configure_chrono_trigger()
+        integration = saved['NPLC'] / self.LineFrequency
+        self.Timing = {
+            'RoundTrip': roundTrip,
+            'ReadingOverhead': max(period - integration, 0),
+            'TraceOverhead': max(traceTime - period, 0),
+            'ReadOverhead': max(readTime - period, 0),
+            'TransferPerPoint': max((blockTime - traceTime -
+                                     (Points - 1) * period) / (Points - 1),
+                                    0)}
+        log.info('SMU timing: %s', self.Timing)
+        return self.Timing
+
+    def trigger_times(self, Times):
+        """Host times of the readings of the last take_points.
+
+        Times are the trace buffer timestamps of the readings. Those
+        count from the first reading in the buffer (which take_points
+        clears), so they only give the spacing of the readings (scaled
+        by the drift of the SMU timer if it is aligned). The first
+        reading is put at the time the trigger was sent plus the
+        trigger and source delays and the integration time.
+        """
+        Times = np.asarray(Times, dtype=float)
+        drift = self.Clock.Drift if self.Clock is not None else 0.
+        first = (self.TriggerTime + float(self.KWARGS['TriggerDelay']) +
+                 float(self.KWARGS['SourceDelay']) +
+                 float(self.KWARGS['NPLC']) / self.LineFrequency)
+        return first + (Times - Times[:1]) / (1 + drift)
+
+    def align_clock(self, Samples=5):
+        """Align the SMU timer with the host clock.
+
+        The first call makes self.Clock (a clocksync.ClockAligner) and
+        every call adds a sync sample from a burst of Samples timer
+        queries, refining the offset and drift. Returns the offset
+        (host time of SMU time zero) and drift.
+        """
+        if self.Clock is None:
+            self.Clock = ClockAligner(self.clock)
+        offset, drift = self.Clock.synchronize(self.k2400, Samples)
+        log.debug('SMU clock offset %.6f s, drift %.3g, +/- %.3g s.',
+                  offset, drift, self.Clock.Uncertainty)
+        return offset, drift
+
+    def _block_size(self, PointDelay, NPLC):
+        """Number of points per block for the Buffered strategy."""
+        reading = NPLC / self.LineFrequency
+        if self.Timing:
+            reading += self.Timing['ReadingOverhead']
+        return int(min(self.KWARGS['BufferSize'], 2500,
+                       max(1, self.MaxBlockTime // max(PointDelay, reading))))
+
+    def predict_period(self, Strategy, PointDelay=None, NPLC=None):
+        """Predict the time between points of an acquisition strategy.
+
+        Returns a tuple of the predicted sample period and the bus
+        overhead per point for Strategy (see choose_strategy) with the
+        requested PointDelay (the target sample period) and NPLC,
+        which default to the values in KWARGS. Needs calibrate_timing
+        to have been run.
+        """
+        if PointDelay is None:
+            PointDelay = self.KWARGS['PointDelay']
+        if NPLC is None:
+            NPLC = self.KWARGS['NPLC']
+        timing = self.Timing
+        reading = NPLC / self.LineFrequency + timing['ReadingOverhead']
+        if Strategy == 'Trace':
+            # PointDelay is waited after each point.
+            overhead = timing['TraceOverhead']
+            return PointDelay + reading + overhead, overhead
+        elif Strategy == 'Read':
+            overhead = timing['ReadOverhead']
+        elif Strategy in ('Buffered', 'Pulsed'):
+            # The SMU paces the points, the bus costs are spread over
+            # the block.
+            if Strategy == 'Pulsed':
+                reading = max(reading, self.KWARGS.get('PulseWidth') or 0)
+            overhead = (timing['TraceOverhead'] /
+                        self._block_size(PointDelay, NPLC) +
+                        timing['TransferPerPoint'])
+            return max(PointDelay, reading) + overhead, overhead
+        else:
+            raise error('Unknown acquisition strategy %s.' % Strategy)
+        return max(PointDelay, reading + overhead), overhead
+
+    def choose_strategy(self, PointDelay=None, NPLC=None):
+        """Choose how to take points for a requested sample period.
+
+        The strategies are:
+            Trace: trigger one reading into the trace buffer, wait for
+                the SRQ and read it back (take_points), then wait
+                PointDelay before the next.
+            Read: a single shot :READ? query per point.
+            Buffered: the SMU takes blocks of points paced by its own
+                trigger delay and the block is read back at once.
+        Of the strategies predicted to meet the PointDelay sample
+        period, the one with the least bus overhead per point is
+        chosen. If none can, the fastest is. Returns the strategy and
+        its predicted period. Without a calibration this is always
+        Trace.
+        """
+        if self.Timing is None:
+            return 'Trace', None
+        if PointDelay is None:
+            PointDelay = self.KWARGS['PointDelay']
+        predictions = [(self.predict_period(strategy, PointDelay, NPLC),
+                        strategy) for strategy in self.ACQUISITION_STRATEGIES]
+        feasible = [(overhead, period, strategy) for
+                    (period, overhead), strategy in predictions
+                    if period <= PointDelay * 1.000001]
+        if feasible:
+            _, period, strategy = min(feasible)
+        else:
+            (period, _), strategy = min(predictions)
+        return strategy, period
+
     def reset_device(self):
         """Reset device before power down."""
         self.k2400.write(':*RST')
         self.k2400.write(':*CLS')
         self.k2400.write(':*SRE 0')
 
+    def close(self):
+        """Close the connection to the instrument (and any trace)."""
+        self.k2400.close()
+
     def _check_kwargs(self):
         """Check values of the KWARGS dictionary.
 
@@ -328,10 +922,97 @@ class SMUExperiments(SourceMeter):
                      'max_cell_dc_concentration_gradient\\AmB\\1.14-0.01' +
                      '\\14-06-19\\')}
 
-    def __init__(self, smu_address='GPIB0::25'):
+    def __init__(self, smu_address='GPIB0::25', Transport=None,
+                 TraceFile=None, Calibrate=True, CalibrateTiming=False):
         """Run initilization."""
-        SourceMeter.__init__(self, smu_address)
+        SourceMeter.__init__(self, smu_address, Transport, TraceFile,
+                             Calibrate, CalibrateTiming)
         self.RunArgs = dict(self.DEFAULT_RUNARGS)
+        # catalog.RunCatalog that recorded runs are added to (if any).
+        self.Catalog = None
+        # Compression ('gzip', 'xz' or 'quantized') for recorded files,
+        # None for none.
+        self.Compression = None
+        # Type the data of runs is kept in (see datastore.RunData).
+        self.DataType = np.float64
+        # Filter that reduces slow_chrono data as it is taken (see
+        # reduction.py), None to keep every point.
+        self.Reduction = None
+        # Strategy, predicted and achieved period of each slow_chrono
+        # setpoint.
+        self.AcquisitionReport = []
+        # Objects told about the progress of slow_chrono (see notify).
+        self.Listeners = []
+        # File slow_chrono journals runs to (see journal.py), None for
+        # no journal.
+        self.Journal = None
+        # auxiliary.AuxiliaryRecorder of the sensors slow_chrono polls
+        # during runs, None for none.
+        self.Auxiliary = None
+        # Keyword arguments of capture_interruption for slow_chrono to
+        # end every setpoint with an interruption burst, None for none.
+        self.Interruption = None
+        # Set by request_stop to end a slow_chrono run early.
+        self.StopRequested = False
+        # Switches, time switching and time waiting of the last
+        # multiplexed_chrono run.
+        self.MultiplexReport = None
+
+    def notify(self, Event, *args):
+        """Tell the listeners about an event in a run.
+
+        Each object in self.Listeners that has a method named Event is
+        called with args. The events sent by slow_chrono are:
+            run_started(SweepPath, KWARGS)
+            setpoint_started(Index, SetPoint)
+            points_taken(Index, Rows): Rows is a view of the newly
+                taken [voltage, current, time, globalTime] rows and is
+                only valid during the call.
+            burst_taken(Index, Burst): the interruption burst of
+                the setpoint (see Interruption in slow_chrono).
+            setpoint_finished(Index, Data): Data is a view of the
+                points of the setpoint.
+            run_finished(Data): Data is the datastore.RunData of the
+                run.
+        """
+        for listener in self.Listeners:
+            method = getattr(listener, Event, None)
+            if method is not None:
+                method(*args)
+
+    def request_stop(self):
+        """Ask a running slow_chrono to stop.
+
+        This can be called from another thread. The run stops after the
+        point (or block) being taken and returns the data taken so far.
+        A stop requested before a run starts (but after the last one
+        ended) stops that run before its first setpoint; the request
+        is cleared when the run ends.
+        """
+        self.StopRequested = True
+
+    def resume_chrono(self, Filename, RecordData='No'):
+        """Resume a slow_chrono run from its journal after a crash.
+
+        The KWARGS, RunArgs and strategy of the run are restored from
+        the journal and the sweep carries on from the setpoint that was
+        interrupted, which is run again from its start. The journal is
+        appended to (self.Journal is set to Filename). Returns what
+        slow_chrono does, with the finished setpoints of the journal
+        in the data.
+        """
+        state = read_journal(Filename)
+        if state['Plan'] is None:
+            raise error('%s does not hold a run to resume.' % Filename)
+        if state['Complete']:
+            raise error('The run in %s has already finished.' % Filename)
+        self.KWARGS.update(state['KWARGS'])
+        self.RunArgs.update(state['RunArgs'])
+        self.Journal = Filename
+        log.info('Resuming the run in %s at setpoint %d.', Filename,
+                 state['Finished'] + 1)
+        return self.slow_chrono(state['Plan'], RecordData=RecordData,
+                                Strategy=state['Strategy'], Resume=state)
 
     def _format_raw_data(self, inputData):
         """Format data from instrument.
@@ -355,88 +1036,497 @@ class SMUExperiments(SourceMeter):
         sweep path. The sweep path is a list that defines the source
         values that will be swept.
 
-        The function will output a list of numpy arrays with the
-        volt, current and time from the SMU. The index of the
-        output list is the values at each of the index of the input
-        sweep. So output[0] corresponds to the points taken at
+        The function will output a datastore.RunData with the volt,
+        current and time from the SMU and the global time of each
+        point. The index of the output is the values at each of the
+        index of the input sweep. So output[0] is an array of the
+        [voltage, current, time, globalTime] points taken at
         SweepPath[0].
         """
-        data = []
+        data = RunData(self.DataType)
         SourceMeter.setup_simple_experiment(self)
+        globalStartTime = self.clock()
         for i in SweepPath:
             SourceMeter.set_output(self, i)
-            data.append(SourceMeter.take_points(self))
+            data.start_setpoint(i)
+            triggerTime = self.clock() - globalStartTime
+            block = SourceMeter.take_points(self)
+            data.append_rows(np.column_stack((
+                block.T, triggerTime + block[2] - block[2, 0])))
         SourceMeter.source_on(self, 'OFF')
         return data
 
     def slow_chrono(self, SweepPath, ExperimentLength=None, PointDelay=None,
-                    RecordData='No'):
+                    RecordData='No', Strategy='Trace', Resume=None):
         """Perform a (slow) chrono measurement.
 
         This function inputs a setpoint, experiment length and
         (non-SMU) internal trigger delay and performs either a
         chronopotentriomitric or chronovoltaic experiment.
 
-        The program will wait PointDelay seconds from the end of
-        the last measurement before asking for another. This means
-        there will be one data point for every TriggerDelay + NPLC/60 +
-        SMUInternal Source and Trigger Delay + Overhead for data transfer.
+        SweepPath is a list of setpoints, a sweeps.Sweep or a plan from
+        sweeps.make_plan. With a list, every setpoint runs for
+        ExperimentLength with PointDelay between points; a Sweep or a
+        plan can set both for each setpoint. With an
+        adaptive.AdaptiveSweep, the setpoints are picked as the run
+        goes from the steady states of the setpoints before them, and
+        the output and files hold the setpoints in the order they were
+        run.
+
+        How the points are taken is set by Strategy, which is one of
+        'Trace', 'Read' or 'Buffered' (see choose_strategy) or 'Auto'
+        to pick the one that can meet the shortest PointDelay of the
+        sweep with the least overhead from the timing measured by
+        calibrate_timing (Trace if it has not been run). With the
+        default, Trace, the program waits PointDelay from the end of
+        the last measurement before taking another, so there is a
+        point every PointDelay + NPLC/60 + trigger and source delays +
+        transfer overhead. With the other strategies PointDelay is the
+        requested time between points; if a strategy can not take
+        points that fast, points are taken as fast as it can. The
+        choice and the predicted and achieved periods are logged and
+        kept in self.AcquisitionReport.
+
+        Strategy 'Pulsed' takes points the Buffered way but pulses the
+        source for every point (see configure_pulse) instead of holding
+        it at the setpoint, for currents that would heat the cell if
+        they were applied for the whole setpoint. KWARGS['PulseWidth']
+        is the width of the pulses and PointDelay their period, so the
+        duty cycle is PulseWidth / PointDelay; the output is off
+        between pulses. Each point is the reading at the end of a
+        pulse.
+        If self.Reduction is set to a filter from reduction.py, the
+        points of each setpoint go through it as they are taken and
+        only the points it keeps are stored. The points taken and kept
+        are kept in the Reduction of the output and recorded in the
+        headers of the files.
         Once the experiment has gone for the length, it will terminate
-        and return a numpy array with the format
+        and return a datastore.RunData (kept as self.DataType) where
+        each setpoint is a numpy array with the format
         [voltage, current, time, globalTime].
 
-        Note that the time in this output is the time from the program,
-        not the SMU as the SMU timer resets for each trigger. Therefore
-        this value is replaced with a computed value from the program.
-        This value is not as accurate as if it came from the meter,
-        but there is no way around that at this time.
+        The times in the output are on the host clock (a monotonic
+        one). Points taken through the trace buffer (Trace, Buffered
+        and Pulsed) are timed from the host time their trigger was
+        sent, with the spacing of the points of a block from the SMU
+        timestamps (see trigger_times). With the Read strategy, if the
+        SMU clock has been aligned with the host clock (see
+        align_clock, done at connect), the times are the SMU timer
+        stamps of the readings converted to host time. For the
+        strategies other than Trace, the alignment is refreshed at the
+        start of each setpoint to follow the drift of the SMU timer.
+        Without an alignment, Read times are read from the host clock
+        as the points arrive.
 
         The advantage if this program over simple_sweep is that it
         is not limited to 2500 data points. It takes data slower,
-        but can run indefinatly (limited by the preallocation which
-        currently is set to 1,000,000 points, but can be changed to
-        any value if needed.)
+        but can run indefinatly (limited only by memory, the data
+        store grows as points are taken.)
+
+        If self.Journal is set, the run is journaled to that file as it
+        goes (see journal.py) so that it can be resumed with
+        resume_chrono or its files written with
+        journal.finalize_journal after a crash. Resume is the
+        journal.read_journal state of an interrupted run to carry on
+        with (resume_chrono passes it). request_stop ends the run early
+        with the points taken so far.
+
+        If self.Interruption is set (to keyword arguments of
+        capture_interruption, {} for the defaults), every setpoint ends
+        with an interruption of the output captured in a burst of fast
+        readings, which is kept in the Bursts of the output (a
+        dictionary of the Level, the readings Before and After the step
+        and the [voltage, current, time, globalTime] Data) and written
+        in a section of its own in the chrono file of the setpoint.
+
+        If self.Auxiliary is set, its sensors are polled on their own
+        threads for the length of the run and the files get their
+        readings (see auxiliary.py); self.Auxiliary.extra_columns
+        gives them for the output.
+
+        Every measurement has a deadline (see wait_for_completion). If
+        one fails, the session is recovered (see recover_session) and
+        the setpoint carries on; the time each recovery took is kept
+        in the Recoveries of the AcquisitionReport.
         """
 
         if ExperimentLength:
             self.KWARGS['ExperimentLength'] = ExperimentLength
         if PointDelay:
             self.KWARGS['PointDelay'] = PointDelay
+        if Resume is not None:
+            SweepPath = Resume['Plan']
+            if Resume.get('Sweep'):
+                SweepPath = AdaptiveSweep.from_dict(Resume['Sweep'])
+        adaptive = None
+        if isinstance(SweepPath, AdaptiveSweep):
+            adaptive = SweepPath
+            adaptive.reset()
+        plan = sweeps.make_plan(SweepPath, self.KWARGS)
+        SweepPath = plan['SetPoint'].tolist()
+        PointDelay = plan['PointDelay'].min() if len(plan) else 0
+        if Strategy == 'Auto':
+            Strategy, predicted = self.choose_strategy(PointDelay)
+        elif self.Timing is not None:
+            predicted, _ = self.predict_period(Strategy, PointDelay)
+        else:
+            predicted = None
+        log.info('slow_chrono using the %s strategy for a %g s period '
+                 '(predicted %s s).', Strategy, PointDelay, predicted)
+        # Predicted period, block size and trigger delay of each point
+        # delay of the sweep (an adaptive sweep only has one).
+        delays = set(plan['PointDelay'].tolist())
+        if self.Timing is not None:
+            predictions = dict((delay, self.predict_period(Strategy,
+                                                           delay)[0])
+                               for delay in delays)
+        else:
+            predictions = dict.fromkeys(delays)
 
+        if Strategy == 'Pulsed':
+            # Check the pulses can be made before anything is set up.
+            self._pulse_source_delay(self.KWARGS.get('PulseWidth'))
+            if self.Interruption is not None:
+                raise error('Interruptions can not be captured in pulsed '
+                            'runs.')
         # Make sure the trigger count is one.
         self.KWARGS['TriggerCount'] = 1
+        savedKWARGS = dict(self.KWARGS)
         self.setup_simple_experiment()
-        globalStartTime = time.time()
+        pulseWidth = None
+        if Strategy in ('Buffered', 'Pulsed'):
+            # Block size and trigger delay of every step. A point takes
+            # a reading (or a pulse) and the trigger delay after it.
+            if Strategy == 'Pulsed':
+                self.configure_pulse()
+                reading = pulseWidth = self.KWARGS['PulseWidth']
+            else:
+                reading = self.KWARGS['NPLC'] / self.LineFrequency
+                if self.Timing:
+                    reading += self.Timing['ReadingOverhead']
+            blockSizes = dict((delay, self._block_size(
+                delay, self.KWARGS['NPLC'])) for delay in delays)
+            triggerDelays = dict((delay, max(delay - reading, 0))
+                                 for delay in delays)
+        elif Strategy == 'Read':
+            self.k2400.write(':TRAC:FEED:CONT NEV')
+        globalStartTime = self.clock()
         self.RunArgs['SourceMode'] = self.KWARGS['SourceMode']
+        journal = None
+
+        def take_block_(count, triggerDelay):
+            """Take a block of count points paced by the SMU."""
+            if (count != self.KWARGS['TriggerCount'] or
+                    triggerDelay != self.KWARGS['TriggerDelay']):
+                self.KWARGS['TriggerCount'] = count
+                self.KWARGS['BufferSize'] = count
+                self.KWARGS['TriggerDelay'] = triggerDelay
+                self.configure_chrono_trigger()
+            return self.take_points().T
+
+        def store_(rows):
+            """Store rows (through the reducer) and tell listeners."""
+            if reducer is not None:
+                rows = reducer.filter(rows)
+            if len(rows):
+                index = len(data) - 1
+                data.append_rows(rows)
+                self.notify('points_taken', index, data.tail(index,
+                                                             len(rows)))
 
-        def take_points_(setPoint):
+        def interrupt_(index, setPoint, startTime):
+            """Capture the interruption burst at the end of a setpoint."""
+            settings = {'Level': 0., 'Before': 10, 'After': 90}
+            settings.update(self.Interruption)
+            now = self.clock()
+            burst = self.call_with_recovery(partial(
+                self.capture_interruption, **self.Interruption), setPoint)
+            offsets = self.trigger_times(burst[:, 2]) - now
+            settings['Data'] = np.column_stack((
+                burst[:, :2], now - startTime + offsets,
+                now - globalStartTime + offsets))
+            data.Bursts.extend([None] * (index - len(data.Bursts)))
+            data.Bursts.append(settings)
+            self.notify('burst_taken', index, settings)
+
+        def take_points_(index, setPoint, length, PointDelay):
             """Take points in the slow chrono way."""
-            DataBin = np.zeros((1000000, 4))  # Preallocate 1,000,000 points.
-            count = -1
-            StartTime = time.time()
+            data.start_setpoint(setPoint)
+            # Points taken and the local time of the first and last.
+            taken = 0
+            firstTime = lastTime = 0.
+            recoveries = len(self.Recoveries)
+            if reducer is not None:
+                reducer.reset()
+            if self.Clock is not None and Strategy != 'Trace':
+                # Trace points are single readings timed by the host
+                # clock, so only the others need the SMU timer.
+                self.align_clock()
+            StartTime = self.clock()
+            nextTime = StartTime
             self.set_output(setPoint)
-            while time.time() - StartTime < self.KWARGS['ExperimentLength']:
-                count += 1
+            self.notify('setpoint_started', index, setPoint)
+            while True:
                 # Time block
-                now = time.time()
+                now = self.clock()
                 currTime = now - StartTime
+                if currTime >= length or self.StopRequested:
+                    break
                 currGlobalTime = now - globalStartTime
-                # Data block                now = time.time()
-                DataBin[count] = np.append(self.take_points(),
-                                           currGlobalTime)
-
-                DataBin[count, 2] = currTime
-                time.sleep(self.KWARGS['PointDelay'])
-            # Remove zeros from array
-            count += 1
-            DataBin = DataBin[0:count, :]
-            return DataBin
-
-        data = []
-        for i in SweepPath:
-            data.append(take_points_(i))
+                # Data block
+                if Strategy in ('Buffered', 'Pulsed'):
+                    block = self.call_with_recovery(take_block_, int(min(
+                        blockSizes[PointDelay], np.ceil((length - currTime) /
+                                                   max(PointDelay, reading)))),
+                        triggerDelays[PointDelay])
+                    offsets = self.trigger_times(block[:, 2]) - now
+                    store_(np.column_stack((
+                        block[:, :2], currTime + offsets,
+                        currGlobalTime + offsets)))
+                    if not taken:
+                        firstTime = currTime + offsets[0]
+                    taken += len(block)
+                    lastTime = currTime + offsets[-1]
+                    continue
+                offset = 0.
+                if Strategy == 'Read':
+                    # :READ? stamps the reading with the SMU timer.
+                    values = self.call_with_recovery(
+                        self.k2400.ask_for_values, ':READ?')
+                    if self.Clock is not None:
+                        offset = self.Clock.to_host(values[2], now) - now
+                else:
+                    values = self.call_with_recovery(self.take_points)[:, 0]
+                    offset = self.trigger_times(values[2:3])[0] - now
+                currTime += offset
+                currGlobalTime += offset
+                if reducer is None:
+                    data.append(values[0], values[1], currTime,
+                                currGlobalTime)
+                    self.notify('points_taken', index, data.tail(index, 1))
+                else:
+                    store_([[values[0], values[1], currTime,
+                             currGlobalTime]])
+                if not taken:
+                    firstTime = currTime
+                taken += 1
+                lastTime = currTime
+                if Strategy == 'Trace':
+                    self.sleep(PointDelay)
+                    continue
+                # Wait for the time of the next point.
+                nextTime += PointDelay
+                wait = nextTime - self.clock()
+                if wait > 0:
+                    self.sleep(wait)
+                else:
+                    nextTime -= wait
+            if reducer is not None:
+                # The last points taken that the reducer did not keep go
+                # in among the kept ones, in time order.
+                rows = reducer.flush()
+                if len(rows):
+                    data.merge_rows(rows)
+                    self.notify('points_taken', index, rows)
+                data.Reduction.append(reducer.describe())
+            if self.Interruption is not None and not self.StopRequested:
+                interrupt_(index, setPoint, StartTime)
+            count = data.count(index)
+            achieved = ((lastTime - firstTime) / (taken - 1) if taken > 1
+                        else None)
+            self.AcquisitionReport.append({
+                'SetPoint': setPoint, 'Strategy': Strategy,
+                'Requested': PointDelay,
+                'Predicted': predictions[PointDelay],
+                'Achieved': achieved, 'Points': count,
+                'PulseWidth': pulseWidth,
+                'TimeSource': ('Trigger' if Strategy != 'Read' else
+                               'Host' if self.Clock is None else 'SMU'),
+                'Recoveries': [recovery['Duration'] for recovery in
+                               self.Recoveries[recoveries:]]})
+            log.info('Setpoint %g: %d points, predicted period %s s, '
+                     'achieved %s s.', setPoint, count,
+                     predictions[PointDelay],
+                     achieved)
+            if journal is not None:
+                journal.finish_setpoint(index, self.AcquisitionReport[-1],
+                                        data.Reduction[-1] if reducer
+                                        else None)
+            self.notify('setpoint_finished', index, data[index])
+
+        self.AcquisitionReport = []
+        data = RunData(self.DataType)
+        reducer = self.Reduction
+        start = 0
+        if Resume is not None:
+            # Keep the finished setpoints and run the rest, with the
+            # global time carrying on from the start of the run.
+            start = Resume['Finished']
+            for key in range(start):
+                data.start_setpoint(Resume['Data'].SetPoints[key])
+                data.append_rows(Resume['Data'][key])
+                if adaptive is not None:
+                    adaptive.add_result(data.SetPoints[key], data[key])
+            if reducer is not None:
+                data.Reduction = list(Resume['Reduction'][:start])
+            self.AcquisitionReport = list(Resume['Report'][:start])
+            elapsed = time.time() - Resume['Wall']
+            globalStartTime -= max([elapsed] +
+                                   data.table()[-1:, 3].tolist())
+        if self.Journal:
+            journal = RunJournal(self.Journal, Resume=Resume is not None)
+            journal.start_run(plan, savedKWARGS, self.RunArgs, Strategy,
+                              start if Resume is not None else None,
+                              adaptive.to_dict() if adaptive else None)
+            self.Listeners.append(journal)
+        if self.Auxiliary is not None:
+            self.Auxiliary.attach(self.clock)
+            self.Listeners.append(self.Auxiliary)
+        if adaptive is not None:
+            self.Listeners.append(adaptive)
+            steps = enumerate(adaptive.steps(savedKWARGS), start)
+        else:
+            steps = enumerate(zip(SweepPath, plan['Dwell'].tolist(),
+                                  plan['PointDelay'].tolist()))
+        try:
+            self.notify('run_started', SweepPath, self.KWARGS)
+            try:
+                for index, (setPoint, length, delay) in steps:
+                    if self.StopRequested:
+                        log.info('slow_chrono stopped before setpoint %d.',
+                                 index)
+                        break
+                    if index >= start:
+                        take_points_(index, setPoint, length, delay)
+            finally:
+                if self.Pulsing:
+                    self.end_pulse()
+                self.source_on('OFF')
+                if Strategy != 'Trace':
+                    self.KWARGS.update(savedKWARGS)
+                    self.configure_chrono_trigger()
+                    self.reset_buffer()
+            data.trim()
+            self.notify('run_finished', data)
+        finally:
+            self.StopRequested = False
+            if self.Auxiliary is not None:
+                self.Auxiliary.stop()
+                self.Listeners.remove(self.Auxiliary)
+            if adaptive is not None:
+                self.Listeners.remove(adaptive)
+            if journal is not None:
+                self.Listeners.remove(journal)
+                journal.close()
+        if adaptive is not None:
+            SweepPath = list(data.SetPoints)
+        if RecordData == "Yes":
+            runArgs = self.RunArgs
+            extra = None
+            if self.Auxiliary is not None:
+                runArgs = dict(runArgs, **self.Auxiliary.solution_info())
+                extra = self.Auxiliary.extra_columns(data)
+            fm.record_data_files(data, SweepPath, runArgs,
+                                 Catalog=self.Catalog,
+                                 Compression=self.Compression, Extra=extra,
+                                 Ranges=self.measure_ranges())
+        else:
+            return data
+
+    def multiplexed_chrono(self, Switch, Cells, RecordData='No'):
+        """Run chrono sweeps on several cells through a switch card.
+
+        Switch is a switching.SwitchCard and Cells a list of
+        dictionaries, one for each cell, with the Channel of the cell
+        on the switch, its SweepPath (a list of setpoints, a
+        sweeps.Sweep or a plan, see slow_chrono) and optionally its
+        RunArgs, the changes to self.RunArgs for its files (the files
+        of the cells must get different names).
+
+        The points of the cells are interleaved by a
+        switching.MultiplexScheduler: every point is taken (the way
+        take_points does) from the cell whose point is due first,
+        allowing for the time a switch takes. The output is turned off
+        for every switch so the relays never switch current, and a
+        switch is made while waiting for the point it is for. When
+        the cells want points faster than they can be taken, each
+        visit to a cell takes several points to keep the time spent
+        switching down. Returns
+        a list of a datastore.RunData for each cell, or records the
+        files of each cell, and keeps the number of switches and the
+        time spent switching and waiting in self.MultiplexReport.
+        request_stop ends the run early.
+        """
+        plans = [sweeps.make_plan(cell['SweepPath'], self.KWARGS)
+                 for cell in Cells]
+        runArgs = []
+        for cell in Cells:
+            args = dict(self.RunArgs)
+            args['SourceMode'] = self.KWARGS['SourceMode']
+            args.update(cell.get('RunArgs', {}))
+            runArgs.append(args)
+        if RecordData == 'Yes':
+            names = [fm.make_filenames(plan['SetPoint'].tolist(), args)[0]
+                     for plan, args in zip(plans, runArgs)]
+            if len(set(names)) < len(names):
+                raise error('The cells would be recorded to the same files; '
+                            'give them different RunArgs.')
+        scheduler = MultiplexScheduler(plans, Switch.SwitchTime)
+        data = [RunData(self.DataType) for cell in Cells]
+        self.KWARGS['TriggerCount'] = 1
+        self.setup_simple_experiment()
         self.source_on('OFF')
+        switches = Switch.Switches
+        switching = idle = 0.
+        connected = None
+        globalStartTime = self.clock()
+        scheduler.start(globalStartTime)
+        try:
+            while not self.StopRequested:
+                cell = scheduler.next_cell(connected, self.clock())
+                if cell is None:
+                    break
+                _, setPoint, _, _ = scheduler.step(cell)
+                first = scheduler.first_point(cell)
+                if cell != connected:
+                    start = self.clock()
+                    self.source_on('OFF')
+                    Switch.connect(Cells[cell]['Channel'])
+                    switching += self.clock() - start
+                    scheduler.SwitchTime = Switch.SwitchTime
+                    connected = cell
+                wait = scheduler.Due[cell] - self.clock()
+                if wait > 0:
+                    idle += wait
+                    self.sleep(wait)
+                if first or self.OutputState != 'ON':
+                    self.set_output(setPoint)
+                    self.source_on('ON')
+                if first:
+                    data[cell].start_setpoint(setPoint)
+                values = self.call_with_recovery(self.take_points)[:, 0]
+                now = self.trigger_times(values[2:3])[0]
+                stepStart = now if first else scheduler.StepStart[cell]
+                data[cell].append(values[0], values[1], now - stepStart,
+                                  now - globalStartTime)
+                scheduler.point_taken(cell, now)
+        finally:
+            self.StopRequested = False
+            self.source_on('OFF')
+            Switch.open_all()
+        for cellData in data:
+            cellData.trim()
+        self.MultiplexReport = {'Switches': Switch.Switches - switches,
+                                'SwitchTime': switching, 'Idle': idle,
+                                'Duration': self.clock() - globalStartTime}
+        log.info('multiplexed_chrono: %(Switches)d switches taking '
+                 '%(SwitchTime).3g s and %(Idle).3g s idle in %(Duration).3g '
+                 's.', self.MultiplexReport)
         if RecordData == "Yes":
-            fm.record_data_files(data, SweepPath, self.RunArgs)
+            for cellData, args in zip(data, runArgs):
+                fm.record_data_files(cellData, list(cellData.SetPoints),
+                                     args, Catalog=self.Catalog,
+                                     Compression=self.Compression,
+                                     Ranges=self.measure_ranges())
         else:
             return data
@@ -0,0 +1,253 @@
+"""Multi-resolution overviews of chrono files.
+
+Looking at a long chrono file should not mean loading every row. An
+overview is a directory written next to the file (filename +
+OVERVIEW_SUFFIX) holding a set of levels that each group the rows
+into buckets of Factor rows (x16.npy, x256.npy, ...) with the time
+span, count and the min, max and mean voltage and current of each
+bucket. Every level is built from the one below it, so writing the
+overview is a few vectorized passes over the data. The rows
+themselves are not copied: for a plain text file the overview keeps
+the byte offset of the first row of every bucket of the finest level
+(rows.npy), so the rows of a window are parsed straight from the
+file.
+
+read_overview returns the coarsest level that still has a bucket per
+pixel for a time window and a plot width. The levels are memory
+mapped, so only the buckets in the window are read from disk and the
+time it takes does not depend on the size of the file (a window too
+short for any level of a compressed file or archive, which can not
+be read from the middle, reads the whole file):
+
+    view = read_overview(filename, Start=3600, End=7200, Width=800)
+    plot(view['Time'], view['VoltageMin'], view['Time'],
+         view['VoltageMax'])
+
+record_data_files writes the overviews of the chrono files it writes
+and read_overview (re)builds a missing or out of date overview from
+the data file.
+"""
+
+import bisect
+import glob
+import mmap
+import os
+import re
+import numpy as np
+import filemanipulation as fm
+import archive
+
+OVERVIEW_SUFFIX = '.overview'
+# Rows per bucket of the first level and between levels.
+FACTOR = 16
+LEVELS = 6
+# record_data_files only writes overviews of files at least this long;
+# shorter ones are quick to read whole (read_overview still works).
+MIN_ROWS = 4096
+OVERVIEW_DTYPE = np.dtype([
+    ('Start', 'f8'), ('End', 'f8'), ('Count', 'i8'),
+    ('VoltageMin', 'f8'), ('VoltageMax', 'f8'), ('VoltageMean', 'f8'),
+    ('CurrentMin', 'f8'), ('CurrentMax', 'f8'), ('CurrentMean', 'f8')])
+VOLTAGE = 0
+CURRENT = 1
+TIME = 2  # Local time
+
+
+def _raw_level(data):
+    """Make level 1 (every row its own bucket) from an (n, 4) array."""
+    level = np.zeros(len(data), dtype=OVERVIEW_DTYPE)
+    level['Start'] = level['End'] = data[:, TIME]
+    level['Count'] = 1
+    for name, column in (('Voltage', VOLTAGE), ('Current', CURRENT)):
+        for stat in ('Min', 'Max', 'Mean'):
+            level[name + stat] = data[:, column]
+    return level
+
+
+def _reduce_level(level, factor):
+    """Group the buckets of a level factor at a time."""
+    starts = np.arange(0, len(level), factor)
+    out = np.zeros(len(starts), dtype=OVERVIEW_DTYPE)
+    out['Start'] = level['Start'][starts]
+    out['End'] = level['End'][np.minimum(starts + factor, len(level)) - 1]
+    out['Count'] = np.add.reduceat(level['Count'], starts)
+    for name in ('Voltage', 'Current'):
+        out[name + 'Min'] = np.minimum.reduceat(level[name + 'Min'], starts)
+        out[name + 'Max'] = np.maximum.reduceat(level[name + 'Max'], starts)
+        out[name + 'Mean'] = np.add.reduceat(
+            level[name + 'Mean'] * level['Count'], starts) / out['Count']
+    return out
+
+
+def build_levels(data, Factor=FACTOR, Levels=LEVELS):
+    """Return the overview levels of an (n, 4) array by factor.
+
+    Levels with fewer than two buckets are left out.
+    """
+    data = np.asarray(data)
+    levels = {}
+    level = _raw_level(data)
+    factor = 1
+    for _ in range(Levels):
+        if len(level) < 2 * Factor:
+            break
+        level = _reduce_level(level, Factor)
+        factor *= Factor
+        levels[factor] = level
+    return levels
+
+
+def overview_path(filename):
+    """Directory the overview of filename is kept in."""
+    return filename + OVERVIEW_SUFFIX
+
+
+def _is_plain(filename):
+    """True if filename is a plain (uncompressed) text data file."""
+    with open(filename, 'rb') as f:
+        magic = f.read(6)
+    return not (magic.startswith(archive.ZIP_MAGIC) or
+                magic.startswith(b'\x1f\x8b') or magic == b'\xfd7zXZ\x00')
+
+
+def row_offsets(filename, Rows, Every=FACTOR, Chunk=1 << 24):
+    """Byte offsets of every Every-th row of a plain text data file.
+
+    The offsets (of rows 0, Every, 2 * Every, ...) are followed by the
+    end of the rows, so the rows of buckets first to last of a level
+    of factor Every are the bytes from offsets[first] to
+    offsets[last]. The file is scanned through a memory map, Chunk
+    bytes at a time. Returns None if the file does not have Rows rows.
+    """
+    with open(filename, 'rb') as f:
+        text = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        start = text.find(b'\n' + fm.COLUMN_LINE.encode('latin-1'))
+        if start < 0:
+            return None
+        start = text.find(b'\n', start + 1) + 1
+        end = text.find(b'\n' + fm.SECTION_LINE.encode('latin-1'), start)
+        if end < 0:
+            end = len(text)
+        starts = [np.array([start])]
+        for pos in range(start, end, Chunk):
+            chunk = np.frombuffer(text, np.uint8, min(Chunk, end - pos), pos)
+            starts.append(np.flatnonzero(chunk == ord('\n')) + pos + 1)
+            # The map can not be closed while a view of it is left.
+            del chunk
+    finally:
+        text.close()
+    starts = np.concatenate(starts)
+    starts = starts[starts < end]
+    if len(starts) != Rows:
+        return None
+    return np.append(starts[::Every], end).astype(np.int64)
+
+
+def _read_rows(filename, offsets, first, last):
+    """Parse the rows of buckets first to last from the data file."""
+    with open(filename, 'rb') as f:
+        f.seek(offsets[first])
+        body = f.read(int(offsets[last] - offsets[first]))
+    body = body.decode('latin-1').replace('\r', '').strip()
+    return fm.parse_rows(body, len(fm.read_header(filename)['Columns']))
+
+
+def write_overview(filename, data, Factor=FACTOR, Levels=LEVELS):
+    """Write the overview of a data file from its data.
+
+    data is the (n, 4) array that was written to filename.
+    """
+    path = overview_path(filename)
+    fm.ensure_dir(path, isfile='No')
+    for old in glob.glob(os.path.join(path, '*.npy')):
+        os.remove(old)
+    levels = build_levels(data, Factor, Levels)
+    for factor, level in levels.items():
+        np.save(os.path.join(path, 'x%d.npy' % factor), level)
+    if levels and _is_plain(filename):
+        offsets = row_offsets(filename, len(data), min(levels))
+        if offsets is not None:
+            np.save(os.path.join(path, 'rows.npy'), offsets)
+    # Written last: the overview is valid for this version of the file.
+    np.save(os.path.join(path, 'key.npy'), fm.cache_key(filename))
+
+
+def _is_current(filename):
+    """True if the overview of filename exists and is up to date."""
+    try:
+        key = np.load(os.path.join(overview_path(filename), 'key.npy'))
+    except (IOError, OSError, ValueError):
+        return False
+    return np.array_equal(key, fm.cache_key(filename))
+
+
+def open_overview(filename):
+    """Open the overview of a data file, building it if needed.
+
+    Returns the row offsets (see row_offsets, None if the overview has
+    none) and a dictionary of the memory mapped levels by factor.
+    """
+    if not _is_current(filename):
+        _, data = fm.read_data(filename)
+        write_overview(filename, data)
+    path = overview_path(filename)
+    try:
+        offsets = np.load(os.path.join(path, 'rows.npy'), mmap_mode='r')
+    except (IOError, OSError):
+        offsets = None
+    levels = {}
+    for name in glob.glob(os.path.join(path, 'x*.npy')):
+        factor = int(re.match(r'x(\d+)\.npy$', os.path.basename(name))
+                     .group(1))
+        levels[factor] = np.load(name, mmap_mode='r')
+    return offsets, levels
+
+
+def _window(starts, ends, Start, End):
+    """Slice of the buckets that overlap [Start, End].
+
+    bisect only reads the log(n) values it compares, where
+    np.searchsorted would copy the whole (strided, memory mapped)
+    column first.
+    """
+    first = 0 if Start is None else bisect.bisect_left(ends, Start)
+    last = len(starts) if End is None else bisect.bisect_right(starts, End)
+    return first, last
+
+
+def read_overview(filename, Start=None, End=None, Width=1000):
+    """Read a data file at the resolution needed for a plot.
+
+    Start and End are the time window (local time, s; None for the
+    start or end of the file) and Width the number of pixels (or
+    points) wanted. The coarsest level with at least Width buckets in
+    the window is used, and the raw rows if there is none. Returns a
+    dictionary with the Factor (rows per bucket) and, for every
+    bucket, Time (middle of the bucket), Start, End, Count and the
+    Min, Max and Mean of the Voltage and Current.
+    """
+    offsets, levels = open_overview(filename)
+    for factor in sorted(levels, reverse=True):
+        level = levels[factor]
+        first, last = _window(level['Start'], level['End'], Start, End)
+        if last - first >= Width:
+            view = np.array(level[first:last])
+            break
+    else:
+        factor = 1
+        if offsets is not None:
+            # Only the rows of the buckets of the finest level that
+            # overlap the window.
+            level = levels[min(levels)]
+            first, last = _window(level['Start'], level['End'], Start, End)
+            rows = _read_rows(filename, offsets, first, last)
+        else:
+            _, rows = fm.read_data(filename)
+        times = rows[:, TIME]
+        first, last = _window(times, times, Start, End)
+        view = _raw_level(rows[first:last])
+    out = dict((name, view[name]) for name in OVERVIEW_DTYPE.names)
+    out['Time'] = 0.5 * (view['Start'] + view['End'])
+    out['Factor'] = factor
+    return out
@@ -0,0 +1,225 @@
+"""On the fly reduction of chrono data.
+
+Once a setpoint has settled, most of the points slow_chrono takes are
+the same to within the noise. The filters here drop those points as
+they are taken while keeping every point of a transient, with a
+guaranteed bound on the error of the points that were dropped:
+
+Deadband: a point is kept when its voltage or current differs from
+    the last kept point by more than the band. Every dropped point is
+    within the band of the last kept point before it (sample and
+    hold).
+SwingingDoor: a point is kept when the straight line from the last
+    kept point can no longer pass within the band of all of the points
+    since. Every dropped point is within the band of the straight line
+    between the kept points on either side of it (linear
+    interpolation), which keeps far fewer points on slow drifts.
+
+A band of 0 leaves that column out, so the source column (which only
+changes with the setpoint) can be ignored by giving it no band; at
+least one band has to be set.
+
+Either way the last Tail points taken of every setpoint are kept (the
+two that generate_ss_array averages by default, so the steady state is
+the same as without a reduction): flush gives the ones of them that
+were not kept, to be merged into the setpoint in time order (see
+datastore.RunData.merge_rows). MaxGap (s), if given,
+forces a point to be kept at least that often. Set
+SMUExperiments.Reduction to a filter to use it in slow_chrono; the
+points taken and kept are recorded in the headers of the files.
+"""
+
+from collections import deque
+import numpy as np
+
+VOLTAGE = 0
+CURRENT = 1
+LOCAL_TIME = 2
+
+
+class Deadband(object):
+
+    """Deadband (sample and hold) reduction.
+
+    VoltageBand (V) and CurrentBand (A) are the largest changes that
+    are not stored. A band of 0 (the default) ignores that column; at
+    least one of the bands has to be set.
+    """
+
+    Method = 'deadband'
+
+    def __init__(self, VoltageBand=0., CurrentBand=0., MaxGap=None,
+                 Tail=2):
+        self.VoltageBand = float(VoltageBand)
+        self.CurrentBand = float(CurrentBand)
+        if self.VoltageBand <= 0 and self.CurrentBand <= 0:
+            raise ValueError('A reduction needs a VoltageBand or a '
+                             'CurrentBand.')
+        self.MaxGap = MaxGap
+        self.Tail = max(int(Tail), 1)
+        # An infinite band never keeps a point for its column.
+        self.band = np.array([self.VoltageBand, self.CurrentBand])
+        self.band[self.band <= 0] = np.inf
+        self.reset()
+
+    def reset(self):
+        """Start a new setpoint."""
+        self.last = None   # Last kept row
+        # Last rows taken since the last kept row.
+        self.recent = deque(maxlen=self.Tail)
+        # Last Tail rows taken, kept or not, as [row, kept].
+        self.tail = deque(maxlen=self.Tail)
+        self.PointsTaken = 0
+        self.PointsKept = 0
+
+    @property
+    def held(self):
+        """The last row taken if it was not kept."""
+        return self.recent[-1] if self.recent else None
+
+    def _take(self, row):
+        """Count a row taken and add it to the tail."""
+        self.PointsTaken += 1
+        self.tail.append([row, False])
+
+    def _keep_row(self, kept, row):
+        kept.append(row)
+        self.last = row
+        self.recent.clear()
+        for entry in self.tail:
+            if entry[0] is row:
+                entry[1] = True
+
+    def _gap(self, row):
+        return (self.MaxGap is not None and
+                row[LOCAL_TIME] - self.last[LOCAL_TIME] >= self.MaxGap)
+
+    def _keep(self, row):
+        """Return True if row has to be kept."""
+        return (np.any(np.abs(row[:2] - self.last[:2]) > self.band) or
+                self._gap(row))
+
+    def filter(self, rows):
+        """Return the rows out of rows that have to be kept."""
+        rows = np.asarray(rows, dtype=float)
+        kept = []
+        for row in rows:
+            self._take(row)
+            if self.last is None or self._keep(row):
+                self._keep_row(kept, row)
+            else:
+                self.recent.append(row)
+        self.PointsKept += len(kept)
+        return np.array(kept).reshape(-1, rows.shape[1])
+
+    def flush(self):
+        """Return the last Tail rows taken that were not kept.
+
+        The rows are in the order they were taken, but kept rows taken
+        after them may already have been stored.
+        """
+        rows = [row for row, kept in self.tail if not kept]
+        rows = np.array(rows) if rows else np.zeros((0, 4))
+        if len(rows):
+            self.last = rows[-1]
+        self.recent.clear()
+        self.tail.clear()
+        self.PointsKept += len(rows)
+        return rows
+
+    def describe(self):
+        """Return the settings and the points taken and kept."""
+        return {'Method': self.Method, 'VoltageBand': self.VoltageBand,
+                'CurrentBand': self.CurrentBand, 'MaxGap': self.MaxGap,
+                'PointsTaken': self.PointsTaken,
+                'PointsKept': self.PointsKept}
+
+
+class SwingingDoor(Deadband):
+
+    """Swinging door reduction.
+
+    The door is the range of slopes of the lines from the last kept
+    point that pass within the bands of every point since. A point is
+    dropped while the line from the last kept point to it stays inside
+    the door; once it does not, the previous point is kept and the door
+    starts again from there.
+    """
+
+    Method = 'swinging door'
+
+    def reset(self):
+        Deadband.reset(self)
+        self.low = np.full(2, -np.inf)
+        self.high = np.full(2, np.inf)
+
+    def _open(self, row):
+        """Narrow the door with the bands of row."""
+        dt = row[LOCAL_TIME] - self.last[LOCAL_TIME]
+        change = row[:2] - self.last[:2]
+        self.low = np.maximum(self.low, (change - self.band) / dt)
+        self.high = np.minimum(self.high, (change + self.band) / dt)
+
+    def _fits(self, row):
+        """True if the line from the last kept point to row fits."""
+        dt = row[LOCAL_TIME] - self.last[LOCAL_TIME]
+        if dt <= 0:
+            return False
+        slope = (row[:2] - self.last[:2]) / dt
+        return np.all((slope >= self.low) & (slope <= self.high))
+
+    def filter(self, rows):
+        rows = np.asarray(rows, dtype=float)
+        kept = []
+        for row in rows:
+            self._take(row)
+            if self.last is None:
+                self._keep_row(kept, row)
+                continue
+            if self.held is not None and (not self._fits(row) or
+                                          self._gap(row)):
+                # The held row is the last one the line can end on.
+                self._keep_row(kept, self.held)
+                self.low[:] = -np.inf
+                self.high[:] = np.inf
+            if row[LOCAL_TIME] <= self.last[LOCAL_TIME]:
+                self._keep_row(kept, row)
+                continue
+            self._open(row)
+            self.recent.append(row)
+        self.PointsKept += len(kept)
+        return np.array(kept).reshape(-1, rows.shape[1])
+
+    def flush(self):
+        rows = Deadband.flush(self)
+        self.low[:] = -np.inf
+        self.high[:] = np.inf
+        return rows
+
+
+METHODS = {Deadband.Method: Deadband, SwingingDoor.Method: SwingingDoor}
+
+
+def make_filter(Method, VoltageBand=0., CurrentBand=0., MaxGap=None,
+                Tail=2):
+    """Make a filter by its Method name (None or '' for no filter)."""
+    if not Method:
+        return None
+    return METHODS[Method](VoltageBand, CurrentBand, MaxGap, Tail)
+
+
+def combine(Descriptions):
+    """Combine the describe() of several setpoints into one."""
+    Descriptions = [d for d in Descriptions if d]
+    if not Descriptions:
+        return None
+    total = dict(Descriptions[0])
+    total['PointsTaken'] = sum(d['PointsTaken'] for d in Descriptions)
+    total['PointsKept'] = sum(d['PointsKept'] for d in Descriptions)
+    return total
+
+
+def compression_ratio(Description):
+    """Points taken per point kept."""
+    return Description['PointsTaken'] / float(max(Description['PointsKept'],
+                                                  1))
@@ -0,0 +1,283 @@
+"""Aggregation of replicate runs.
+
+Each membrane/salt/concentration condition is usually run several times
+(RunArgs['RunNumber']). The functions here find the replicate runs of a
+condition (from the names make_filenames gives the files, or from a
+catalog.RunCatalog), line up their steady state I-V curves by setpoint
+and compute the mean, standard deviation and confidence interval of
+the voltage and current at every setpoint:
+
+    groups = find_replicates('C:\\data', MembraneID='AmB')
+    for condition, runs in groups.items():
+        summarize_replicates(runs)
+
+summarize_replicates writes the result to a summary file next to the
+runs (see summary_filename) and keeps the steady state curve of every
+replicate in a cache next to it, so running it again after a new
+replicate was recorded (or one was rewritten) only reads the runs that
+changed.
+"""
+
+import json
+import os
+import numpy as np
+import filemanipulation as fm
+import analysis
+import sweeps
+
+try:
+    from scipy import stats
+except ImportError:
+    stats = None
+
+# Filename keys that make up a condition (everything but the time
+# stamp and the run number).
+CONDITION_KEYS = ('SourceMode', 'MembraneID', 'Salt', 'HighConcentration',
+                  'LowConcentration')
+# Two sided 95% quantiles of Student's t for 1 to 30 degrees of freedom
+# (used when scipy is not installed).
+T_95 = np.array([
+    12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228,
+    2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086,
+    2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042])
+NORMAL_95 = 1.960
+CACHE_SUFFIX = '.replicates.json'
+SUMMARY_COLUMNS = ('SetPoint', 'N', 'Voltage', 'VoltageStd', 'VoltageCI',
+                   'Current', 'CurrentStd', 'CurrentCI')
+
+
+def condition_of(SSFilename):
+    """Return the condition (a tuple of CONDITION_KEYS) of a run."""
+    info = fm.parse_filename(SSFilename)
+    if info is None or info['FileType'] != 'SS':
+        raise ValueError('%s is not a steady state file.' % SSFilename)
+    return tuple(info[key] for key in CONDITION_KEYS)
+
+
+def _run_order(SSFilename):
+    info = fm.parse_filename(SSFilename)
+    return (info['RunNumber'], info['Timestamp'])
+
+
+def find_replicates(Root=None, Catalog=None, **Condition):
+    """Group the runs below Root (or in Catalog) by condition.
+
+    Condition narrows the runs down by any of CONDITION_KEYS. Returns
+    a dictionary from the condition tuple to the list of steady state
+    files of its replicates, ordered by run number.
+    """
+    for key in Condition:
+        if key not in CONDITION_KEYS:
+            raise KeyError('Can not group replicates by %s.' % key)
+    if Catalog is not None:
+        filenames = [run['ss_path'] for run in
+                     Catalog.find_runs(**Condition)]
+    elif Root is not None:
+        filenames = []
+        for dirPath, _, files in os.walk(Root):
+            filenames.extend(os.path.join(dirPath, name) for name in files
+                             if (fm.parse_filename(name) or {}).get(
+                                 'FileType') == 'SS')
+    else:
+        raise ValueError('find_replicates needs a Root or a Catalog.')
+    # Compare the way parse_filename gives the values.
+    wanted = [(CONDITION_KEYS.index(key), fm.to_number(str(value))
+               if key.endswith('Concentration') else str(value))
+              for key, value in Condition.items()]
+    groups = {}
+    for filename in filenames:
+        condition = condition_of(filename)
+        if all(condition[index] == value for index, value in wanted):
+            groups.setdefault(condition, []).append(filename)
+    for runs in groups.values():
+        runs.sort(key=_run_order)
+    return groups
+
+
+def replicate_curve(SSFilename, Window=None, nPoints=2):
+    """Return the setpoints, voltages and currents of one run.
+
+    Without a Window the steady state file is used as written;
+    otherwise the steady state is computed again from the chrono files
+    over the last Window seconds of each setpoint (see
+    analysis.steady_state).
+    """
+    header, table = fm.read_data(SSFilename)
+    setPoints = np.array(header['SweepPath'], dtype=float)
+    if Window is not None:
+        data, _ = analysis.load_sweep(SSFilename)
+        ss = analysis.steady_state(data, Window, nPoints)
+        voltage, current = ss['Voltage'], ss['Current']
+    else:
+        voltage, current = table[:, 0], table[:, 1]
+    count = min(len(setPoints), len(voltage))
+    return setPoints[:count], voltage[:count], current[:count]
+
+
+def t_quantile(DegreesOfFreedom, Confidence=0.95):
+    """Two sided quantiles of Student's t.
+
+    DegreesOfFreedom is an array; the quantile is nan where it is
+    less than one.
+    """
+    df = np.asarray(DegreesOfFreedom, dtype=float)
+    if stats is not None:
+        with np.errstate(invalid='ignore'):
+            return np.where(df > 0, stats.t.ppf(0.5 + Confidence / 2.,
+                                                np.maximum(df, 1)), np.nan)
+    if Confidence != 0.95:
+        raise ValueError('Confidence levels other than 0.95 need scipy.')
+    out = np.full(df.shape, NORMAL_95)
+    out[df < 1] = np.nan
+    small = (df >= 1) & (df <= len(T_95))
+    out[small] = T_95[df[small].astype(int) - 1]
+    return out
+
+
+def _statistics(values):
+    """Mean, sample standard deviation and count of every column.
+
+    values is a (replicates, setpoints) array; nan is left out.
+    """
+    have = ~np.isnan(values)
+    count = have.sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(have, values, 0).sum(axis=0) / count
+        dev = np.where(have, values - mean, 0) ** 2
+        std = np.sqrt(dev.sum(axis=0) / (count - 1))
+    std[count < 2] = np.nan
+    return mean, std, count
+
+
+def _mean_by(index, values, count):
+    """Mean of the values with each index (nan left out)."""
+    values = np.asarray(values, dtype=float)
+    have = ~np.isnan(values)
+    sums = np.bincount(index[have], values[have], minlength=count)
+    counts = np.bincount(index[have], minlength=count)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return sums / counts
+
+
+def _read_cache(CacheFile):
+    try:
+        with open(CacheFile) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def aggregate_replicates(SSFilenames, Window=None, nPoints=2,
+                         Confidence=0.95, CacheFile=None):
+    """Aggregate the steady state curves of replicate runs.
+
+    The curves (see replicate_curve) are lined up by setpoint; a
+    setpoint missing from a run is left out of its statistics and one
+    a run went through more than once (a sweep there and back) counts
+    once, with the mean of its values in the run. If
+    CacheFile is given, the curves are kept in it and only the runs
+    whose files changed since are read again. Returns a dictionary of
+    arrays with an entry per setpoint (SetPoint, N and the mean,
+    standard deviation and half width of the Confidence interval of
+    the Voltage and Current) plus the Replicates (the files) and
+    Recomputed (the files that were read).
+    """
+    cache = _read_cache(CacheFile) if CacheFile else {}
+    settings = [Window, nPoints]
+    curves = []
+    recomputed = []
+    for filename in SSFilenames:
+        key = fm.cache_key(filename).tolist()
+        entry = cache.get(filename)
+        if (entry is None or entry['Key'] != key or
+                entry['Settings'] != settings):
+            setPoints, voltage, current = replicate_curve(filename, Window,
+                                                          nPoints)
+            entry = {'Key': key, 'Settings': settings,
+                     'SetPoint': setPoints.tolist(),
+                     'Voltage': voltage.tolist(),
+                     'Current': current.tolist()}
+            recomputed.append(filename)
+        cache[filename] = entry
+        curves.append(entry)
+    if CacheFile:
+        cache = dict((filename, cache[filename]) for filename in SSFilenames)
+        with open(CacheFile, 'w') as f:
+            json.dump(cache, f)
+    # Line the curves up on the union of their (rounded) setpoints.
+    rounded = [np.array(sweeps.round_setpoints(curve['SetPoint']))
+               for curve in curves]
+    setPoints = (np.unique(np.concatenate(rounded)) if rounded
+                 else np.zeros(0))
+    shape = (len(curves), len(setPoints))
+    voltage = np.full(shape, np.nan)
+    current = np.full(shape, np.nan)
+    for row, (curve, values) in enumerate(zip(curves, rounded)):
+        values, index = np.unique(values, return_inverse=True)
+        columns = np.searchsorted(setPoints, values)
+        voltage[row, columns] = _mean_by(index, curve['Voltage'],
+                                         len(values))
+        current[row, columns] = _mean_by(index, curve['Current'],
+                                         len(values))
+    out = {'SetPoint': setPoints, 'Replicates': list(SSFilenames),
+           'Recomputed': recomputed, 'Confidence': Confidence}
+    for name, values in (('Voltage', voltage), ('Current', current)):
+        mean, std, count = _statistics(values)
+        out[name] = mean
+        out[name + 'Std'] = std
+        out[name + 'CI'] = (t_quantile(count - 1, Confidence) * std /
+                            np.sqrt(count))
+    out['N'] = count
+    return out
+
+
+def summary_filename(SSFilenames, Directory=None):
+    """Name of the summary file of a group of replicates.
+
+    The name is made from the condition the way make_filenames makes
+    run names, with AV for the file type and no time stamp or run
+    number, in Directory (the directory of the first run by default).
+    """
+    info = fm.parse_filename(SSFilenames[0])
+    if Directory is None:
+        Directory = os.path.dirname(SSFilenames[0])
+    name = '%s_AV_%s_%s_%sp%s.csv' % (
+        'i' if info['SourceMode'] == 'CURR' else 'v', info['MembraneID'],
+        info['Salt'], info['HighConcentration'], info['LowConcentration'])
+    return os.path.join(Directory, name)
+
+
+def write_summary(filename, Summary):
+    """Write the result of aggregate_replicates to a CSV file."""
+    info = fm.parse_filename(Summary['Replicates'][0])
+    header = [os.path.basename(filename), 'Data Type,Replicate Summary',
+              'Source Mode,%s' % info['SourceMode'],
+              'Membrane ID,%s' % info['MembraneID'],
+              'Salt,%s' % info['Salt'],
+              'High Concentration (M),%s' % info['HighConcentration'],
+              'Low Concentration (M),%s' % info['LowConcentration'],
+              'Confidence,%s' % Summary['Confidence'],
+              'Replicates,%d' % len(Summary['Replicates'])]
+    header.extend('Run %s,%s' % (fm.parse_filename(name)['RunNumber'],
+                                 os.path.basename(name))
+                  for name in Summary['Replicates'])
+    header.append(','.join(SUMMARY_COLUMNS))
+    table = np.column_stack([Summary[column] for column in SUMMARY_COLUMNS])
+    fm.ensure_dir(filename)
+    with open(filename, 'w') as f:
+        np.savetxt(f, table, delimiter=',', header='\n'.join(header),
+                   comments='')
+    return filename
+
+
+def summarize_replicates(SSFilenames, Directory=None, **kwargs):
+    """Aggregate a group of replicates and write its summary file.
+
+    kwargs are passed to aggregate_replicates; the curves are cached
+    next to the summary file. Returns the summary filename and the
+    aggregate.
+    """
+    filename = summary_filename(SSFilenames, Directory)
+    kwargs.setdefault('CacheFile', filename + CACHE_SUFFIX)
+    summary = aggregate_replicates(SSFilenames, **kwargs)
+    return write_summary(filename, summary), summary
@@ -0,0 +1,235 @@
+"""Shared memory ring buffer of points.
+
+When acquisition runs in its own process, sending every chunk of
+points to the plot, the file writer and the analysis through pipes
+costs a pickle and a copy per consumer. RingWriter instead writes the
+points as fixed width records (RECORD_DTYPE) into a ring in a memory
+mapped file that any number of RingReaders, in any process, map and
+read in place:
+
+    writer = RingWriter()             # in the acquisition process
+    SMU.Listeners.append(writer)      # slow_chrono writes its points
+    ...
+    reader = RingReader(writer.Filename)   # in each consumer
+    records = reader.read()
+    plot(records['GlobalTime'], records['Voltage'])
+
+Every record carries a sequence number (1 for the first point). The
+writer never waits for the readers: when the ring is full it writes
+over the oldest records. A reader that falls more than the capacity
+behind skips ahead to the oldest record still in the ring and counts
+the records it missed in Missed, so a slow plot only loses points and
+never holds up acquisition.
+
+The writer marks a slot as being written (sequence 0) before it
+changes the values and writes the sequence number last, so a reader
+can tell a record that was overwritten while it read it by its
+sequence number (a seqlock). read copies the records, then reads the
+sequence numbers in the ring again and drops any record whose number
+was not the expected one both before and after the copy.
+read(Copy=False) returns a view of the ring itself (no copy at all)
+and intact tells whether it is still good after use.
+"""
+
+import mmap
+import os
+import tempfile
+import time
+import numpy as np
+
+RECORD_DTYPE = np.dtype([
+    ('Sequence', '<u8'), ('Index', '<u4'), ('Status', '<u4'),
+    ('Voltage', '<f8'), ('Current', '<f8'), ('LocalTime', '<f8'),
+    ('GlobalTime', '<f8')])
+HEADER_DTYPE = np.dtype([('Magic', 'S8'), ('Capacity', '<u8'),
+                         ('RecordSize', '<u8'), ('Head', '<u8'),
+                         ('Reserved', 'V32')])
+MAGIC = b'SMURING1'
+# Records in a ring (3 MB), minutes of points at the fastest rates.
+CAPACITY = 1 << 16
+VALUES = ('Voltage', 'Current', 'LocalTime', 'GlobalTime')
+
+
+def _ring_directory():
+    """Directory for ring files, in memory where there is one."""
+    if os.path.isdir('/dev/shm'):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+
+class _Ring(object):
+
+    """Map a ring file into a header and an array of records."""
+
+    def __init__(self, Filename):
+        self.Filename = Filename
+        with open(Filename, 'r+b') as f:
+            self._map = mmap.mmap(f.fileno(), 0)
+        self._header = np.frombuffer(self._map, HEADER_DTYPE, 1)
+        if (self._header['Magic'][0] != MAGIC or
+                self._header['RecordSize'][0] != RECORD_DTYPE.itemsize):
+            self._map.close()
+            raise ValueError('%s is not a ring buffer.' % Filename)
+        self.Capacity = int(self._header['Capacity'][0])
+        self.records = np.frombuffer(self._map, RECORD_DTYPE, self.Capacity,
+                                     HEADER_DTYPE.itemsize)
+
+    @property
+    def Head(self):
+        """Sequence number of the last record written."""
+        return int(self._header['Head'][0])
+
+    def close(self):
+        # The arrays have to go before the map can be closed; views
+        # still held elsewhere keep it open until they go too.
+        del self._header, self.records
+        try:
+            self._map.close()
+        except BufferError:
+            pass
+
+
+class RingWriter(_Ring):
+
+    """Write points into a new ring buffer.
+
+    Filename defaults to a new file in /dev/shm (or the temporary
+    directory). The writer is a slow_chrono listener: added to
+    SMUExperiments.Listeners, it writes every point that is taken
+    with the index of its setpoint.
+    """
+
+    def __init__(self, Filename=None, Capacity=CAPACITY):
+        if Filename is None:
+            handle, Filename = tempfile.mkstemp('.ring', 'smu',
+                                                _ring_directory())
+            os.close(handle)
+        header = np.zeros(1, HEADER_DTYPE)
+        header['Magic'] = MAGIC
+        header['Capacity'] = Capacity
+        header['RecordSize'] = RECORD_DTYPE.itemsize
+        with open(Filename, 'wb') as f:
+            f.write(header.tobytes())
+            f.truncate(HEADER_DTYPE.itemsize +
+                       Capacity * RECORD_DTYPE.itemsize)
+        _Ring.__init__(self, Filename)
+
+    def write(self, Index, Rows, Status=0):
+        """Write an (n, 4) array of points of setpoint Index."""
+        Rows = np.asarray(Rows)
+        count = len(Rows)
+        if not count:
+            return
+        head = self.Head
+        # Only the last Capacity rows can be in the ring.
+        skip = max(count - self.Capacity, 0)
+        sequences = np.arange(head + skip + 1, head + count + 1)
+        slots = (sequences - 1) % self.Capacity
+        records = self.records
+        records['Sequence'][slots] = 0
+        records['Index'][slots] = Index
+        records['Status'][slots] = Status
+        for column, name in enumerate(VALUES):
+            records[name][slots] = Rows[skip:, column]
+        records['Sequence'][slots] = sequences
+        self._header['Head'] = head + count
+
+    def points_taken(self, Index, Rows):
+        self.write(Index, Rows)
+
+    def close(self, Remove=True):
+        """Unmap the ring and (with Remove) delete its file.
+
+        Readers that have the ring mapped can still read it.
+        """
+        _Ring.close(self)
+        if Remove:
+            os.remove(self.Filename)
+
+
+class RingReader(_Ring):
+
+    """Read the points of a ring buffer.
+
+    A new reader starts at the oldest record in the ring (Start=
+    'oldest') or only reads the records written after it was made
+    (Start='latest').
+    """
+
+    def __init__(self, Filename, Start='oldest'):
+        _Ring.__init__(self, Filename)
+        head = self.Head
+        if Start == 'latest':
+            self.Next = head + 1
+        else:
+            self.Next = max(head - self.Capacity, 0) + 1
+        self.Missed = 0
+        self._last = None
+
+    def available(self):
+        """Number of records written that have not been read."""
+        return max(self.Head - self.Next + 1, 0)
+
+    def wait(self, Timeout=None, Poll=0.005):
+        """Wait for records to read; False if Timeout (s) runs out."""
+        end = None if Timeout is None else time.time() + Timeout
+        while not self.available():
+            if end is not None and time.time() >= end:
+                return False
+            time.sleep(Poll)
+        return True
+
+    def read(self, Count=None, Copy=True):
+        """Read up to Count (default all) of the next records.
+
+        With Copy, the records are copied out of the ring and any that
+        were overwritten while they were read are dropped (and counted
+        in Missed). Without, a view of the ring is returned that only
+        reaches up to the end of the ring (the rest comes with the next
+        read); check it with intact after using it.
+        """
+        head = self.Head
+        oldest = max(head - self.Capacity, 0) + 1
+        if self.Next < oldest:
+            self.Missed += oldest - self.Next
+            self.Next = oldest
+        count = head - self.Next + 1
+        if Count is not None:
+            count = min(count, Count)
+        if count <= 0:
+            return self.records[:0].copy() if Copy else self.records[:0]
+        first = self.Next
+        start = (first - 1) % self.Capacity
+        if Copy:
+            slots = (np.arange(count) + start) % self.Capacity
+            expected = first + np.arange(count)
+            records = self.records[slots]
+            # A slot the writer started on during the copy has a new
+            # (or 0) sequence number now, though the copy has the old.
+            good = ((records['Sequence'] == expected) &
+                    (self.records['Sequence'][slots] == expected))
+            if not good.all():
+                self.Missed += count - int(good.sum())
+                records = records[good]
+        else:
+            count = min(count, self.Capacity - start)
+            records = self.records[start:start + count]
+            self._last = (records, first)
+        self.Next = first + count
+        return records
+
+    def intact(self):
+        """True if the view of the last read(Copy=False) is still good.
+
+        A False means the writer has written over some of its records
+        since, so values read from it may be wrong.
+        """
+        if self._last is None:
+            return True
+        records, first = self._last
+        return np.array_equal(records['Sequence'],
+                              first + np.arange(len(records)))
+
+    def close(self):
+        self._last = None
+        _Ring.close(self)
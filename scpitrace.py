@@ -0,0 +1,343 @@
+"""Record and replay of the SCPI traffic of a SourceMeter.
+
+TraceRecorder wraps the PyVISA instrument of a SourceMeter and writes
+every command, query, response, SRQ wait, serial poll, device clear
+and clock reading to a trace file along with when it happened and how
+long it took. TraceReplayer
+reads a trace back and stands in for the instrument, so a run that was
+recorded in the lab can be re-executed offline exactly as it happened:
+
+    smu = SMUExperiments(Transport=TraceReplayer('run.trace'))
+    smu.KWARGS = ...  # Same arguments as the recorded run
+    data = smu.slow_chrono(SweepPath)
+
+The replay checks that every call made is the one that was recorded
+and raises TraceMismatch as soon as the code under test does something
+different. A call that failed in the recorded session raises the
+same class of error (ReplayedError if the class can not be found), so
+the error handling and session recovery are replayed as well. By
+default the replay runs as fast as possible; with RealTime=True each
+response is held back until the time it took in the recorded session.
+
+The trace file is a gzip compressed stream of binary records, one per
+event (see the EVENT constants below).
+"""
+
+import gzip
+import importlib
+import struct
+import time
+from clocksync import host_clock
+
+MAGIC = b'SCPITRC1'
+
+# Event kinds
+WRITE = b'W'
+ASK = b'Q'
+ASK_VALUES = b'V'
+SRQ = b'S'
+CLOCK = b'C'
+STB = b'B'
+CLEAR = b'L'
+ERROR = b'X'
+EVENT_NAMES = {WRITE: 'write', ASK: 'ask', ASK_VALUES: 'ask_for_values',
+               SRQ: 'wait_for_srq', CLOCK: 'clock', STB: 'read_stb',
+               CLEAR: 'clear', ERROR: 'error'}
+
+# Every record starts with the kind, the start time (seconds from the
+# start of the trace) and the duration of the call.
+RECORD = struct.Struct('<cdf')
+LENGTH = struct.Struct('<I')
+FLOAT = struct.Struct('<d')
+
+
+class TraceMismatch(Exception):
+
+    """The replayed code made a call that is not in the trace."""
+
+
+class ReplayedError(Exception):
+
+    """An error raised by the instrument in the recorded session."""
+
+
+def _pack_string(string):
+    """Pack a string as its length and utf-8 bytes."""
+    data = string.encode('utf-8')
+    return LENGTH.pack(len(data)) + data
+
+
+def _error_name(e):
+    """Module qualified class name of an exception."""
+    return '%s.%s' % (type(e).__module__, type(e).__name__)
+
+
+def _replayed_error(recorded):
+    """Rebuild a recorded 'module.Class: message' error.
+
+    The error is an instance of the recorded class where that can be
+    imported and made, ReplayedError otherwise.
+    """
+    name, _, message = recorded.partition(': ')
+    module, _, cls = name.rpartition('.')
+    try:
+        cls = getattr(importlib.import_module(module or 'builtins'), cls)
+    except (ImportError, AttributeError, ValueError):
+        cls = None
+    if not (isinstance(cls, type) and issubclass(cls, Exception)):
+        return ReplayedError(recorded)
+    try:
+        return cls(message)
+    except Exception:
+        # Errors such as VisaIOError take other arguments.
+        e = cls.__new__(cls)
+        Exception.__init__(e, message)
+        return e
+
+
+class TraceRecorder(object):
+
+    """Record the I/O of an instrument to a trace file.
+
+    The recorder passes every call through to instrument and can be
+    used anywhere the instrument is. It also provides the clock and
+    sleep functions that SourceMeter uses for timing so that the time
+    readings the code made are part of the trace. Those are the ones of
+    the instrument if it has them (like the simulator), the host clock
+    otherwise.
+    """
+
+    def __init__(self, instrument, filename):
+        """Open the trace file."""
+        self._instrument = instrument
+        self._clock = getattr(instrument, 'clock', host_clock)
+        self._sleep = getattr(instrument, 'sleep', time.sleep)
+        self._file = gzip.open(filename, 'wb')
+        self._file.write(MAGIC)
+        self._start = self._clock()
+
+    def _record(self, kind, start, payload=b''):
+        """Write a record for a call that started at start."""
+        now = self._clock()
+        self._file.write(RECORD.pack(kind, start - self._start, now - start) +
+                         payload)
+
+    def _call(self, kind, function, command, *args):
+        """Call function and record it along with any error it raised."""
+        start = self._clock()
+        try:
+            response = function(*args)
+        except Exception as e:
+            self._record(kind, start, _pack_string(command) + b'\x00')
+            self._record(ERROR, start, _pack_string(
+                '%s: %s' % (_error_name(e), e)))
+            raise
+        return start, response
+
+    @property
+    def values_format(self):
+        return self._instrument.values_format
+
+    @values_format.setter
+    def values_format(self, value):
+        self._instrument.values_format = value
+
+    def write(self, command):
+        start, _ = self._call(WRITE, self._instrument.write, command,
+                              command)
+        self._record(WRITE, start, _pack_string(command) + b'\x01')
+
+    def ask(self, command):
+        start, response = self._call(ASK, self._instrument.ask, command,
+                                     command)
+        self._record(ASK, start, _pack_string(command) + b'\x01' +
+                     _pack_string(response))
+        return response
+
+    def ask_for_values(self, command):
+        start, values = self._call(ASK_VALUES, self._instrument.ask_for_values,
+                                   command, command)
+        values = list(values)
+        self._record(ASK_VALUES, start, _pack_string(command) + b'\x01' +
+                     LENGTH.pack(len(values)) +
+                     struct.pack('<%dd' % len(values), *values))
+        return values
+
+    def wait_for_srq(self, timeout=None):
+        start, response = self._call(
+            SRQ, self._instrument.wait_for_srq, str(timeout), timeout)
+        self._record(SRQ, start, _pack_string(str(timeout)) + b'\x01')
+        return response
+
+    @property
+    def read_stb(self):
+        """Serial poll of the instrument (if it has one)."""
+        # Missing like on the instrument, so callers can fall back.
+        read_stb = getattr(self._instrument, 'read_stb')
+
+        def recorded():
+            start, response = self._call(STB, read_stb, '')
+            self._record(STB, start, _pack_string('') + b'\x01' +
+                         _pack_string(str(int(response))))
+            return response
+        return recorded
+
+    def clear(self):
+        start, _ = self._call(CLEAR, self._instrument.clear, '')
+        self._record(CLEAR, start, _pack_string('') + b'\x01')
+
+    def clock(self):
+        """Return the clock and record the reading."""
+        now = self._clock()
+        self._record(CLOCK, now, FLOAT.pack(now))
+        return now
+
+    def sleep(self, seconds):
+        self._sleep(seconds)
+
+    def close(self):
+        """Close the trace file and the instrument."""
+        self._file.close()
+        if hasattr(self._instrument, 'close'):
+            self._instrument.close()
+
+    def __getattr__(self, name):
+        return getattr(self._instrument, name)
+
+
+def read_trace(filename):
+    """Read a trace file.
+
+    Returns a list of events as tuples of (kind, start, duration,
+    command, response). The command of a clock event is None and its
+    response is the time read, the response of a serial poll is the
+    status byte. A call that raised an error has a response of
+    ReplayedError and is followed by an ERROR event with the class and
+    message of the error as its command.
+    """
+    with gzip.open(filename, 'rb') as f:
+        data = f.read()
+    if not data.startswith(MAGIC):
+        raise ValueError('%s is not a trace file.' % filename)
+    events = []
+    pos = len(MAGIC)
+
+    def string():
+        length, = LENGTH.unpack_from(data, pos)
+        return data[pos + 4:pos + 4 + length].decode('utf-8'), 4 + length
+
+    while pos < len(data):
+        kind, start, duration = RECORD.unpack_from(data, pos)
+        pos += RECORD.size
+        response = None
+        if kind == CLOCK:
+            command = None
+            response, = FLOAT.unpack_from(data, pos)
+            pos += FLOAT.size
+        else:
+            command, size = string()
+            pos += size
+            if kind != ERROR:
+                ok = data[pos:pos + 1] == b'\x01'
+                pos += 1
+                if not ok:
+                    response = ReplayedError
+                elif kind in (ASK, STB):
+                    response, size = string()
+                    pos += size
+                    if kind == STB:
+                        response = int(response)
+                elif kind == ASK_VALUES:
+                    count, = LENGTH.unpack_from(data, pos)
+                    response = list(struct.unpack_from('<%dd' % count, data,
+                                                       pos + 4))
+                    pos += 4 + 8 * count
+        events.append((kind, start, duration, command, response))
+    return events
+
+
+class TraceReplayer(object):
+
+    """Stand in for an instrument by replaying a trace.
+
+    Pass the replayer to SourceMeter (or SMUExperiments) as its
+    Transport. Each call is checked against the next event in the
+    trace and answered with the recorded response. The clock and sleep
+    functions replay the recorded time readings so timing dependent
+    loops such as slow_chrono take exactly the same path they did in
+    the recorded session. With RealTime=True each call returns at the
+    time it did in the recorded session, otherwise as fast as possible.
+    A call that failed raises the recorded error again (see
+    _replayed_error). read_stb is only there if the recorded instrument
+    had it, so code that checks for it takes the same path.
+    """
+
+    values_format = None
+
+    def __init__(self, filename, RealTime=False):
+        """Load the trace."""
+        self.events = read_trace(filename)
+        self.RealTime = RealTime
+        self.position = 0
+        self._start = None
+
+    def _next(self, kind, command=None):
+        """Return the next event after checking that it matches."""
+        if self._start is None:
+            self._start = time.time()
+        if self.position >= len(self.events):
+            raise TraceMismatch('Trace ended but %s(%r) was called.' %
+                                (EVENT_NAMES[kind], command))
+        event = self.events[self.position]
+        if event[0] != kind or (command is not None and event[3] != command):
+            raise TraceMismatch(
+                'Event %d: expected %s(%r) but %s(%r) was called.' %
+                (self.position, EVENT_NAMES[event[0]], event[3],
+                 EVENT_NAMES[kind], command))
+        self.position += 1
+        if self.RealTime:
+            wait = self._start + event[1] + event[2] - time.time()
+            if wait > 0:
+                time.sleep(wait)
+        if event[4] is ReplayedError:
+            recorded = self.events[self.position][3]
+            self.position += 1
+            raise _replayed_error(recorded)
+        return event[4]
+
+    @property
+    def finished(self):
+        """True once every event in the trace has been replayed."""
+        return self.position >= len(self.events)
+
+    def write(self, command):
+        self._next(WRITE, command)
+
+    def ask(self, command):
+        return self._next(ASK, command)
+
+    def ask_for_values(self, command):
+        return self._next(ASK_VALUES, command)
+
+    def wait_for_srq(self, timeout=None):
+        self._next(SRQ, str(timeout))
+
+    @property
+    def read_stb(self):
+        if not any(event[0] == STB for event in self.events):
+            raise AttributeError('read_stb')
+        return lambda: self._next(STB, '')
+
+    def clear(self):
+        self._next(CLEAR, '')
+
+    def clock(self):
+        return self._next(CLOCK)
+
+    def sleep(self, seconds):
+        # Sleeping is covered by the clock readings (and by the real
+        # time pacing of the calls after it).
+        pass
+
+    def close(self):
+        pass
@@ -0,0 +1,416 @@
+"""Local network service for run control and live data.
+
+RunService puts an SMUExperiments object behind a plain TCP socket so
+that runs can be queued, started, stopped and watched from other
+programs (or other computers) and not only from the main window:
+
+    python service.py --address GPIB0::25 --port 8742
+
+Each request is a line of JSON with a Command and the reply is a line
+of JSON with OK (and an Error if it is False):
+
+    {"Command": "queue", "SweepPath": [0.001, 0.002],
+     "KWARGS": {"ExperimentLength": 60}, "RunArgs": {"RunNumber": 2}}
+    {"Command": "start"}    run the queued runs one after the other
+    {"Command": "stop"}     stop the run (request_stop) and the queue
+    {"Command": "status"}
+
+A "queue" request can give a sweeps.Sweep definition (Sweep.to_dict)
+as Sweep instead of a SweepPath, and a Strategy and RecordData for
+slow_chrono.
+
+{"Command": "subscribe"} turns the connection into a stream of binary
+frames, each a FRAME_HEADER (kind, setpoint index, sequence number and
+payload length) and a payload. POINTS frames hold the float64 [voltage,
+current, time, globalTime] rows of a points_taken event; EVENT frames
+hold the JSON of the other slow_chrono events. A frame is packed once
+and handed to every subscriber's queue, so acquisition never waits on
+the network. When the queue of a slow subscriber is full, its oldest
+points frame is dropped (SlowClients='decimate', the gap shows in the
+sequence numbers; events are only dropped, oldest first, once the
+queue holds nothing else) or it is disconnected
+(SlowClients='drop'). ServiceClient is a client for
+scripts and tests.
+"""
+
+import argparse
+import json
+import logging
+import socket
+import struct
+import threading
+import time
+from collections import deque
+try:
+    import SocketServer as socketserver
+except ImportError:
+    import socketserver
+import numpy as np
+import sweeps
+
+log = logging.getLogger(__name__)
+
+DEFAULT_PORT = 8742
+# Frame header: kind, setpoint index, sequence number, payload length.
+FRAME_HEADER = struct.Struct('<cIII')
+POINTS = b'P'
+EVENT = b'E'
+# Frames that may wait for a subscriber before it counts as slow.
+MAX_QUEUE = 256
+
+
+class _Subscriber(object):
+
+    """Queue of frames waiting to be sent to one subscriber."""
+
+    def __init__(self, MaxQueue, Policy):
+        self.MaxQueue = MaxQueue
+        self.Policy = Policy
+        self.frames = deque()  # (is points, frame)
+        self.condition = threading.Condition()
+        self.closed = False
+        self.Dropped = 0
+
+    def offer(self, isPoints, frame):
+        """Queue a frame without ever waiting on the subscriber."""
+        with self.condition:
+            if self.closed:
+                return
+            if len(self.frames) >= self.MaxQueue:
+                if self.Policy == 'drop':
+                    self.closed = True
+                    self.frames.clear()
+                    self.condition.notify()
+                    return
+                # The oldest points frame goes, or the oldest frame if
+                # there are only events, so the queue stays bounded.
+                for position, (points, _) in enumerate(self.frames):
+                    if points:
+                        del self.frames[position]
+                        break
+                else:
+                    self.frames.popleft()
+                self.Dropped += 1
+            self.frames.append((isPoints, frame))
+            self.condition.notify()
+
+    def get(self, Timeout=1.):
+        """Return the next frame, None if there is none (yet)."""
+        with self.condition:
+            if not self.frames and not self.closed:
+                self.condition.wait(Timeout)
+            if self.frames:
+                return self.frames.popleft()[1]
+        return None
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        service = self.server.service
+        for line in iter(self.rfile.readline, b''):
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line.decode('utf-8'))
+                if request.get('Command') == 'subscribe':
+                    self._reply({'OK': True})
+                    self._stream(service)
+                    return
+                reply = service.command(request)
+            except Exception as e:
+                reply = {'OK': False, 'Error': str(e)}
+            self._reply(reply)
+
+    def _reply(self, reply):
+        self.request.sendall(json.dumps(reply, default=float).encode(
+            'utf-8') + b'\n')
+
+    def _stream(self, service):
+        subscriber = service.subscribe()
+        try:
+            while not (subscriber.closed and not subscriber.frames):
+                frame = subscriber.get()
+                if frame is not None:
+                    self.request.sendall(frame)
+        except socket.error:
+            pass
+        finally:
+            service.unsubscribe(subscriber)
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class RunService(object):
+
+    """Serve run control and live points of an SMUExperiments.
+
+    The service adds itself to Experiment.Listeners. Port 0 picks a
+    free port; the address actually used is in self.Address. Call
+    serve to start answering (in a background thread) and shutdown to
+    stop.
+    """
+
+    def __init__(self, Experiment, Host='127.0.0.1', Port=DEFAULT_PORT,
+                 MaxQueue=MAX_QUEUE, SlowClients='decimate'):
+        if SlowClients not in ('decimate', 'drop'):
+            raise ValueError('SlowClients must be decimate or drop.')
+        self.Experiment = Experiment
+        self.MaxQueue = MaxQueue
+        self.SlowClients = SlowClients
+        self.Queue = deque()
+        self.State = 'Idle'
+        self.LastError = None
+        self._subscribers = []
+        self._lock = threading.Lock()
+        self._worker = None
+        self._sequence = 0
+        self._progress = {'SetPoint': None, 'Index': None, 'Points': 0}
+        self._server = _Server((Host, Port), _Handler)
+        self._server.service = self
+        self.Address = self._server.server_address
+        Experiment.Listeners.append(self)
+
+    def serve(self):
+        """Start answering requests in a background thread."""
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        log.info('Run service listening on %s:%d.', *self.Address)
+
+    def shutdown(self):
+        """Stop the run and queue and stop answering requests."""
+        self.stop()
+        self._server.shutdown()
+        self._server.server_close()
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            subscriber.close()
+
+    # Subscribers.
+
+    def subscribe(self):
+        subscriber = _Subscriber(self.MaxQueue, self.SlowClients)
+        with self._lock:
+            self._subscribers.append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        subscriber.close()
+        with self._lock:
+            if subscriber in self._subscribers:
+                self._subscribers.remove(subscriber)
+        if subscriber.Dropped:
+            log.info('Subscriber missed %d frames.', subscriber.Dropped)
+
+    def _publish(self, kind, index, payload):
+        """Pack a frame once and offer it to every subscriber."""
+        with self._lock:
+            subscribers = list(self._subscribers)
+            if not subscribers:
+                return
+            self._sequence += 1
+            sequence = self._sequence
+        frame = FRAME_HEADER.pack(kind, index, sequence,
+                                  len(payload)) + payload
+        for subscriber in subscribers:
+            subscriber.offer(kind == POINTS, frame)
+
+    def _event(self, index, **values):
+        self._publish(EVENT, index or 0, json.dumps(
+            values, default=float).encode('utf-8'))
+
+    # slow_chrono events (called on the acquisition thread).
+
+    def run_started(self, SweepPath, KWARGS):
+        self._progress.update(SetPoint=None, Index=None, Points=0)
+        self._event(0, Event='run_started', SweepPath=list(SweepPath))
+
+    def setpoint_started(self, Index, SetPoint):
+        self._progress.update(SetPoint=SetPoint, Index=Index)
+        self._event(Index, Event='setpoint_started', SetPoint=SetPoint)
+
+    def points_taken(self, Index, Rows):
+        self._progress['Points'] += len(Rows)
+        self._publish(POINTS, Index,
+                      np.ascontiguousarray(Rows, '<f8').tobytes())
+
+    def setpoint_finished(self, Index, Data):
+        self._event(Index, Event='setpoint_finished', Points=len(Data))
+
+    def run_finished(self, Data):
+        self._event(0, Event='run_finished', SetPoints=len(Data))
+
+    # Run control.
+
+    def queue_run(self, SweepPath=None, Sweep=None, KWARGS=None,
+                  RunArgs=None, Strategy='Trace', RecordData='No'):
+        """Add a run to the queue and return the queue length."""
+        if Sweep is not None:
+            SweepPath = sweeps.Sweep.from_dict(Sweep)
+        if SweepPath is None:
+            raise ValueError('A run needs a SweepPath or a Sweep.')
+        with self._lock:
+            self.Queue.append({'SweepPath': SweepPath,
+                               'KWARGS': KWARGS or {},
+                               'RunArgs': RunArgs or {},
+                               'Strategy': Strategy,
+                               'RecordData': RecordData})
+            return len(self.Queue)
+
+    def start(self):
+        """Run the queued runs in a background thread."""
+        with self._lock:
+            if self._worker is not None and self._worker.is_alive():
+                return False
+            self.State = 'Running'
+            self._worker = threading.Thread(target=self._run_queue)
+            self._worker.daemon = True
+            self._worker.start()
+        return True
+
+    def stop(self):
+        """Stop the run that is going and the queue after it."""
+        with self._lock:
+            if self.State != 'Running':
+                # A stop with nothing running would stop the next run.
+                return
+            self.State = 'Stopping'
+            # Under the lock, so that _run_queue clears it if no run
+            # is left to stop.
+            self.Experiment.request_stop()
+
+    def _run_queue(self):
+        experiment = self.Experiment
+        while True:
+            with self._lock:
+                # A stop that came between runs is for the queue, not
+                # for the next run.
+                experiment.StopRequested = False
+                if self.State != 'Running' or not self.Queue:
+                    self.State = 'Idle'
+                    return
+                run = self.Queue.popleft()
+            experiment.KWARGS.update(run['KWARGS'])
+            experiment.RunArgs.update(run['RunArgs'])
+            try:
+                experiment.slow_chrono(run['SweepPath'],
+                                       RecordData=run['RecordData'],
+                                       Strategy=run['Strategy'])
+            except Exception as e:
+                log.exception('Queued run failed.')
+                self.LastError = str(e)
+                with self._lock:
+                    self.State = 'Stopping'
+
+    def status(self):
+        """Return the state of the service and the run."""
+        with self._lock:
+            subscribers = [{'Queued': len(subscriber.frames),
+                            'Dropped': subscriber.Dropped}
+                           for subscriber in self._subscribers]
+            status = {'State': self.State, 'Queued': len(self.Queue),
+                      'LastError': self.LastError,
+                      'Subscribers': subscribers}
+        status.update(self._progress)
+        return status
+
+    def command(self, request):
+        """Answer a request (see the module documentation)."""
+        request = dict(request)
+        name = request.pop('Command', None)
+        if name == 'queue':
+            return {'OK': True, 'Queued': self.queue_run(**request)}
+        if name == 'start':
+            return {'OK': True, 'Started': self.start()}
+        if name == 'stop':
+            self.stop()
+            return {'OK': True}
+        if name == 'status':
+            status = self.status()
+            status['OK'] = True
+            return status
+        return {'OK': False, 'Error': 'Unknown command %s.' % name}
+
+
+class ServiceClient(object):
+
+    """Client of a RunService."""
+
+    def __init__(self, Host='127.0.0.1', Port=DEFAULT_PORT, Timeout=10.):
+        self._socket = socket.create_connection((Host, Port), Timeout)
+        self._file = self._socket.makefile('rb')
+
+    def command(self, Command, **kwargs):
+        """Send a request and return the reply."""
+        kwargs['Command'] = Command
+        self._socket.sendall(json.dumps(kwargs).encode('utf-8') + b'\n')
+        reply = json.loads(self._file.readline().decode('utf-8'))
+        if not reply.get('OK'):
+            raise RuntimeError(reply.get('Error'))
+        return reply
+
+    def subscribe(self):
+        """Subscribe to the live data and yield the frames.
+
+        Yields (kind, index, sequence, values) where values is an
+        (n, 4) array for POINTS frames and a dictionary for EVENT
+        frames. The connection is only good for this afterwards.
+        """
+        self.command('subscribe')
+        while True:
+            header = self._file.read(FRAME_HEADER.size)
+            if len(header) < FRAME_HEADER.size:
+                return
+            kind, index, sequence, length = FRAME_HEADER.unpack(header)
+            payload = self._file.read(length)
+            if kind == POINTS:
+                values = np.frombuffer(payload, '<f8').reshape(-1, 4)
+            else:
+                values = json.loads(payload.decode('utf-8'))
+            yield kind, index, sequence, values
+
+    def close(self):
+        self._file.close()
+        self._socket.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--address', default='GPIB0::25',
+                        help='VISA address of the source meter.')
+    parser.add_argument('--simulate', action='store_true',
+                        help='Use the simulated instrument.')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='Interface to listen on.')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--slow-clients', default='decimate',
+                        choices=('decimate', 'drop'))
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    from keithley import SMUExperiments
+    transport = None
+    if args.simulate:
+        from simulator import SimulatedK2400
+        transport = SimulatedK2400()
+    service = RunService(SMUExperiments(args.address, Transport=transport),
+                         args.host, args.port, SlowClients=args.slow_clients)
+    service.serve()
+    try:
+        while True:
+            time.sleep(1.)
+    except KeyboardInterrupt:
+        service.shutdown()
+
+
+if __name__ == '__main__':
+    main()
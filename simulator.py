@@ -0,0 +1,428 @@
+"""Simulated Keithley 2400 for running experiments without hardware.
+
+SimulatedK2400 answers the SCPI commands that keithley.SourceMeter
+sends the same way the instrument does and can be passed to
+SourceMeter/SMUExperiments as their Transport:
+
+    smu = SMUExperiments(Transport=SimulatedK2400())
+
+Readings come from a simple membrane cell model (CellModel) and take
+as long as they would on the instrument (NPLC, trigger and source
+delays plus a fixed overhead per reading and a bus latency per call).
+Set TimeScale to run faster than real time; the instrument timestamps
+always follow the simulated time. As on the instrument, readings from
+:READ? are stamped with the timer (:SYST:TIME?) and those in the trace
+buffer with the time since the first reading in the buffer.
+
+In source list mode (:SOUR:CURR:MODE LIST) each reading of a trigger
+takes the next level of the list, and when the current steps the
+polarization of the cell decays with its time constant rather than
+at once (the ohmic drop does), as in a current interruption.
+
+With source auto clear on (:SOUR:CLE:AUTO ON) every reading is a pulse:
+the cell sees the level only from the start of the reading to its
+measurement and is back at rest between readings.
+
+SimulatedSwitch is a switch mainframe (see switching.SwitchCard) with a
+cell on each channel, that connects the cell of the closed channel to
+a SimulatedK2400.
+
+Anything that is written and not understood is stored so that it can
+be queried back with '?', which is how the instrument state queries
+are answered.
+"""
+
+import re
+import time
+import numpy as np
+
+# Long form SCPI nodes and their short forms.
+SHORT_FORMS = {'SOURCE': 'SOUR', 'SENSE': 'SENS', 'RANGE': 'RANG',
+               'TRIGGER': 'TRIG', 'TRACE': 'TRAC', 'SYSTEM': 'SYST',
+               'OUTPUT': 'OUTP', 'FORMAT': 'FORM', 'STATUS': 'STAT',
+               'FUNCTION': 'FUNC', 'COUNT': 'COUN', 'DELAY': 'DEL',
+               'LEVEL': 'LEV', 'POINTS': 'POIN', 'UPPER': 'UPP',
+               'DISPLAY': 'DISP', 'ENABLE': 'ENAB', 'AZERO': 'AZER',
+               'STATE': 'STAT', 'ROUTE': 'ROUT', 'TERMINALS': 'TERM',
+               'PROTECTION': 'PROT', 'INITIATE': 'INIT', 'CLEAR': 'CLE',
+               'FEED': 'FEED', 'CONTROL': 'CONT', 'MODE': 'MODE',
+               'VOLTAGE': 'VOLT', 'CURRENT': 'CURR', 'AUTO': 'AUTO'}
+
+LINE_FREQUENCY = 60.
+# The instrument timer rolls over after this many seconds.
+TIMER_WRAP = 100000.
+
+
+def normalize(header):
+    """Return the short upper case form of a SCPI command header."""
+    nodes = [SHORT_FORMS.get(node, node) for node in
+             header.lstrip(':').upper().split(':')]
+    # RANG and RANG:UPP are the same setting.
+    if nodes[-2:] == ['RANG', 'UPP']:
+        nodes.pop()
+    return ':'.join(nodes)
+
+
+class VisaTimeout(Exception):
+
+    """Raised when a simulated wait times out (like a VISA timeout)."""
+
+
+class CellModel(object):
+
+    """Simple model of a membrane cell.
+
+    The voltage across the cell is the membrane potential plus an
+    ohmic drop and a polarization that relaxes with time constant Tau
+    after every change in current. Above LimitingCurrent the cell
+    resistance increases by OverlimitingFactor. Noise is added with a
+    standard deviation of Noise volts.
+    """
+
+    def __init__(self, Resistance=100., Potential=0.01, Polarization=0.2,
+                 Tau=1., LimitingCurrent=0.005, OverlimitingFactor=3.,
+                 Noise=1e-5, Seed=None):
+        self.Resistance = Resistance
+        self.Potential = Potential
+        self.Polarization = Polarization
+        self.Tau = Tau
+        self.LimitingCurrent = LimitingCurrent
+        self.OverlimitingFactor = OverlimitingFactor
+        self.Noise = Noise
+        self.random = np.random.RandomState(Seed)
+
+    def voltage(self, current, elapsed):
+        """Return cell voltages for currents after elapsed seconds."""
+        current = np.asarray(current, dtype=float)
+        elapsed = np.asarray(elapsed, dtype=float)
+        resistance = np.where(np.abs(current) > self.LimitingCurrent,
+                              self.Resistance * self.OverlimitingFactor,
+                              self.Resistance)
+        relax = 1 + self.Polarization * (1 - np.exp(-elapsed / self.Tau))
+        noise = self.random.normal(0, self.Noise, np.shape(current))
+        return self.Potential + current * resistance * relax + noise
+
+    def remaining(self, current, elapsed, since):
+        """Polarization left since seconds after current is stepped.
+
+        current had flowed for elapsed seconds before the step.
+        """
+        resistance = (self.Resistance * self.OverlimitingFactor
+                      if abs(current) > self.LimitingCurrent
+                      else self.Resistance)
+        return (current * resistance * self.Polarization *
+                (1 - np.exp(-elapsed / self.Tau)) *
+                np.exp(-np.asarray(since) / self.Tau))
+
+    def current(self, voltage, elapsed):
+        """Return cell currents for applied voltages (inverse model)."""
+        voltage = np.asarray(voltage, dtype=float)
+        elapsed = np.asarray(elapsed, dtype=float)
+        relax = 1 + self.Polarization * (1 - np.exp(-elapsed / self.Tau))
+        noise = self.random.normal(0, self.Noise / self.Resistance,
+                                   np.shape(voltage))
+        return (voltage - self.Potential) / (self.Resistance * relax) + noise
+
+
+class SimulatedK2400(object):
+
+    """Simulated Keithley 2400 source meter.
+
+    Latency is the time every bus call takes and Overhead the time the
+    instrument needs per reading on top of the integration time. The
+    delays of the instrument are scaled by TimeScale (0 to not wait at
+    all) while the simulated time used for the timestamps is not. The
+    clock and sleep functions give and pass the simulated time, so a
+    SourceMeter using the simulator paces itself (and reports rates)
+    in instrument time whatever the TimeScale.
+
+    Faults can be simulated: MissedSRQ is the chance that the SRQ of an
+    *OPC never arrives (the status byte still shows the completion)
+    and hang makes measurements never complete until a device clear.
+    """
+
+    values_format = None
+
+    def __init__(self, Cell=None, TimeScale=1., Latency=0.0005,
+                 Overhead=0.0005, TransferTime=2e-5, ClockDrift=0.,
+                 MissedSRQ=0.):
+        self.Cell = Cell or CellModel(Seed=0)
+        self.TimeScale = TimeScale
+        self.Latency = Latency
+        self.Overhead = Overhead
+        self.TransferTime = TransferTime
+        # How much faster the instrument timer runs than real time.
+        self.ClockDrift = ClockDrift
+        self.MissedSRQ = MissedSRQ
+        self._random = np.random.RandomState(0)
+        # Measurements still to hang and whether one is hung now.
+        self.hangs = 0
+        self.hung = False
+        self.state = {}
+        self.Time = 0.  # Simulated time (s)
+        self._realStart = time.time()
+        self.reset()
+
+    def reset(self):
+        """Return to the power on state."""
+        self.state = {'SOUR:FUNC:MODE': 'VOLT', 'OUTP': 'OFF',
+                      'TRIG:COUN': '1', 'TRIG:DEL': '0', 'SOUR:DEL': '0',
+                      'SENS:VOLT:NPLC': '1', 'SENS:CURR:NPLC': '1',
+                      'TRAC:POIN': '100', 'TRAC:FEED:CONT': 'NEV',
+                      'SYST:AZER:STAT': '1', 'DISP:ENAB': '1',
+                      'SENS:VOLT:RANG:AUTO': '1', 'SENS:CURR:RANG:AUTO': '1',
+                      'SENS:VOLT:RANG': '21', 'SENS:CURR:RANG': '1.05E-4',
+                      'SOUR:VOLT:RANG': '21', 'SOUR:CURR:RANG': '1.05E-4',
+                      'SOUR:DEL:AUTO': '1', 'SOUR:CLE:AUTO': 'OFF',
+                      'SOUR:CURR:MODE': 'FIX', 'SOUR:VOLT:MODE': 'FIX',
+                      '*ESE': '0', '*SRE': '0'}
+        self.level = 0.
+        self.levelTime = self.Time
+        self.timerZero = self.Time
+        self.buffer = []
+        self.last = np.zeros((0, 3))
+        self.srqPending = False
+        self.srqLost = False
+
+    def hang(self, Count=1):
+        """Make the next Count measurements hang until a clear."""
+        self.hangs += Count
+
+    def clear(self):
+        """Device clear: abort a hung measurement and clear the SRQ."""
+        self._catch_up()
+        self._wait(self.Latency)
+        self.hung = False
+        self.srqPending = False
+        self.srqLost = False
+
+    def _catch_up(self):
+        """Let the simulated time pass that the caller spent idle.
+
+        When running in scaled real time, time spent between calls
+        (sleeping, computing) passes on the instrument as well.
+        """
+        if self.TimeScale:
+            self.Time = max(self.Time, (time.time() - self._realStart) /
+                            self.TimeScale)
+
+    def _wait(self, seconds):
+        """Let simulated time pass (and real time, scaled)."""
+        self.Time += seconds
+        if self.TimeScale and seconds > 0:
+            time.sleep(seconds * self.TimeScale)
+
+    def clock(self):
+        """Simulated time (s), the host clock of a simulated session."""
+        self._catch_up()
+        return self.Time
+
+    def sleep(self, seconds):
+        """Let seconds of simulated time pass."""
+        self._catch_up()
+        self._wait(seconds)
+
+    def timer(self, simTime=None):
+        """Reading of the instrument timer at a simulated time."""
+        if simTime is None:
+            simTime = self.Time
+        return ((simTime - self.timerZero) * (1 + self.ClockDrift) %
+                TIMER_WRAP)
+
+    def _float(self, key):
+        return float(self.state.get(key, 0))
+
+    def reading_time(self):
+        """Time one reading takes with the current settings."""
+        mode = self.state['SOUR:FUNC:MODE']
+        measure = 'CURR' if mode == 'VOLT' else 'VOLT'
+        return (self._float('SENS:%s:NPLC' % measure) / LINE_FREQUENCY +
+                self._float('TRIG:DEL') + self._float('SOUR:DEL') +
+                self.Overhead)
+
+    def _measure(self, count):
+        """Take count readings, returning [v, c, t] rows."""
+        step = self.reading_time()
+        start = self.Time
+        times = start + step * np.arange(1, count + 1)
+        elapsed = times - self.levelTime
+        if self.state['SOUR:CLE:AUTO'] in ('ON', '1'):
+            # A pulse from rest lasting the source delay and the
+            # integration.
+            elapsed = np.full(count, step - self._float('TRIG:DEL') -
+                              self.Overhead)
+            level = np.full(count, self.level)
+        elif self.state['OUTP'] in ('ON', '1'):
+            level = np.full(count, self.level)
+        else:
+            level = None
+        mode = self.state['SOUR:FUNC:MODE']
+        steps = []
+        if level is None:
+            level = np.zeros(count)
+        elif self.state['SOUR:%s:MODE' % mode] == 'LIST':
+            levels = np.array(self.state['SOUR:LIST:' + mode].split(','),
+                              dtype=float)
+            level = levels[np.arange(count) % len(levels)]
+            steps = np.flatnonzero(np.diff(level)) + 1
+        if mode == 'CURR':
+            current = level
+            voltage = self.Cell.voltage(current, elapsed)
+            if len(steps):
+                # The current of the first step stops polarizing.
+                first = steps[0]
+                stepTime = times[first - 1]
+                voltage[first:] = (
+                    self.Cell.voltage(current[first:], times[first:] -
+                                      stepTime) +
+                    self.Cell.remaining(current[0], stepTime -
+                                        self.levelTime,
+                                        times[first:] - stepTime))
+        else:
+            voltage = level
+            current = self.Cell.current(voltage, elapsed)
+        self.Time = start
+        self._wait(step * count)
+        return np.column_stack((voltage, current, self.timer(times)))
+
+    def _initiate(self):
+        """Run the trigger model (:INIT)."""
+        rows = self._measure(int(self._float('TRIG:COUN')))
+        if self.state['TRAC:FEED:CONT'] == 'NEXT':
+            room = int(self._float('TRAC:POIN')) - len(self.buffer)
+            self.buffer.extend(rows[:max(room, 0)])
+        self.last = rows
+        return rows
+
+    def write(self, command):
+        self._catch_up()
+        self._wait(self.Latency)
+        header, _, value = command.strip().partition(' ')
+        header = normalize(header)
+        value = value.strip()
+        if header == '*RST':
+            self.reset()
+        elif header == '*CLS':
+            self.srqPending = False
+        elif header == '*OPC':
+            self.srqPending = not self.hung
+            self.srqLost = self._random.random_sample() < self.MissedSRQ
+        elif header == 'INIT':
+            if self.hangs:
+                self.hangs -= 1
+                self.hung = True
+            else:
+                self._initiate()
+        elif header == 'TRAC:CLE':
+            self.buffer = []
+        elif header == 'SYST:TIME:RES':
+            self.timerZero = self.Time
+        elif re.match(r'SOUR:(CURR|VOLT):LEV(:TRIG)?(:AMPL)?$', header):
+            self.level = float(value)
+            self.levelTime = self.Time
+        elif header == 'OUTP':
+            if value.upper() in ('ON', '1') and self.state['OUTP'] != 'ON':
+                self.levelTime = self.Time
+            self.state['OUTP'] = 'ON' if value.upper() in ('ON', '1') \
+                else 'OFF'
+        else:
+            self.state[header] = value.upper()
+
+    def ask(self, command):
+        self._catch_up()
+        self._wait(self.Latency)
+        header = normalize(command.strip().rstrip('?'))
+        if header == '*STB':
+            return str(96 if self.srqPending else 0)
+        elif header == '*OPC':
+            return '1'
+        elif header == 'SYST:TIME':
+            return repr(self.timer())
+        elif header == '*IDN':
+            return 'KEITHLEY INSTRUMENTS INC.,MODEL 2400,SIMULATED,0'
+        return self.state.get(header, '0')
+
+    def ask_for_values(self, command):
+        self._catch_up()
+        self._wait(self.Latency)
+        header = normalize(command.strip().rstrip('?'))
+        if header == 'TRAC:DATA':
+            rows = np.array(self.buffer, dtype=float).reshape(-1, 3)
+            # Trace timestamps count from the first buffered reading.
+            rows[:, 2] = (rows[:, 2] - rows[:1, 2]) % TIMER_WRAP
+        elif header in ('READ', 'MEAS'):
+            rows = self._initiate()
+        elif header == 'FETC':
+            rows = self.last
+        else:
+            raise ValueError('Simulator can not return values for %s' %
+                             command)
+        values = np.asarray(rows, dtype=float).ravel().tolist()
+        self._wait(self.TransferTime * len(values))
+        return values
+
+    def wait_for_srq(self, timeout=None):
+        """Wait for the SRQ of a pending *OPC (or raise VisaTimeout).
+
+        timeout is in milliseconds, as for a VISA instrument.
+        """
+        if not self.srqPending or self.srqLost:
+            if timeout is None:
+                raise RuntimeError('wait_for_srq would hang forever.')
+            self._wait(timeout / 1000.)
+            raise VisaTimeout('Timed out waiting for SRQ.')
+
+    def close(self):
+        pass
+
+
+class SimulatedSwitch(object):
+
+    """Simulated switch mainframe (a Keithley 7001 or 7002).
+
+    Cells maps channel names ('1!1') to the CellModel on each channel;
+    the cell of the closed channel is connected to SMU, a
+    SimulatedK2400 (which is open circuit while no channel is closed).
+    A connected cell starts from rest. Closing a channel takes
+    SwitchTime (scaled like the delays of the SMU) and every call the
+    bus Latency of the SMU.
+    """
+
+    def __init__(self, SMU, Cells, SwitchTime=0.003):
+        self.SMU = SMU
+        self.Cells = dict(Cells)
+        self.SwitchTime = SwitchTime
+        self.Closed = None
+        self.Open = CellModel(Resistance=1e9, Polarization=0., Noise=0.)
+        self.SMU.Cell = self.Open
+
+    def write(self, command):
+        self.SMU._catch_up()
+        self.SMU._wait(self.SMU.Latency)
+        header, _, value = command.strip().partition(' ')
+        header = normalize(header)
+        if header == 'ROUT:OPEN':
+            self.Closed = None
+            self.SMU.Cell = self.Open
+        elif header == 'ROUT:CLOS':
+            channels = value.strip().strip('(@)').split(',')
+            if len(channels) != 1 or channels[0] not in self.Cells:
+                raise ValueError('Simulated switch can not close %s.' %
+                                 value)
+            self.Closed = channels[0]
+            self.SMU.Cell = self.Cells[self.Closed]
+            self.SMU.levelTime = self.SMU.Time
+            self.SMU._wait(self.SwitchTime)
+
+    def ask(self, command):
+        self.SMU._catch_up()
+        self.SMU._wait(self.SMU.Latency)
+        header = normalize(command.strip().rstrip('?'))
+        if header == 'ROUT:CLOS':
+            return '(@%s)' % (self.Closed or '')
+        elif header == '*IDN':
+            return 'KEITHLEY INSTRUMENTS INC.,MODEL 7001,SIMULATED,0'
+        return '1'
+
+    def close(self):
+        pass
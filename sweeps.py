@@ -0,0 +1,251 @@
+"""Sweep definitions.
+
+A Sweep is an ordered list of segments, each made by one of the
+generators below, plus optional per-setpoint overrides of the dwell
+time (ExperimentLength) and of the time between points (PointDelay):
+
+    sweep = Sweep('IV')
+    sweep.add('linear', Start=-0.005, Stop=0.008, Points=14)
+    sweep.add('hysteresis', Amplitude=0.005, Points=9)
+    sweep.override(0, Dwell=60)
+
+sweep.setpoints() gives the plain list of setpoints that make_filenames
+and record_data_files use, and sweep.plan(KWARGS) compiles the sweep
+into a plan: a numpy record array with the SetPoint, Dwell and
+PointDelay of every step with the defaults from KWARGS filled in, which
+is what slow_chrono runs.
+
+Named sweeps are saved to and loaded from a JSON sweep library with
+save_sweep, load_sweeps and delete_sweep.
+"""
+
+import json
+import os
+import numpy as np
+
+PLAN_DTYPE = np.dtype([('SetPoint', 'f8'), ('Dwell', 'f8'),
+                       ('PointDelay', 'f8')])
+
+# Setpoints are rounded to this many significant digits so that the
+# filenames from make_filenames stay readable (0.001, not
+# 0.0010000000000000009).
+SIGNIFICANT_DIGITS = 9
+
+
+def round_setpoints(values):
+    """Round setpoints to SIGNIFICANT_DIGITS and return a list."""
+    return [float('%.*g' % (SIGNIFICANT_DIGITS, value)) for value in values]
+
+
+def linear(Start, Stop, Points):
+    """Points evenly spaced setpoints from Start to Stop."""
+    return round_setpoints(np.linspace(Start, Stop, int(Points)))
+
+
+def log(Start, Stop, Points):
+    """Points logarithmically spaced setpoints from Start to Stop.
+
+    Start and Stop must be non-zero and have the same sign.
+    """
+    if Start * Stop <= 0:
+        raise ValueError('A log sweep needs Start and Stop with the same '
+                         'sign and not zero.')
+    sign = np.sign(Start)
+    return round_setpoints(sign * np.geomspace(abs(Start), abs(Stop),
+                                               int(Points)))
+
+
+def staircase(Start, Stop, Step):
+    """Setpoints from Start towards Stop in steps of Step.
+
+    Stop is included if it is a whole number of steps from Start.
+    """
+    if Step == 0:
+        raise ValueError('A staircase needs a Step that is not zero.')
+    Step = abs(Step) if Stop >= Start else -abs(Step)
+    count = int(np.floor((Stop - Start) / Step + 1e-9)) + 1
+    return round_setpoints(Start + Step * np.arange(count))
+
+
+def up_down(Start, Stop, Points):
+    """Linear sweep from Start to Stop and back to Start.
+
+    Stop is only visited once.
+    """
+    up = linear(Start, Stop, Points)
+    return up + up[-2::-1]
+
+
+def hysteresis(Amplitude, Points, Cycles=1, Offset=0.):
+    """Hysteresis loops around Offset.
+
+    Each cycle goes from Offset up to Offset + Amplitude, down to
+    Offset - Amplitude and back to Offset with Points setpoints per
+    quarter of the loop. Offset is only repeated between cycles.
+    """
+    Points = int(Points)
+    rise = np.linspace(0, 1, Points + 1)[1:]
+    quarter = np.concatenate((rise, rise[::-1][1:], [0]))
+    loop = np.concatenate((quarter, -quarter))
+    values = np.concatenate([[0]] + [loop] * int(Cycles))
+    return round_setpoints(Offset + Amplitude * values)
+
+
+def points(Values):
+    """An explicit list of setpoints."""
+    return round_setpoints(Values)
+
+
+GENERATORS = {'linear': linear, 'log': log, 'staircase': staircase,
+              'up_down': up_down, 'hysteresis': hysteresis,
+              'points': points}
+# Parameters of each generator in the order they are asked for.
+PARAMETERS = {'linear': ('Start', 'Stop', 'Points'),
+              'log': ('Start', 'Stop', 'Points'),
+              'staircase': ('Start', 'Stop', 'Step'),
+              'up_down': ('Start', 'Stop', 'Points'),
+              'hysteresis': ('Amplitude', 'Points', 'Cycles', 'Offset'),
+              'points': ('Values',)}
+
+
+class Sweep(object):
+
+    """A named sweep made of generated segments.
+
+    Segments is a list of (generator name, parameters) pairs (see
+    GENERATORS) and Overrides maps the index of a setpoint to a
+    dictionary that can hold a Dwell and/or a PointDelay for it.
+    """
+
+    def __init__(self, Name='Sweep', Segments=None, Overrides=None):
+        self.Name = Name
+        self.Segments = list(Segments or [])
+        self.Overrides = dict((int(key), dict(value)) for key, value in
+                              (Overrides or {}).items())
+
+    def add(self, Generator, **kwargs):
+        """Add a segment made by Generator(**kwargs) to the sweep."""
+        if Generator not in GENERATORS:
+            raise ValueError('Unknown sweep generator %s.' % Generator)
+        GENERATORS[Generator](**kwargs)  # Check the parameters.
+        self.Segments.append((Generator, kwargs))
+        return self
+
+    def override(self, Index, Dwell=None, PointDelay=None):
+        """Set the dwell and/or point delay of one setpoint.
+
+        Passing neither removes the override.
+        """
+        values = {}
+        if Dwell is not None:
+            values['Dwell'] = float(Dwell)
+        if PointDelay is not None:
+            values['PointDelay'] = float(PointDelay)
+        if values:
+            self.Overrides[int(Index)] = values
+        else:
+            self.Overrides.pop(int(Index), None)
+        return self
+
+    def setpoints(self):
+        """Return the setpoints of the sweep as a list."""
+        values = []
+        for generator, kwargs in self.Segments:
+            values.extend(GENERATORS[generator](**kwargs))
+        return values
+
+    def __len__(self):
+        return len(self.setpoints())
+
+    def plan(self, KWARGS):
+        """Compile the sweep into a plan (see make_plan)."""
+        return make_plan(self.setpoints(), KWARGS, self.Overrides)
+
+    def to_dict(self):
+        return {'Name': self.Name,
+                'Segments': [[generator, kwargs] for generator, kwargs
+                             in self.Segments],
+                'Overrides': dict((str(key), value) for key, value in
+                                  self.Overrides.items())}
+
+    @classmethod
+    def from_dict(cls, definition):
+        return cls(definition['Name'],
+                   [(str(generator), dict((str(key), value) for key, value
+                                          in kwargs.items()))
+                    for generator, kwargs in definition['Segments']],
+                   definition.get('Overrides'))
+
+
+def make_plan(SweepPath, KWARGS, Overrides=None):
+    """Compile a sweep into a plan.
+
+    SweepPath is a list of setpoints, a Sweep (or anything else with a
+    plan method, like an adaptive.AdaptiveSweep) or an existing plan
+    (which is returned as is). The Dwell and PointDelay of every step
+    are taken from Overrides and default to the ExperimentLength and
+    PointDelay in KWARGS.
+    """
+    if isinstance(SweepPath, np.ndarray) and SweepPath.dtype == PLAN_DTYPE:
+        return SweepPath
+    if hasattr(SweepPath, 'plan'):
+        return SweepPath.plan(KWARGS)
+    plan = np.zeros(len(SweepPath), dtype=PLAN_DTYPE)
+    plan['SetPoint'] = SweepPath
+    plan['Dwell'] = KWARGS['ExperimentLength']
+    plan['PointDelay'] = KWARGS['PointDelay']
+    for index, values in (Overrides or {}).items():
+        if 0 <= index < len(plan):
+            for key, value in values.items():
+                plan[key][index] = value
+    return plan
+
+
+def read_library(Filename):
+    """Return the sweep definitions saved in a library file."""
+    if not os.path.exists(Filename):
+        return {}
+    with open(Filename) as f:
+        return json.load(f)
+
+
+def _write_library(Filename, library):
+    directory = os.path.dirname(Filename)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    with open(Filename, 'w') as f:
+        json.dump(library, f, indent=1, sort_keys=True)
+
+
+def save_sweep(SweepDefinition, Filename):
+    """Save a sweep to a library file under its name."""
+    library = read_library(Filename)
+    library[SweepDefinition.Name] = SweepDefinition.to_dict()
+    _write_library(Filename, library)
+
+
+def delete_sweep(Name, Filename):
+    """Remove a named sweep from a library file."""
+    library = read_library(Filename)
+    if library.pop(Name, None) is not None:
+        _write_library(Filename, library)
+
+
+def load_sweeps(Filename):
+    """Load all of the sweeps in a library file.
+
+    Returns a dictionary of Sweep objects by name.
+    """
+    return dict((name, Sweep.from_dict(definition)) for name, definition
+                in read_library(Filename).items())
+
+
+def load_sweep(Name, Filename):
+    """Load one named sweep from a library file."""
+    return Sweep.from_dict(read_library(Filename)[Name])
+
+
+# The sweep the program has always used.
+DEFAULT_SWEEP = Sweep('Default', [('linear', {'Start': -0.005,
+                                              'Stop': 0.008,
+                                              'Points': 14})])
@@ -0,0 +1,169 @@
+"""Measuring several cells with one SMU through a switch card.
+
+SwitchCard drives a SCPI switching mainframe (a Keithley 7001 or 7002
+on the same bus as the SMU) that connects one cell at a time to the
+SMU. SMUExperiments.multiplexed_chrono uses it to run a chrono sweep on
+each of several cells at once:
+
+    switch = SwitchCard(rm.get_instrument('GPIB0::7'))
+    data = SMU.multiplexed_chrono(switch, [
+        {'Channel': '1!1', 'SweepPath': [0.001, 0.002],
+         'RunArgs': {'MembraneID': 'A'}},
+        {'Channel': '1!2', 'SweepPath': [0.001, 0.002],
+         'RunArgs': {'MembraneID': 'B'}}], RecordData='Yes')
+
+The points of the cells are interleaved by a MultiplexScheduler, and
+the data of each cell is recorded to its own files. A cell is open
+circuit while another is connected, so it only carries its setpoint
+while its points are being taken.
+"""
+
+import time
+import numpy as np
+from clocksync import host_clock
+
+# Relay settling time of the usual 7011 cards (s).
+SETTLE_TIME = 0.003
+
+
+class SwitchCard(object):
+
+    """A SCPI switch mainframe with one cell on each channel.
+
+    instrument is the VISA instrument of the mainframe (or a
+    simulator.SimulatedSwitch). Channels are given the way the
+    mainframe names them ('1!1' is card 1, channel 1). After a channel
+    closes, the close is confirmed with *OPC? and SettleTime (s) is
+    waited for the relay to settle. SwitchTime is the running mean of
+    how long a switch takes.
+    """
+
+    def __init__(self, instrument, SettleTime=SETTLE_TIME):
+        self.k700x = instrument
+        self.SettleTime = SettleTime
+        self.clock = getattr(instrument, 'clock', host_clock)
+        self.sleep = getattr(instrument, 'sleep', time.sleep)
+        self.Channel = None
+        self.Switches = 0
+        self.SwitchTime = SettleTime
+        self.open_all()
+
+    def open_all(self):
+        """Open every channel (no cell connected)."""
+        self.k700x.write(':ROUT:OPEN ALL')
+        self.k700x.ask('*OPC?')
+        self.Channel = None
+
+    def connect(self, Channel):
+        """Connect the cell on Channel and no other.
+
+        Opening and closing is break before make (the mainframe
+        default). Returns True if a switch had to be made.
+        """
+        if Channel == self.Channel:
+            return False
+        start = self.clock()
+        self.k700x.write(':ROUT:OPEN ALL')
+        self.k700x.write(':ROUT:CLOS (@%s)' % Channel)
+        self.k700x.ask('*OPC?')
+        if self.SettleTime:
+            self.sleep(self.SettleTime)
+        self.Channel = Channel
+        self.Switches += 1
+        self.SwitchTime += ((self.clock() - start - self.SwitchTime) /
+                            self.Switches)
+        return True
+
+    def close(self):
+        self.open_all()
+
+
+class MultiplexScheduler(object):
+
+    """Order the points of several cells that share one SMU.
+
+    Plans is a list of plans (see sweeps.make_plan), one for each cell.
+    Every cell runs its setpoints in order, with a point due every
+    PointDelay for Dwell seconds from the first point of the setpoint,
+    as slow_chrono would. next_cell picks the cell whose point is due
+    first. SwitchTime (s) is counted against the cells that are not
+    connected, so the SMU stays on a cell while its points come due
+    about as soon as those of the others, rather than switching away
+    and back, and only waits when no cell has a point due.
+
+    When the cells want points faster than the SMU can take them (their
+    points are overdue), switching after every point would spend most
+    of the time switching. A visit to a cell then goes on while its
+    points are due until it has lasted SwitchTime / MaxSwitching, so
+    no more than about MaxSwitching of the time goes to switches.
+    """
+
+    def __init__(self, Plans, SwitchTime=0., MaxSwitching=0.1):
+        self.Plans = list(Plans)
+        self.SwitchTime = SwitchTime
+        self.MaxSwitching = MaxSwitching
+        # Time the visit to the connected cell started.
+        self.VisitStart = None
+        count = len(self.Plans)
+        self.Step = np.zeros(count, dtype=int)
+        self.Due = np.zeros(count)
+        # Time of the first point of the current setpoint of each cell
+        # (nan before it).
+        self.StepStart = np.full(count, np.nan)
+        self.Done = np.array([not len(plan) for plan in self.Plans],
+                             dtype=bool)
+
+    def start(self, Now):
+        """Make a point of every cell due at Now."""
+        self.Due[:] = Now
+
+    def next_cell(self, Connected=None, Now=None):
+        """Return the cell to measure next, or None when all are done.
+
+        Connected is the cell connected now and Now the time.
+        """
+        if self.Done.all():
+            return None
+        if (Connected is not None and Now is not None and
+                not self.Done[Connected] and self.Due[Connected] <= Now and
+                self.VisitStart is not None and
+                Now - self.VisitStart < self.SwitchTime / self.MaxSwitching):
+            return Connected
+        cost = self.Due + self.SwitchTime
+        if Connected is not None:
+            cost[Connected] -= self.SwitchTime
+        cost[self.Done] = np.inf
+        cell = int(np.argmin(cost))
+        if cell != Connected:
+            self.VisitStart = Now
+        return cell
+
+    def step(self, Cell):
+        """Index, setpoint, dwell and point delay of a cell's setpoint."""
+        index = self.Step[Cell]
+        setPoint, dwell, delay = self.Plans[Cell][index].tolist()
+        return index, setPoint, dwell, delay
+
+    def point_taken(self, Cell, Time):
+        """Record a point of Cell taken at Time.
+
+        Returns True if that finished the setpoint (its next point would
+        be due after the dwell); the next setpoint of the cell is then
+        due at the end of the dwell.
+        """
+        _, _, dwell, delay = self.step(Cell)
+        if np.isnan(self.StepStart[Cell]):
+            self.StepStart[Cell] = Time
+        self.Due[Cell] = max(self.Due[Cell] + delay, Time)
+        end = self.StepStart[Cell] + dwell
+        if self.Due[Cell] < end:
+            return False
+        self.Due[Cell] = end
+        self.StepStart[Cell] = np.nan
+        self.Step[Cell] += 1
+        self.Done[Cell] = self.Step[Cell] >= len(self.Plans[Cell])
+        return True
+
+    def first_point(self, Cell):
+        """True if the next point of Cell starts its setpoint."""
+        return np.isnan(self.StepStart[Cell])
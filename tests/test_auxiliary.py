@@ -0,0 +1,32 @@
+"""Tests of the sensors polled alongside a run."""
+
+import numpy as np
+from auxiliary import AuxiliaryRecorder, SimulatedSensor
+from keithley import SMUExperiments
+from simulator import SimulatedK2400
+
+
+def test_readings_follow_the_run():
+    simulator = SimulatedK2400(TimeScale=1)
+    smu = SMUExperiments(Transport=simulator)
+    smu.KWARGS.update(ExperimentLength=1, PointDelay=0.05, NPLC=0.1)
+    # A reading is its time on the clock of the SMU plus 10.
+    sensor = SimulatedSensor('HighTempIn', 'C', Value=10., Drift=1.,
+                             ReadTime=0.01, clock=simulator.clock,
+                             sleep=simulator.sleep)
+    recorder = AuxiliaryRecorder([sensor], Interval=0.1)
+    smu.Auxiliary = recorder
+    data = smu.slow_chrono([0.001, 0.002], Strategy='Read')
+    extra = recorder.extra_columns(data)
+    recorder.close()
+    assert extra['Labels'] == ['HighTempIn (C)']
+    assert [len(column) for column in extra['Columns']] == [
+        len(table) for table in data]
+    # Interpolated to the points, the readings keep in step with the
+    # global time of the run (to within a polling interval, as points
+    # after the last reading get that reading).
+    for table, column in zip(data, extra['Columns']):
+        lag = column[:, 0] - np.asarray(table)[:, 3]
+        assert np.ptp(lag) < recorder.Interval + sensor.ReadTime
+    assert np.all(np.isfinite(extra['Summary']))
+    assert 10 < recorder.solution_info()['HighTempIn'] < 13
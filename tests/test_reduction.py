@@ -0,0 +1,39 @@
+"""Tests of the on the fly reduction of chrono data."""
+
+import numpy as np
+import pytest
+import filemanipulation as fm
+import reduction
+from datastore import RunData
+
+
+def reduce_setpoint(Method, rows, **kwargs):
+    """Run rows through a filter the way slow_chrono does."""
+    reducer = reduction.make_filter(Method, **kwargs)
+    data = RunData()
+    data.start_setpoint(0.001)
+    for row in rows:
+        data.append_rows(reducer.filter([row]))
+    data.merge_rows(reducer.flush())
+    return reducer, data
+
+
+@pytest.mark.parametrize('Method', sorted(reduction.METHODS))
+def test_last_points_are_kept(Method):
+    voltage = [0., 0.01, 0.02, 0.5]
+    rows = np.column_stack((voltage, np.full(4, 0.001), np.arange(4.),
+                            np.arange(4.)))
+    reducer, data = reduce_setpoint(Method, rows, VoltageBand=0.1)
+    table = data[0]
+    # The setpoint stays in time order and ends with the last two
+    # points taken, so the steady state is the unreduced one.
+    assert np.all(np.diff(table[:, 2]) > 0)
+    assert np.array_equal(table[-2:], rows[-2:])
+    assert np.allclose(fm.generate_ss_array(data),
+                       fm.generate_ss_array([rows]))
+    assert reducer.describe()['PointsKept'] == len(table)
+
+
+def test_a_band_is_needed():
+    with pytest.raises(ValueError):
+        reduction.make_filter('deadband')
@@ -0,0 +1,92 @@
+"""Tests of the run service over a local socket."""
+
+import threading
+import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+import pytest
+from keithley import SMUExperiments
+from simulator import SimulatedK2400
+from service import RunService, ServiceClient, POINTS
+
+SHORT = {'ExperimentLength': 0.5, 'PointDelay': 0.002, 'NPLC': 0.01}
+
+
+@pytest.fixture
+def service():
+    smu = SMUExperiments(Transport=SimulatedK2400(TimeScale=0.1))
+    service = RunService(smu, Port=0)
+    service.serve()
+    yield service
+    service.shutdown()
+
+
+def subscribe(service):
+    """Return a queue that the frames of the service are put on."""
+    frames = queue.Queue()
+    client = ServiceClient(*service.Address)
+
+    def read():
+        for frame in client.subscribe():
+            frames.put(frame)
+    reader = threading.Thread(target=read)
+    reader.daemon = True
+    reader.start()
+    # Wait for the service to take the subscription.
+    while not service.status()['Subscribers']:
+        time.sleep(0.01)
+    return frames
+
+
+def until_event(frames, Event, Timeout=30.):
+    """Return the frames up to and including the event."""
+    got = []
+    while True:
+        frame = frames.get(timeout=Timeout)
+        got.append(frame)
+        if frame[0] != POINTS and frame[3]['Event'] == Event:
+            return got
+
+
+def wait_idle(client):
+    while client.command('status')['State'] != 'Idle':
+        time.sleep(0.01)
+
+
+def test_start_stop_start(service):
+    frames = subscribe(service)
+    client = ServiceClient(*service.Address)
+    client.command('queue', SweepPath=[0.001, 0.002], KWARGS=SHORT)
+    assert client.command('start')['Started']
+    got = until_event(frames, 'run_finished')
+    assert any(frame[0] == POINTS and len(frame[3]) for frame in got)
+    sequence = [frame[2] for frame in got]
+    assert sequence == list(range(sequence[0], sequence[0] + len(got)))
+    assert got[-1][3]['SetPoints'] == 2
+    wait_idle(client)
+
+    # A long run stopped once it has taken points.
+    client.command('queue', SweepPath=[0.001, 0.002],
+                   KWARGS={'ExperimentLength': 30})
+    client.command('start')
+    while frames.get(timeout=30)[0] != POINTS:
+        pass
+    client.command('stop')
+    assert until_event(frames, 'run_finished')[-1][3]['SetPoints'] == 1
+    wait_idle(client)
+    assert not service.Experiment.StopRequested
+
+    # The stop does not carry over to the next start.
+    client.command('queue', SweepPath=[0.001, 0.002], KWARGS=SHORT)
+    client.command('start')
+    assert until_event(frames, 'run_finished')[-1][3]['SetPoints'] == 2
+    client.close()
+
+
+def test_stop_when_idle(service):
+    client = ServiceClient(*service.Address)
+    client.command('stop')
+    assert not service.Experiment.StopRequested
+    client.close()
@@ -0,0 +1,32 @@
+"""Tests of multiplexed runs through a switch card."""
+
+import numpy as np
+from keithley import SMUExperiments
+from simulator import CellModel, SimulatedK2400, SimulatedSwitch
+from switching import SwitchCard
+
+
+def test_multiplexed_chrono():
+    simulator = SimulatedK2400(TimeScale=0)
+    cells = dict(('1!%d' % k, CellModel(Resistance=100. * k, Noise=0.,
+                                        Seed=k)) for k in (1, 2, 3))
+    card = SwitchCard(SimulatedSwitch(simulator, cells))
+    smu = SMUExperiments(Transport=simulator)
+    smu.KWARGS.update(NPLC=0.1, PointDelay=0.1, ExperimentLength=1)
+    data = smu.multiplexed_chrono(card, [
+        {'Channel': '1!%d' % k, 'SweepPath': [0.001, 0.002]}
+        for k in (1, 2, 3)])
+    assert len(data) == 3
+    for k, cell in enumerate(data):
+        assert cell.SetPoints == [0.001, 0.002]
+        for index, setPoint in enumerate(cell.SetPoints):
+            table = np.asarray(cell[index])
+            # Every cell gets its points at the requested pace.
+            assert len(table) >= 5
+            assert np.all(table[:, 1] == setPoint)
+            assert np.all(np.diff(table[:, 3]) > 0)
+            assert 0 <= table[0, 2] and table[-1, 2] < 1.1
+            # The points are of the cell on the channel.
+            ohmic = 100. * (k + 1) * setPoint
+            assert ohmic < table[-1, 0] < ohmic + 0.5
+    assert smu.MultiplexReport['Switches'] >= 3